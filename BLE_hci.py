@@ -68,13 +68,18 @@
 import serial
 import sys
 import signal
-import codecs
+import struct
 import argparse
 from argparse import RawTextHelpFormatter
 from time import sleep
 import datetime
+import queue
 import threading
 
+from ble_hci_console import CONN_STATS, HCI_CMD_ADV_ENABLE, HCI_CMD_DISCONNECT, HCI_CMD_RESET, HCI_CMDS_EVENT_MASKS, \
+    TEST_END, HciReader, addrCommand, advParamCommand, createConnCommand, defaultCmdTimeout, isDisconnectionComplete, \
+    isPhyUpdateComplete, phyCommand, setupCommands
+
 # Setup the default serial port settings
 defaultBaud=115200
 defaultSP="/dev/ttyUSB5"
@@ -159,7 +164,7 @@ class Namespace:
         self.__dict__.update(kwargs)
 
 
-class BLE_hci:
+class BLE_hci(HciReader):
     port = serial.Serial()
     serialPort = ""
 
@@ -214,6 +219,8 @@ class BLE_hci:
             monTraceMsgThread = threading.Thread(target=self.monTraceMsg, daemon=True)
             monTraceMsgThread.start()
 
+        self.startReader()
+
     def closeListenDiscon(self):
         # Close the listener thread if active
         self.listenDisconThread
@@ -229,6 +236,9 @@ class BLE_hci:
     ################################################################################
     def exitFunc(self, args):
 
+        # Stop the reader thread
+        self.stopReader()
+
         # Close the serial port
         if (self.port.open == True):
             self.port.flush()
@@ -252,59 +262,34 @@ class BLE_hci:
 
         sys.exit(exitFuncMagic)
 
+    def printCommand(self, packet):
+        if self.id == "-":
+            print(str(datetime.datetime.now()) + "  >", packet)
+        else:
+            print(str(datetime.datetime.now()) + f" {self.id}>", packet)
+
+    def printEvent(self, packet):
+        if self.id == "-":
+            print(str(datetime.datetime.now()) + "  <", str(packet))
+        else:
+            print(str(datetime.datetime.now()) + f" {self.id}<", str(packet))
+
     ## Wait for an HCI event.
     #
     # Waits for an HCI event, optionally prints the received event.
-    # Will timeout on the serial port if nothing arrives.
+    # Returns the HciPacket, None if nothing arrives within the timeout.
     ################################################################################
     def wait_event(self, print_evt=True, timeout=1.0):
-
-        # Set the serial port timeout
-        self.port.timeout = timeout
-
-        # Receive the event
-        evt = self.port.read(size=1)
-        if (len(evt) == 0):
-            # TODO: Read flush
-            self.port.flush()
-            return ""
-
-        evt = int(codecs.encode(evt, 'hex_codec'), 16)
-        status_string = '%02X' % evt
-
-        # ACL data
-        if (evt == 2):
-            # Receive the rest of the header
-            hdr = self.port.read(size=4)
-            packet_len = hdr[2] + (hdr[3] << 8)
-            hdr = int(codecs.encode(hdr, 'hex_codec'), 16)
-            status_string += '%08X' % hdr
-
-        # HCI Event
-        elif (evt == 4):
-            # Receive the rest of the header
-            hdr = self.port.read(size=2)
-            packet_len = hdr[1]
-            hdr = int(codecs.encode(hdr, 'hex_codec'), 16)
-            status_string += '%04X' % hdr
-
-        else:
-            print("Error: unknown evt = " + str(evt))
-            return
-
-        payload = self.port.read(size=packet_len)
+        try:
+            packet = self.events.get(timeout=timeout)
+        except queue.Empty:
+            return None
 
         # Print the packet
-        if print_evt and len(payload) > 0:
-            for i in range(0, len(payload)):
-                status_string += '%02X'%payload[i]
+        if print_evt and len(packet.payload) > 0:
+            self.printEvent(packet)
 
-            if self.id == "-":
-                print(str(datetime.datetime.now()) + "  <", status_string)
-            else:
-                print(str(datetime.datetime.now()) + f" {self.id}<", status_string)
-
-        return status_string
+        return packet
 
     ## Wait for HCI events.
     #
@@ -322,25 +307,25 @@ class BLE_hci:
 
     ## Send HCI command.
     #
-    # Send a HCI command to the serial port. Will add a small delay and wait for
-    # and print an HCI event by default.
+    # Send a HCI command to the serial port. The command is sent when the controller
+    # has a command credit, and by default waits for and prints its Command Complete
+    # or Command Status, which is returned as an HciPacket, None if the controller
+    # did not respond.
+    #
+    # Wait for the events a test depends on with wait_for_event(), e.g.
+    # wait_for_event(isConnectionComplete), rather than with a fixed delay.
     ################################################################################
-    def send_command(self, packet, resp=True, delay=0.01, print_cmd=True):
-        # Send the command and data
-        if(print_cmd):
-            if self.id == "-":
-                print(str(datetime.datetime.now()) + "  >", packet)
-            else:
-                print(str(datetime.datetime.now()) + f" {self.id}>", packet)
-
-        self.port.write(bytearray.fromhex(packet))
-
-        sleep(0.2) # for better sync of controller status change and master/slave sync
+    def send_command(self, packet, resp=True, delay=0, print_cmd=True, timeout=defaultCmdTimeout):
+        if delay:
+            sleep(delay)
 
-        sleep(delay)
+        future = self.send_command_async(packet, resp=resp, print_cmd=print_cmd, timeout=timeout)
 
         if (resp):
-            return self.wait_event()
+            evt = self.waitResponse(future, timeout)
+            if evt is not None:
+                self.printEvent(evt)
+            return evt
 
     ## Parse connection stats event.
     #
@@ -348,19 +333,9 @@ class BLE_hci:
     ################################################################################
     def parseConnStatsEvt(self, evt):
         try:
-            # Offset into the event where the stats start, each stat is 32 bits, or
-            # 8 hex nibbles
-            i = 14
-            rxDataOk = int(evt[6 + i:8 + i] + evt[4 + i:6 + i] + evt[2 + i:4 + i] + evt[0 + i:2 + i], 16)
-            i += 8
-            rxDataCRC = int(evt[6 + i:8 + i] + evt[4 + i:6 + i] + evt[2 + i:4 + i] + evt[0 + i:2 + i], 16)
-            i += 8
-            rxDataTO = int(evt[6 + i:8 + i] + evt[4 + i:6 + i] + evt[2 + i:4 + i] + evt[0 + i:2 + i], 16)
-            i += 8
-            txData = int(evt[6 + i:8 + i] + evt[4 + i:6 + i] + evt[2 + i:4 + i] + evt[0 + i:2 + i], 16)
-            i += 8
-            errTrans = int(evt[6 + i:8 + i] + evt[4 + i:6 + i] + evt[2 + i:4 + i] + evt[0 + i:2 + i], 16)
-        except ValueError as err:
+            # The stats are 32 bit values after the status
+            rxDataOk, rxDataCRC, rxDataTO, txData, errTrans = CONN_STATS.unpack_from(evt.params)
+        except (AttributeError, struct.error) as err:
             print(f'{self.id}: {evt}')
             print(err)
             return None
@@ -436,7 +411,7 @@ class BLE_hci:
             evt = self.wait_event(timeout=0.1)
             if (self.listenDisconStop):
                 sys.exit(1)
-            if ("040504" in evt):
+            if evt is not None and isDisconnectionComplete(evt):
                 if (self.listenDisconCommand != ""):
                     self.send_command(listenDisconCommand)
 
@@ -450,11 +425,8 @@ class BLE_hci:
     #  Sets the public BD address for the device.
     ################################################################################
     def addrFunc(self, args):
-        # Reorder the address
-        addrBytes = parseBdAddr(args.addr)
-
         # Send the vendor specific set address command
-        self.send_command("01F0FF06" + addrBytes)
+        self.send_command(addrCommand(args.addr))
 
     ## Start advertising function.
     #
@@ -468,45 +440,14 @@ class BLE_hci:
             else:
                 args.stats = False
         
-        # Bogus address to use for commands, allows any peer to connect
-        peer_addr = "000000000000"
-
-        # Setup the event masks
-        self.send_command("01010C08FFFFFFFFFFFFFFFF")
-        self.send_command("01630C08FFFFFFFFFFFFFFFF")
-        self.send_command("01010C08FFFFFFFFFFFFFFFF")
-        self.send_command("01012008FFFFFFFFFFFFFFFF")
-
-        # Reset the connection stats
-        if (args.stats):
-            self.send_command("0102FF00")
-
-        # Set default PHY to enable all PHYs
-        self.send_command("01312003" + "00" + "07" + "07")
+        # Setup the event masks, reset the connection stats, enable all PHYs
+        for cmd in setupCommands(args.stats):
+            self.send_command(cmd)
 
-        advType = "03"  # Non connectable undirected advertising (ADV_NONCONN_IND)
-        if (args.connect == "True"):
-            advType = "00"  # Connectable and scannable undirected advertising (ADV_IND)
-
-        # Convert advertising interval string to int
-        advIntervalInt = int(args.interval, 16)
-
-        # Convert int to 2 hex bytes, LSB first
-        advInterval = "%0.2X" % (advIntervalInt & 0xFF)
-        advInterval += "%0.2X" % ((advIntervalInt & 0xFF00) >> 8)
-
-        # LeSetAdvParam(Advertising_Interval_Min=advInterval,
-        # Advertising_Interval_Max=advInterval,
-        # Advertising_Type=advType,
-        # Own_Address_Type=0 (public),
-        # Peer_Address_Type=0 (public),
-        # Peer_Address=peer_addr,
-        # Advertising_Channel_Map=7 (all 3 advertising channels),
-        # Advertising_Filter_Policy=0 (don't do any filtering))
-        self.send_command("0106200F" + advInterval + advInterval + advType + "0000" + peer_addr + "0700")
+        self.send_command(advParamCommand(args.interval, args.connect == "True"))
 
         # Start advertising
-        connCommand = "010A200101"
+        connCommand = HCI_CMD_ADV_ENABLE
 
         # Start a thread to listen for disconnection events and restart advertising
         if (args.maintain == True):
@@ -561,10 +502,8 @@ class BLE_hci:
     def scanFunc(self, args):
 
         # Setup the event masks
-        self.send_command("01010C08FFFFFFFFFFFFFFFF")
-        self.send_command("01630C08FFFFFFFFFFFFFFFF")
-        self.send_command("01010C08FFFFFFFFFFFFFFFF")
-        self.send_command("01012008FFFFFFFFFFFFFFFF")
+        for cmd in HCI_CMDS_EVENT_MASKS:
+            self.send_command(cmd)
 
         # Set scan parameters
         # Active scanning
@@ -591,40 +530,12 @@ class BLE_hci:
             else:
                 args.stats = False
 
-        # Reorder the address
-        addrBytes = parseBdAddr(args.addr)
-
-        # Setup the event masks
-        self.send_command("01010C08FFFFFFFFFFFFFFFF")
-        self.send_command("01630C08FFFFFFFFFFFFFFFF")
-        self.send_command("01010C08FFFFFFFFFFFFFFFF")
-        self.send_command("01012008FFFFFFFFFFFFFFFF")
-
-        # Reset the connection stats
-        if (args.stats):
-            self.send_command("0102FF00")
-
-        # Set default PHY to enable all PHYs
-        self.send_command("01312003" + "00" + "07" + "07")
-
-        # Convert connection interval string to int
-        connIntervalInt = int(args.interval, 16)
-
-        # Convert int to 2 hex bytes, LSB first
-        connInterval = "%0.2X" % (connIntervalInt & 0xFF)
-        connInterval += "%0.2X" % ((connIntervalInt & 0xFF00) >> 8)
-
-        # Convert supervision timeout string to int
-        supTimeoutInt = int(args.timeout, 16)
-
-        # Convert int to 2 hex bytes, LSB first
-        supTimeout = "%0.2X" % (supTimeoutInt & 0xFF)
-        supTimeout += "%0.2X" % ((supTimeoutInt & 0xFF00) >> 8)
+        # Setup the event masks, reset the connection stats, enable all PHYs
+        for cmd in setupCommands(args.stats):
+            self.send_command(cmd)
 
         # Create the connection, using a public address for peer and local
-        ownAddrType = "00"
-        connLatency = "0000"
-        connCommand = "010D2019A000A00000" + "00" + addrBytes + ownAddrType + connInterval + connInterval + connLatency + supTimeout + "0F100F10"
+        connCommand = createConnCommand(args.addr, args.interval, args.timeout)
 
         # Start a thread to listen for disconnection events and restart the connection
         if (args.maintain == True):
@@ -710,26 +621,14 @@ class BLE_hci:
 
     ## PHY switch function.
     #
-    # Sends HCI command to switch PHYs. Assumes that we can't do asymmetric PHY settings.
+    # Sends HCI command to switch PHYs, and waits for the PHY update to complete.
+    # Assumes that we can't do asymmetric PHY settings.
     # Assumes we're using connection handle 0000
     ################################################################################
     def phyFunc(self, args):
-        # Convert PHY options to bits
-        phy = "01"
-        phyOptions = "0000"
-        if (args.phy == "4"):
-            phy = "04"
-            phyOptions = "0100"
-        elif (args.phy == "3"):
-            phy = "04"
-            phyOptions = "0200"
-        elif (args.phy == "2"):
-            phy = "02"
-        elif (args.phy != "1"):
-            print("Invalid PHY selection, using 1M")
-
-        self.send_command("01322007" + "0000" + "00" + phy + phy + phyOptions)
-        self.wait_events(3)
+        self.send_command(phyCommand(args.phy))
+        if self.wait_for_event(isPhyUpdateComplete, timeout=3) is None:
+            print("PHY update did not complete")
 
     ## Rest function.
     #
@@ -741,7 +640,7 @@ class BLE_hci:
         self.closeListenDiscon()
 
         # Send the HCI command for HCI Reset
-        self.send_command("01030C00")
+        self.send_command(HCI_CMD_RESET)
 
     ## Listen for events.
     #
@@ -822,11 +721,13 @@ class BLE_hci:
     ################################################################################
     def endTestFunc(self, args):
         # Send the end test command, store the event
-        evtString = self.send_command("011F2000")
+        evt = self.send_command("011F2000")
+        if evt is None or len(evt.params) < TEST_END.size:
+            print("Error: no test end event")
+            return None
 
         # Parse the event and print the number of received packets
-        evtData = int(evtString, 16)
-        rxPackets = int((evtData & 0xFF00) >> 8) + int((evtData & 0xFF) << 8)
+        rxPackets = TEST_END.unpack_from(evt.params)[0]
         print("Received PKTS  : " + str(rxPackets))
         return rxPackets
 
@@ -857,7 +758,7 @@ class BLE_hci:
     ################################################################################
     def disconFunc(self, args):
         # Send the disconnect command, handle 0, reason 0x16 Local Host Term
-        self.send_command("01060403000016")
+        self.send_command(HCI_CMD_DISCONNECT)
 
     ## Set channel map function.
     #
@@ -926,14 +827,13 @@ class BLE_hci:
         totalLen = "%0.2X" % (1 + 4)
 
         # Send the command and save the event
-        evtString = self.send_command("0101FF" + totalLen + readLenString + addrBytes)
-
-        # Get the data
-        evtString = evtString[14:]
+        evt = self.send_command("0101FF" + totalLen + readLenString + addrBytes)
+        if evt is None:
+            print("Error: no response")
+            return None
 
-        # Split the data into bytes
-        chunks, chunk_size = len(evtString), 2
-        evtBytes = [evtString[i:i + chunk_size] for i in range(0, chunks, chunk_size)]
+        # Get the data, after the status
+        evtBytes = bytes(evt.params)
 
         # Print the data
         startingAddr = int(args.addr, 16)
@@ -955,10 +855,10 @@ class BLE_hci:
             lineAddr = int(i / 4) * 4 + (4 - (i % 4)) - 1
 
             # Print spaces if we're padding the length
-            if (lineAddr >= readLen):
+            if (lineAddr >= readLen) or (lineAddr >= len(evtBytes)):
                 print("__", end="")
             else:
-                print(evtBytes[lineAddr], end="")
+                print("%0.2X" % evtBytes[lineAddr], end="")
 
             # Print a new line at the end of the 32 bit value
             if (i % 4 == 3):
@@ -1155,6 +1055,16 @@ def run_terminal(params: dict):
                                            formatter_class=RawTextHelpFormatter)
     sinkAcl_parser.set_defaults(func=ble_hci.sinkAclFunc)
 
+    hostAcl_parser = subparsers.add_parser('hostAcl', help="Send and sink ACL packets from the host, print the "
+                                           "throughput", formatter_class=RawTextHelpFormatter)
+    hostAcl_parser.add_argument('packetLen', nargs='?', default=None,
+                                help="Number of bytes per ACL packet, decimal, default: controller buffer size")
+    hostAcl_parser.add_argument('-t', '--time', default="10", help="Seconds to run the test, default: 10")
+    hostAcl_parser.add_argument('--handle', nargs='+', default=["0"],
+                                help="Connection handles to send to, round robin, default: 0")
+    hostAcl_parser.add_argument('--rx', action='store_true', help="Only sink the received ACL packets")
+    hostAcl_parser.set_defaults(func=ble_hci.hostAclFunc)
+
     connStats_parser = subparsers.add_parser('connStats', help="Get the connection stats",
                                              formatter_class=RawTextHelpFormatter)
     connStats_parser.set_defaults(func=ble_hci.connStatsFunc)
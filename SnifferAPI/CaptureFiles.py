@@ -38,12 +38,18 @@
 import datetime
 import logging
 import os
+import threading
+import time
 
 from . import Logger
 from . import Pcap
 
 DEFAULT_CAPTURE_FILE_DIR = Logger.DEFAULT_LOG_FILE_DIR
 DEFAULT_CAPTURE_FILE_NAME = "capture.pcap"
+# The capture file is moved to the backup file at startup when it is larger than this
+MAX_CAPTURE_FILE_SIZE = 20000000
+DEFAULT_WRITE_BUFFER_SIZE = 64 * 1024
+DEFAULT_FLUSH_INTERVAL = 1.0
 
 
 def get_capture_file_path(capture_file_path=None, auto_test=False, given_name=None):
@@ -65,26 +71,46 @@ def get_capture_file_path(capture_file_path=None, auto_test=False, given_name=No
 
 
 class CaptureFileHandler:
-    def __init__(self, auto_test=False, given_name=None, capture_file_path=None, clear=False):
+    # The packets are collected in a buffer of buffer_size bytes, which is written to the file when it is full,
+    # when flush_interval seconds have passed since the last write (checked when a packet is written), on flush()
+    # and on close(). The CaptureWriter calls flush() when the packets stop, so that the tail of the capture does
+    # not stay in the buffer.
+    def __init__(self, auto_test=False, given_name=None, capture_file_path=None, clear=False,
+                 buffer_size=DEFAULT_WRITE_BUFFER_SIZE, flush_interval=DEFAULT_FLUSH_INTERVAL):
         filename = get_capture_file_path(capture_file_path, auto_test=auto_test, given_name=given_name)
         if not os.path.isdir(os.path.dirname(filename)):
             os.makedirs(os.path.dirname(filename))
         self.filename = filename
+        self.bufferSize = buffer_size
+        self.flushInterval = flush_interval
+        self._file = None
+        self._encoder = Pcap.PacketEncoder(buffer_size)
+        self._lastFlush = time.monotonic()
+        self._lock = threading.Lock()
 
         self.backupFilename = self.filename+".1"
         if not os.path.isfile(self.filename):
             self.startNewFile()
-        elif os.path.getsize(self.filename) > 20000000:
+        elif os.path.getsize(self.filename) > MAX_CAPTURE_FILE_SIZE:
             self.doRollover()
         if clear:
             #clear file
             self.startNewFile()
 
+    def __del__(self):
+        if hasattr(self, "_lock"):
+            self.close()
+
     def startNewFile(self):
-        with open(self.filename, "wb") as f:
-            f.write(Pcap.get_global_header())
+        with self._lock:
+            self._closeFile()
+            self._file = open(self.filename, "wb")
+            self._file.write(Pcap.get_global_header())
+            self._file.flush()
 
     def doRollover(self):
+        with self._lock:
+            self._closeFile()
         try:
             os.remove(self.backupFilename)
         except:
@@ -96,8 +122,38 @@ class CaptureFileHandler:
             logging.exception("capture file rollover failed")
 
     def writePacket(self, packet):
-        with open(self.filename, "ab") as f:
-            packet = Pcap.create_packet(
-                bytes([packet.boardId] + packet.getList()),
-                packet.time)
-            f.write(packet)
+        with self._lock:
+            self._encoder.add_packet(packet)
+            if len(self._encoder) >= self.bufferSize or time.monotonic() - self._lastFlush >= self.flushInterval:
+                self._flush()
+
+    def writePackets(self, packets):
+        with self._lock:
+            self._encoder.add_packets(packets)
+            if len(self._encoder) >= self.bufferSize or time.monotonic() - self._lastFlush >= self.flushInterval:
+                self._flush()
+
+    # Write the buffered packets to the file
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    # Write the buffered packets and close the file. Packets written after this reopen the file.
+    def close(self):
+        with self._lock:
+            self._closeFile()
+
+    def _flush(self):
+        if len(self._encoder):
+            if self._file is None:
+                self._file = open(self.filename, "ab")
+            self._encoder.write_to(self._file)
+        if self._file is not None:
+            self._file.flush()
+        self._lastFlush = time.monotonic()
+
+    def _closeFile(self):
+        self._flush()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
@@ -0,0 +1,159 @@
+# Copyright (c) Nordic Semiconductor ASA
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form, except as embedded into a Nordic
+#    Semiconductor ASA integrated circuit in a product or a software update for
+#    such product, must reproduce the above copyright notice, this list of
+#    conditions and the following disclaimer in the documentation and/or other
+#    materials provided with the distribution.
+#
+# 3. Neither the name of Nordic Semiconductor ASA nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#    software without specific prior written permission.
+#
+# 4. This software, with or without modification, must only be used with a
+#    Nordic Semiconductor ASA integrated circuit.
+#
+# 5. Any software provided in binary form under this license must not be reverse
+#    engineered, decompiled, modified and/or disassembled.
+#
+# THIS SOFTWARE IS PROVIDED BY NORDIC SEMICONDUCTOR ASA "AS IS" AND ANY EXPRESS
+# OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES
+# OF MERCHANTABILITY, NONINFRINGEMENT, AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL NORDIC SEMICONDUCTOR ASA OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE
+# GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT
+# OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import collections
+import logging
+import time
+from threading import Thread, Event
+
+# Number of packets the write queue holds before new packets are dropped
+DEFAULT_WRITE_QUEUE_SIZE = 20000
+# Seconds close() waits for the queued packets to be written
+DEFAULT_CLOSE_TIMEOUT = 5.0
+
+
+class CaptureWriter:
+    # Writes the captured packets to the sinks on a worker thread, so that a slow disk or a blocked capture pipe
+    # does not stall the UART packet processing.
+    # A sink is a callable which is called with each Packet, in the order the packets were put.
+    # onIdle is called on the worker thread when no packet was put for idleTimeout seconds after packets were
+    # written, e.g. to flush the buffered capture file when the traffic stops.
+    def __init__(self, sinks=(), queueSize=DEFAULT_WRITE_QUEUE_SIZE, metrics=None, onIdle=None, idleTimeout=None):
+        self.sinks = list(sinks)
+        self.metrics = metrics
+        self.onIdle = onIdle
+        self.idleTimeout = idleTimeout if onIdle is not None else None
+        self._writtenSinceIdle = False
+        self.write_queue = collections.deque()
+        self.write_queue_has_data = Event()
+        self.write_queue_size = queueSize
+        self.write_queue_peak = 0
+        self.queued_packets = 0
+        self.written_packets = 0
+        self.dropped_packets = 0
+        self.sink_errors = 0
+
+        self.worker_thread = Thread(target=self._write_worker)
+        self.writing = True
+        self.worker_thread.daemon = True
+        self.worker_thread.start()
+
+    def addSink(self, sink):
+        if sink not in self.sinks:
+            self.sinks = self.sinks + [sink]
+
+    def removeSink(self, sink):
+        self.sinks = [s for s in self.sinks if s != sink]
+
+    # Queue a packet for the sinks. The packet is dropped if the queue is full, this never blocks.
+    def put(self, packet):
+        if len(self.write_queue) >= self.write_queue_size:
+            if self.dropped_packets == 0:
+                logging.warning("capture write queue full (%d packets), dropping packets" % self.write_queue_size)
+            self.dropped_packets += 1
+            return
+        self.write_queue.append(packet)
+        self.queued_packets += 1
+        self.write_queue_peak = max(self.write_queue_peak, len(self.write_queue))
+        self.write_queue_has_data.set()
+
+    # Write the queued packets and stop the worker thread. Returns False when the worker is still writing after
+    # timeout, the sinks must then stay open.
+    def close(self, timeout=DEFAULT_CLOSE_TIMEOUT):
+        if self.writing:
+            self.writing = False
+            self.write_queue_has_data.set()
+            self.worker_thread.join(timeout)
+            if self.worker_thread.is_alive():
+                logging.warning("capture writer did not finish within %.1f seconds, %d packets not written"
+                                % (timeout, len(self.write_queue)))
+        return not self.worker_thread.is_alive()
+
+    # Backpressure statistics of the write queue
+    @property
+    def stats(self):
+        return {
+            "queued": self.queued_packets,
+            "written": self.written_packets,
+            "dropped": self.dropped_packets,
+            "pending": len(self.write_queue),
+            "queue_size": self.write_queue_size,
+            "queue_peak": self.write_queue_peak,
+            "sink_errors": self.sink_errors,
+        }
+
+    def _write_worker(self):
+        while True:
+            if not self.write_queue_has_data.wait(self.idleTimeout):
+                self._idle()
+                continue
+            self.write_queue_has_data.clear()
+            self._write_queued()
+            if not self.writing:
+                self._write_queued()
+                return
+
+    def _write_queued(self):
+        metrics = self.metrics
+        while self.write_queue:
+            packet = self.write_queue.popleft()
+            timed = metrics is not None and metrics.enabled
+            if timed:
+                start = time.perf_counter()
+            for sink in self.sinks:
+                try:
+                    sink(packet)
+                except OSError as e:
+                    # E.g. the capture pipe was closed by Wireshark, stop writing to this sink
+                    logging.info("capture sink %s failed, removing it: %s" % (sink, e))
+                    self.sink_errors += 1
+                    self.removeSink(sink)
+                except Exception as e:
+                    logging.exception("capture sink error: %s" % e)
+                    self.sink_errors += 1
+            self.written_packets += 1
+            self._writtenSinceIdle = True
+            if timed:
+                metrics.addTime("capture.write", time.perf_counter() - start)
+
+    def _idle(self):
+        if not self._writtenSinceIdle:
+            return
+        self._writtenSinceIdle = False
+        try:
+            self.onIdle()
+        except Exception as e:
+            logging.exception("capture writer idle callback error: %s" % e)
@@ -51,6 +51,9 @@ class InvalidPacketException(Exception):
 class InvalidAdvChannel(Exception):
     pass
 
+class InvalidCaptureFile(Exception):
+    pass
+
 # Internal Use
 class SnifferWatchDogTimeout(SnifferTimeout):
     pass
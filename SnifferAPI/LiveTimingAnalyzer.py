@@ -0,0 +1,121 @@
+# Copyright (c) Nordic Semiconductor ASA
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form, except as embedded into a Nordic
+#    Semiconductor ASA integrated circuit in a product or a software update for
+#    such product, must reproduce the above copyright notice, this list of
+#    conditions and the following disclaimer in the documentation and/or other
+#    materials provided with the distribution.
+#
+# 3. Neither the name of Nordic Semiconductor ASA nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#    software without specific prior written permission.
+#
+# 4. This software, with or without modification, must only be used with a
+#    Nordic Semiconductor ASA integrated circuit.
+#
+# 5. Any software provided in binary form under this license must not be reverse
+#    engineered, decompiled, modified and/or disassembled.
+#
+# THIS SOFTWARE IS PROVIDED BY NORDIC SEMICONDUCTOR ASA "AS IS" AND ANY EXPRESS
+# OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES
+# OF MERCHANTABILITY, NONINFRINGEMENT, AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL NORDIC SEMICONDUCTOR ASA OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE
+# GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT
+# OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import collections
+import threading
+
+from . import Packet, TimingAnalyzer
+from .Trace import tracer, INFO, CAT_TIMING
+
+MAX_MESSAGES = 1000
+
+
+class LiveTimingAnalyzer:
+    # T_IFS, PHY switch and connection timing of the packets captured by a Sniffer, analysed as they are captured.
+    #
+    # The analyzer subscribes to the NEW_BLE_PACKET notification of the Sniffer, and runs the same analysis as the
+    # offline parser reading the capture file (file type 0), on the pipe thread of the Sniffer. The packet history the
+    # analysis needs is kept in a parser PacketReader of its own, as the one of the Sniffer is already updated when
+    # the notification is sent.
+    #
+    # The messages of the analysis are not printed on the pipe thread. They are traced in CAT_TIMING and the last
+    # MAX_MESSAGES are kept in messages, for the caller to print once the capture is done. An analyzer given by the
+    # caller keeps its own output.
+    #
+    # on_failure is called with the reason the first time TimingAnalyzer.checkFailure() fails, on the pipe thread.
+    def __init__(self, notifier=None, analyzer=None, on_failure=None):
+        self.messages = collections.deque(maxlen=MAX_MESSAGES)
+        if analyzer is None:
+            analyzer = TimingAnalyzer.TimingAnalyzer(output=self._output)
+        self.analyzer = analyzer
+        self.onFailure = on_failure
+        self.failed = threading.Event()
+        self._notifier = None
+        self.reset()
+
+        if notifier is not None:
+            self.attach(notifier)
+
+    def reset(self):
+        self.analyzer.reset()
+        self._reader = Packet.PacketReader(pcapng_parser=True, timing_analyzer=self.analyzer)
+        self.packets = 0
+        self.failure = None
+        self.failed.clear()
+        self.messages.clear()
+
+    # Start analysing the packets of notifier, a Sniffer or SnifferCollector
+    def attach(self, notifier):
+        self.detach()
+        notifier.subscribe("NEW_BLE_PACKET", self._onNewBlePacket)
+        self._notifier = notifier
+
+    def detach(self):
+        if self._notifier is not None:
+            self._notifier.unSubscribe("NEW_BLE_PACKET", self._onNewBlePacket)
+            self._notifier = None
+
+    def _onNewBlePacket(self, notification):
+        self.analyzePacket(notification.msg["packet"])
+
+    # The packet is shared with the other subscribers and is not modified, its timing is passed to the analyzer
+    def analyzePacket(self, packet):
+        reader = self._reader
+        analyzer = self.analyzer
+
+        end_to_start = analyzer.packetTiming(packet, reader, 0)
+        if packet.OK and packet.blePacket is not None:
+            # The capture file records the packet with the time set by SnifferCollector
+            analyzer.analyzePacket(packet, packet.blePacket.type, reader, packet.time,
+                                   end_to_start if end_to_start is not None else 0)
+
+        # Only BLE packets are notified, as only they are in the capture file
+        reader.lastReceivedPacket = packet
+        reader.lastReceivedTimestampPacket = packet
+        self.packets += 1
+
+        if self.failure is None:
+            failure = analyzer.checkFailure()
+            if failure is not None:
+                self.failure = failure
+                self.failed.set()
+                if self.onFailure is not None:
+                    self.onFailure(failure)
+
+    def _output(self, msg):
+        self.messages.append(msg)
+        if tracer.info:
+            tracer.trace(INFO, CAT_TIMING, "130", "%s", msg.rstrip("\n"))
@@ -0,0 +1,125 @@
+# Copyright (c) Nordic Semiconductor ASA
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form, except as embedded into a Nordic
+#    Semiconductor ASA integrated circuit in a product or a software update for
+#    such product, must reproduce the above copyright notice, this list of
+#    conditions and the following disclaimer in the documentation and/or other
+#    materials provided with the distribution.
+#
+# 3. Neither the name of Nordic Semiconductor ASA nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#    software without specific prior written permission.
+#
+# 4. This software, with or without modification, must only be used with a
+#    Nordic Semiconductor ASA integrated circuit.
+#
+# 5. Any software provided in binary form under this license must not be reverse
+#    engineered, decompiled, modified and/or disassembled.
+#
+# THIS SOFTWARE IS PROVIDED BY NORDIC SEMICONDUCTOR ASA "AS IS" AND ANY EXPRESS
+# OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES
+# OF MERCHANTABILITY, NONINFRINGEMENT, AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL NORDIC SEMICONDUCTOR ASA OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE
+# GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT
+# OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import collections
+import logging
+import threading
+import time
+
+
+class Metrics:
+    # Counters and timers for the sniffer hot path, and gauges which are read when a snapshot is taken.
+    #
+    # Counters and timers are only updated when enabled, callers check it first so that a disabled registry costs
+    # one attribute lookup:
+    #     if metrics.enabled:
+    #         metrics.count("uart.bytes_read", len(data))
+    # Counters and timers are updated from the UART reader, the SnifferCollector pipe and the CaptureWriter threads.
+    # Each one has a single writer, so updates are not lost without a lock. snapshot() reads them without a lock as
+    # well, its values are best-effort and may be a few updates behind or mix values from slightly different times.
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.counters = collections.defaultdict(int)
+        self.timers = collections.defaultdict(lambda: [0.0, 0])
+        self._gauges = {}
+        self._dumpThread = None
+        self._dumpStop = threading.Event()
+
+    def count(self, name, value=1):
+        self.counters[name] += value
+
+    # Add the time spent in one call of a stage, in seconds
+    def addTime(self, name, seconds):
+        timer = self.timers[name]
+        timer[0] += seconds
+        timer[1] += 1
+
+    # Register a gauge, read is called without arguments when a snapshot is taken
+    def addGauge(self, name, read):
+        self._gauges[name] = read
+
+    def reset(self):
+        self.counters.clear()
+        self.timers.clear()
+
+    def snapshot(self):
+        gauges = {}
+        for name, read in list(self._gauges.items()):
+            try:
+                gauges[name] = read()
+            except Exception:
+                gauges[name] = None
+
+        timers = {}
+        for name, (seconds, calls) in list(self.timers.items()):
+            timers[name] = {
+                "calls": calls,
+                "total_s": seconds,
+                "mean_us": seconds / calls * 1E6 if calls else 0.0,
+            }
+
+        return {
+            "enabled": self.enabled,
+            "time": time.time(),
+            "counters": dict(self.counters),
+            "timers": timers,
+            "gauges": gauges,
+        }
+
+    # Log a snapshot every interval seconds on a background thread
+    def startDump(self, interval, output=logging.info):
+        self.stopDump()
+        self._dumpStop.clear()
+        self._dumpThread = threading.Thread(target=self._dump, args=(interval, output), daemon=True)
+        self._dumpThread.start()
+
+    def stopDump(self):
+        if self._dumpThread is not None:
+            self._dumpStop.set()
+            self._dumpThread.join()
+            self._dumpThread = None
+
+    def _dump(self, interval, output):
+        while not self._dumpStop.wait(interval):
+            output(format_snapshot(self.snapshot()))
+
+
+def format_snapshot(snapshot):
+    """Format a snapshot as one line of name=value pairs."""
+    items = [f"{name}={value}" for name, value in sorted(snapshot["counters"].items())]
+    items += [f"{name}={value}" for name, value in sorted(snapshot["gauges"].items())]
+    items += [f"{name}={timer['calls']}x{timer['mean_us']:.1f}us" for name, timer in sorted(snapshot["timers"].items())]
+    return "sniffer stats: " + " ".join(items)
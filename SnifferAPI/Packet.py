@@ -34,8 +34,9 @@
 # LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT
 # OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
-import datetime
-from . import UART, Exceptions, Notifications
+import struct
+from . import UART, Exceptions, Notifications, TimingAnalyzer
+from .Trace import tracer, INFO, DEBUG, VERBOSE, CAT_PACKET, CAT_UART
 import time
 import logging
 import os, sys, serial
@@ -70,44 +71,115 @@ VALID_ADV_CHANS = [37, 38, 39]
 
 PACKET_COUNTER_CAP = 2**16
 
-test_log = open("test_packet_info.log", "w")
-test_tifs_log = open("test_tifs_log.log", "w")
-
-all_tifs = list()
-
-# PHY switching state
-PHY_SW_ST_INIT = 0
-PHY_SW_ST_REQ = 1
-PHY_SW_ST_UPDATE = 2
-PHY_SW_ST_CHANGING = 3
-PHY_SW_ST_DONE = 4
-
-# search "Check PHY switch" to locate the code
-phy_switch_state = PHY_SW_ST_INIT
-phy_switch_start = None
-phy_switch_end = None
-phy_switch_time = None
-
-# CONNECTION TIMING TEST STATE
-CONN_TIMING_ST_INIT = 0
-CONN_TIMING_ST_REQ = 1
-CONN_TIMING_ST_DONE = 2
-conn_timing_state = CONN_TIMING_ST_INIT
-conn_timing_start = None
-conn_timing_end = None
-conn_timing_time = None
+# Payload length (V2+), protocol version, packet counter and packet ID
+UART_HEADER = struct.Struct("<HBHB")
+PAYLOAD_LENGTH = struct.Struct("<H")
+# Flags, channel, RSSI, event counter and timestamp, following the BLE header length byte
+BLE_HEADER = struct.Struct("<BBBHL")
+
+SLIP_UNESCAPE = {
+    SLIP_ESC_START: SLIP_START,
+    SLIP_ESC_END: SLIP_END,
+    SLIP_ESC_ESC: SLIP_ESC,
+}
+
+
+class SlipDecoder:
+    """Decode a SLIP encoded byte stream into frames.
+
+    Data is fed in chunks as it is read from the UART. Frame boundaries are located with bytes.find() and
+    the frame content is unescaped in bulk, so the cost per frame does not depend on the number of bytes.
+    """
+    def __init__(self):
+        self.buffer = bytearray()
+        self.inFrame = False
+        # Framing errors: bytes received outside of a frame, and unknown escape codes
+        self.discardedBytes = 0
+        self.escapeErrors = 0
+
+    def feed(self, data):
+        """Add a chunk of received data and return the list of frames it completed."""
+        self.buffer += data
+        buf = self.buffer
+        frames = []
+        pos = 0
+        with memoryview(buf) as view:
+            while True:
+                if not self.inFrame:
+                    start = buf.find(SLIP_START, pos)
+                    if start < 0:
+                        self.discardedBytes += len(buf) - pos
+                        pos = len(buf)
+                        break
+                    self.discardedBytes += start - pos
+                    pos = start + 1
+                    self.inFrame = True
+
+                end = self.findEnd(buf, pos)
+                if end < 0:
+                    break
+                frames.append(self.unescape(view[pos:end]))
+                pos = end + 1
+                self.inFrame = False
+        del buf[:pos]
+        return frames
+
+    @staticmethod
+    def findEnd(buf, pos):
+        end = buf.find(SLIP_END, pos)
+        while end >= 0:
+            # A SLIP_END preceded by an odd number of SLIP_ESC is the escaped byte, not the end of the frame
+            escapes = 0
+            while end - escapes - 1 >= pos and buf[end - escapes - 1] == SLIP_ESC:
+                escapes += 1
+            if escapes % 2 == 0:
+                break
+            end = buf.find(SLIP_END, end + 1)
+        return end
+
+    def unescape(self, frame):
+        """Unescape the content of one frame (between SLIP_START and SLIP_END) and return it as bytes."""
+        data = bytes(frame)
+        if SLIP_ESC not in data:
+            return data
+
+        out = bytearray()
+        pos = 0
+        while True:
+            esc = data.find(SLIP_ESC, pos)
+            if esc < 0 or esc + 1 >= len(data):
+                out += data[pos:]
+                break
+            out += data[pos:esc]
+            # Unknown escape codes are decoded as SLIP_END, as the byte-wise decoder always did
+            byte = SLIP_UNESCAPE.get(data[esc + 1])
+            if byte is None:
+                self.escapeErrors += 1
+                byte = SLIP_END
+            out.append(byte)
+            pos = esc + 2
+        return bytes(out)
+
 
 class PacketReader(Notifications.Notifier):
-    def __init__(self, portnum=None, callbacks=[], baudrate=None, pcapng_parser=False):
+    # timing_analyzer is the TimingAnalyzer of the packets parsed with this reader, a new one is created if not given
+    def __init__(self, portnum=None, callbacks=[], baudrate=None, pcapng_parser=False, metrics=None,
+                 timing_analyzer=None):
         Notifications.Notifier.__init__(self, callbacks)
         self.is_parser = pcapng_parser
+        self.timingAnalyzer = timing_analyzer if timing_analyzer is not None else TimingAnalyzer.TimingAnalyzer()
         self.portnum = portnum
         self.last_ble_packet = None
         self.detected_connection = False
+        self.uart = None
+        self.metrics = metrics
+        # Packet counter gaps, and the number of packets missing in them
+        self.packetGaps = 0
+        self.packetsMissing = 0
 
         try:
             if self.portnum is not None and baudrate is not None:
-                self.uart = UART.Uart(portnum, baudrate)
+                self.uart = UART.Uart(portnum, baudrate, metrics=metrics)
         except serial.SerialException as e:
             logging.exception("Error opening UART %s" % str(e))
             self.uart = UART.Uart()
@@ -121,12 +193,9 @@ class PacketReader(Notifications.Notifier):
         pass
 
     def doExit(self, caller):
-        if test_log:
-            msg = f'{str(datetime.datetime.now())} - from {caller}, PacketReader, doExit()\n'
-            print(msg)
-            test_log.write(msg)
+        logging.info(f'from {caller}, PacketReader, doExit()')
 
-        if not self.is_parser:
+        if not self.is_parser and self.uart is not None:
             # This method will always join the Uart worker thread
             self.uart.close()
         # Clear method references to avoid uncollectable cyclic references
@@ -151,47 +220,22 @@ class PacketReader(Notifications.Notifier):
         tempSLIPBuffer.append(SLIP_END)
         return tempSLIPBuffer
 
-    # This function uses getSerialByte() function to get SLIP encoded bytes from the serial port and return a decoded byte list  
-    # Based on https://github.com/mehdix/pyslip/
-    def decodeFromSLIP(self, timeout=None, complete_timeout=None):
-        dataBuffer = []
-        startOfPacket = False
-        endOfPacket = False
-
-        if complete_timeout is not None:
-            time_start = time.time()
-
-        while not startOfPacket and (complete_timeout is None or (time.time() - time_start < complete_timeout)):
-            res = self.getSerialByte(timeout)
-            startOfPacket = (res == SLIP_START)
-
-        while not endOfPacket and (complete_timeout is None or (time.time() - time_start < complete_timeout)):
-            serialByte = self.getSerialByte(timeout)
-            if serialByte == SLIP_END:
-                endOfPacket = True
-            elif serialByte == SLIP_ESC:
-                serialByte = self.getSerialByte(timeout)
-                if serialByte == SLIP_ESC_START:
-                    dataBuffer.append(SLIP_START)
-                elif serialByte == SLIP_ESC_END:
-                    dataBuffer.append(SLIP_END)
-                elif serialByte == SLIP_ESC_ESC:
-                    dataBuffer.append(SLIP_ESC)
-                else:
-                    dataBuffer.append(SLIP_END)
-            else:
-                 dataBuffer.append(serialByte)
-        if not endOfPacket:
-            raise Exceptions.UARTPacketError("Exceeded max timeout of %f seconds." % complete_timeout)
-        return dataBuffer
-
-    # This function read byte chuncks from the serial port and return one byte at a time
-    # Based on https://github.com/mehdix/pyslip/
-    def getSerialByte(self, timeout=None):
-        serialByte = self.uart.readByte(timeout)
-        if serialByte is None:
+    # This function returns the next SLIP frame decoded by the UART worker thread as bytes.
+    def getFrame(self, timeout=None, complete_timeout=None):
+        if complete_timeout is not None and (timeout is None or complete_timeout < timeout):
+            frame = self.uart.readFrame(complete_timeout)
+            if frame is None:
+                raise Exceptions.UARTPacketError("Exceeded max timeout of %f seconds." % complete_timeout)
+            return frame
+
+        frame = self.uart.readFrame(timeout)
+        if frame is None:
             raise Exceptions.SnifferTimeout("Packet read timed out.")
-        return serialByte
+        return frame
+
+    # Compatibility wrapper around getFrame() which returns the decoded frame as a byte list.
+    def decodeFromSLIP(self, timeout=None, complete_timeout=None):
+        return list(self.getFrame(timeout, complete_timeout))
 
     def handlePacketHistory(self, packet):
         # Reads and validates packet counter
@@ -199,10 +243,13 @@ class PacketReader(Notifications.Notifier):
                 and packet.packetCounter != (self.lastReceivedPacket.packetCounter + 1) % PACKET_COUNTER_CAP \
                 and self.lastReceivedPacket.packetCounter != 0:
 
+            self.packetGaps += 1
+            self.packetsMissing += (packet.packetCounter - self.lastReceivedPacket.packetCounter - 1) \
+                % PACKET_COUNTER_CAP
             # TODO: find out where the gap comes from.
             logging.info("gap in packets, between " + str(self.lastReceivedPacket.packetCounter) + " and "
-                         + str(packet.packetCounter) + " packet before: " + str(self.lastReceivedPacket.packetList)
-                         + " packet after: " + str(packet.packetList))
+                         + str(packet.packetCounter) + " packet before: " + str(self.lastReceivedPacket.getList())
+                         + " packet after: " + str(packet.getList()))
 
         self.lastReceivedPacket = packet
         if packet.id in [EVENT_PACKET_DATA_PDU, EVENT_PACKET_ADV_PDU]:
@@ -217,7 +264,7 @@ class PacketReader(Notifications.Notifier):
             return 4 * (2 + ble_payload_length)
         elif packet.phy == PHY_CODED:
             # blePacket is not assigned if not packet is "OK" (CRC error)
-            ci = packet.packetList[BLEPACKET_POS + 4]
+            ci = packet.buffer[BLEPACKET_POS + 4]
             fec2_block_len = ble_payload_length - 4 - 1
             fec1_block_us = 80 + 256 + 16 + 24
             if ci == PHY_CODED_CI_S8:
@@ -228,33 +275,30 @@ class PacketReader(Notifications.Notifier):
         return 0
 
     def convertPacketListProtoVer2(self, packet):
+        packetList = bytearray(packet.buffer)
+
         # Convert to version 2
-        packet.packetList[PROTOVER_POS] = 2
+        packetList[PROTOVER_POS] = 2
 
         # Convert to common packet ID
-        if packet.packetList[ID_POS] == EVENT_PACKET_ADV_PDU:
-            packet.packetList[ID_POS] = EVENT_PACKET_DATA_PDU
+        if packetList[ID_POS] == EVENT_PACKET_ADV_PDU:
+            packetList[ID_POS] = EVENT_PACKET_DATA_PDU
 
-        if packet.packetList[ID_POS] != EVENT_PACKET_DATA_PDU:
-            # These types do not have a timestamp
-            return
+        if packetList[ID_POS] == EVENT_PACKET_DATA_PDU:
+            # Convert time-stamp to End to Start delta. Other types do not have a timestamp.
+            time_delta = 0
+            if self.lastReceivedTimestampPacket is not None and self.lastReceivedTimestampPacket.valid:
+                time_delta = (packet.timestamp -
+                              (self.lastReceivedTimestampPacket.timestamp +
+                               self.getPacketTime(self.lastReceivedTimestampPacket)))
 
-        # Convert time-stamp to End to Start delta
-        time_delta = 0
-        if self.lastReceivedTimestampPacket is not None and self.lastReceivedTimestampPacket.valid:
-            time_delta = (packet.timestamp -
-                          (self.lastReceivedTimestampPacket.timestamp +
-                           self.getPacketTime(self.lastReceivedTimestampPacket)))
+            packetList[TIMESTAMP_POS:TIMESTAMP_POS+4] = toLittleEndian(time_delta, 4)
 
-        time_delta = toLittleEndian(time_delta, 4)
-        packet.packetList[TIMESTAMP_POS  ] = time_delta[0]
-        packet.packetList[TIMESTAMP_POS+1] = time_delta[1]
-        packet.packetList[TIMESTAMP_POS+2] = time_delta[2]
-        packet.packetList[TIMESTAMP_POS+3] = time_delta[3]
+        packet.buffer = bytes(packetList)
 
 
     def handlePacketCompatibility(self, packet):
-        if self.supportedProtocolVersion == PROTOVER_V2 and packet.packetList[PROTOVER_POS] > PROTOVER_V2:
+        if self.supportedProtocolVersion == PROTOVER_V2 and packet.buffer[PROTOVER_POS] > PROTOVER_V2:
             self.convertPacketListProtoVer2(packet)
 
     def setSupportedProtocolVersion(self, supportedProtocolVersion):
@@ -263,29 +307,41 @@ class PacketReader(Notifications.Notifier):
         self.supportedProtocolVersion = supportedProtocolVersion
 
     def getPacket(self, timeout=None):
-        packetList = []
         try:
-            packetList = self.decodeFromSLIP(timeout)
+            frame = self.getFrame(timeout)
         except Exceptions.UARTPacketError:  # FIXME: This is never thrown...
             logging.exception("")
             return None
         else:
-            packet = Packet(packetList)
-            # TRACE: 122
+            metrics = self.metrics
+            timed = metrics is not None and metrics.enabled
+            if timed:
+                start = time.perf_counter()
+
+            packet = Packet(frame)
 
             if packet.valid:
                 self.handlePacketCompatibility(packet)
                 self.handlePacketHistory(packet)
-            else:
-                print(f'<4.2')
+            elif tracer.debug:
+                tracer.trace(DEBUG, CAT_PACKET, "122", "invalid packet: %s", frame.hex())
+
+            if timed:
+                metrics.addTime("packet.decode", time.perf_counter() - start)
+                if not packet.valid:
+                    metrics.count("packet.invalid")
+                elif packet.id == EVENT_PACKET_ADV_PDU or packet.id == EVENT_PACKET_DATA_PDU:
+                    metrics.count("packet.ble")
+                    if not packet.crcOK:
+                        metrics.count("packet.crc_errors")
             return packet
 
     def sendPacket(self, id, payload):
-        #print(f'\n<<< sendPacket to sniffer: {uart_proto_id_str[id]}\n')
         packetList = [HEADER_LENGTH] + [len(payload)] + [PROTOVER_V1] + \
                      toLittleEndian(self.packetCounter, 2) + [id] + payload
         packetList = self.encodeToSLIP(packetList)
-        print(f'!!sendPacket: {packetList}')
+        if tracer.debug:
+            tracer.trace(DEBUG, CAT_UART, "129", "sendPacket id %d: %s", id, packetList)
         self.packetCounter += 1
         self.uart.writeList(packetList)
 
@@ -296,11 +352,11 @@ class PacketReader(Notifications.Notifier):
 
     def sendFollow(self, addr, followOnlyAdvertisements = False, followOnlyLegacy = False, followCoded = False):
         flags0 = followOnlyAdvertisements | (followOnlyLegacy << 1) | (followCoded << 2)
-        print(f'addr: {addr} ' + "Follow flags: %s" % bin(flags0))
+        if tracer.info:
+            tracer.trace(INFO, CAT_UART, "129", "follow addr: %s flags: %s", addr, bin(flags0))
         self.sendPacket(REQ_FOLLOW, addr + [flags0])
 
     def sendPingReq(self):
-        print(f'sendPingReq()')
         self.sendPacket(PING_REQ, [])
 
     def getBytes(self, value, size):
@@ -342,11 +398,13 @@ class PacketReader(Notifications.Notifier):
         logging.info("Sent IRK to sniffer: " + str(irk))
 
     def sendSwitchBaudRate(self, newBaudRate):
-        print(f'!!sendSwitchBaudRate()')
+        if tracer.info:
+            tracer.trace(INFO, CAT_UART, "126", "switch baud rate request: %d", newBaudRate)
         self.sendPacket(SWITCH_BAUD_RATE_REQ, toLittleEndian(newBaudRate, 4))
 
     def switchBaudRate(self, newBaudRate):
-        print(f'!!sendBaudRate()')
+        if tracer.info:
+            tracer.trace(INFO, CAT_UART, "126", "switch baud rate: %d", newBaudRate)
         self.uart.switchBaudRate(newBaudRate)
 
     def sendHopSequence(self, hopSequence):
@@ -354,27 +412,34 @@ class PacketReader(Notifications.Notifier):
             if chan not in VALID_ADV_CHANS:
                 raise Exceptions.InvalidAdvChannel("%s is not an adv channel" % str(chan))
         payload = [len(hopSequence)] + hopSequence + [37]*(3-len(hopSequence))
-        print(f'!!sendHopSequence()')
         self.sendPacket(SET_ADV_CHANNEL_HOP_SEQ, payload)
         self.notify("NEW_ADV_HOP_SEQ", {"hopSequence":hopSequence})
 
     def sendVersionReq(self):
-        print(f'!!sendVersion()')
         self.sendPacket(REQ_VERSION, [])
 
     def sendTimestampReq(self):
-        (f'!!sendTimestampReq')
         self.sendPacket(REQ_TIMESTAMP, [])
 
     def sendGoIdle(self):
-        print(f'!!sendGoIdle')
         self.sendPacket(GO_IDLE, [])
 
 
 class Packet:
+    # The packet is backed by a single bytes buffer holding the UART packet (header and payload). Header fields
+    # are decoded with precompiled structs, and the payload and BLE packet are memoryviews into the buffer.
+    # Up to 100000 packets are kept by SnifferCollector, so the attributes are slots rather than a __dict__.
+    __slots__ = ("buffer", "end_to_start", "packet_reader", "eventCounter", "RSSI", "rawRSSI", "channel", "flags",
+                 "version", "blePacket", "bleHeaderLength", "is_parser", "last_ble_packet", "packet_time_from_pcap",
+                 "protover", "packetCounter", "id", "payloadLength", "OK", "valid", "timestamp", "baudRate",
+                 "crcOK", "direction", "encrypted", "micOK", "phy",
+                 # Set by SnifferCollector
+                 "boardId", "time")
+
     def __init__(self, packetList, is_parser=False, packet_reader=None, file_type=0, packet_time_from_pcap=None):
         # By default, Packet is used for Sniffer packet generation. This code can be
         # re-used for pcapng file parsing.
+        self.buffer = None
         self.end_to_start = 0  # T_IFS
         self.packet_reader = packet_reader
 
@@ -384,7 +449,6 @@ class Packet:
         self.channel = None
         self.flags = None
         self.version = None
-        self.payload = None
         self.blePacket = None
         self.bleHeaderLength = None
         self.is_parser = is_parser
@@ -395,22 +459,19 @@ class Packet:
             if not packetList:
                 raise Exceptions.InvalidPacketException("packet list not valid: %s" % str(packetList))
 
-            self.protover = packetList[PROTOVER_POS]
+            if isinstance(packetList, list):
+                packetList = bytes(packetList)
+
+            self.payloadLength, self.protover, self.packetCounter, self.id = UART_HEADER.unpack_from(packetList)
 
             if self.protover > PROTOVER_V3:
-                print(f'>V3')
                 logging.exception("Unsupported protocol version %s" % str(self.protover))
                 raise RuntimeError("Unsupported protocol version %s" % str(self.protover))
 
-            self.packetCounter = parseLittleEndian(packetList[PACKETCOUNTER_POS:PACKETCOUNTER_POS + 2])
-            self.id = packetList[ID_POS]
-
-            if int(self.protover) == PROTOVER_V1:
+            if self.protover == PROTOVER_V1:
                 self.payloadLength = packetList[PAYLOAD_LEN_POS_V1]
-            else:
-                self.payloadLength = parseLittleEndian(packetList[PAYLOAD_LEN_POS:PAYLOAD_LEN_POS + 2])
 
-            self.packetList = packetList
+            self.buffer = packetList
             self.readPayload(packetList, file_type)
 
         except Exceptions.InvalidPacketException as e:
@@ -426,7 +487,7 @@ class Packet:
     def __repr__(self):
         msg = "\nUART packet, type: "+str(self.id)+", packetCounter: "+str(self.packetCounter)+"\n"
         if self.payload is not None:
-            msg += f"payload: {self.payload}\n"
+            msg += f"payload: {list(self.payload)}\n"
         
         if self.blePacket is not None:
             msg += f"blePacket: {self.blePacket}"
@@ -435,16 +496,18 @@ class Packet:
         
         return msg
 
-    def readPayload(self, packetList, file_type):
-        global test_log
-        global test_tifs_log
-        global phy_switch_state
-        global phy_switch_start
-        global phy_switch_end
-        global phy_switch_time
-        global conn_timing_state
-        global conn_timing_time
+    @property
+    def payload(self):
+        if self.buffer is None:
+            return None
+        return memoryview(self.buffer)[PAYLOAD_POS:PAYLOAD_POS+self.payloadLength]
+
+    # The packet as a byte list, as it was stored before packets were backed by a buffer.
+    @property
+    def packetList(self):
+        return self.getList()
 
+    def readPayload(self, packetList, file_type):
         self.blePacket = None
         self.OK = False
 
@@ -453,67 +516,38 @@ class Packet:
         else:
             self.valid = True
 
-        self.payload = packetList[PAYLOAD_POS:PAYLOAD_POS+self.payloadLength]
-
         if self.id == EVENT_PACKET_ADV_PDU or self.id == EVENT_PACKET_DATA_PDU:
             try:
                 self.bleHeaderLength = packetList[BLE_HEADER_LEN_POS]
                 if self.bleHeaderLength == BLE_HEADER_LENGTH:
-                    self.flags = packetList[FLAGS_POS]
+                    (self.flags, self.channel, self.rawRSSI,
+                     self.eventCounter, self.timestamp) = BLE_HEADER.unpack_from(packetList, FLAGS_POS)
                     self.readFlags()
-                    self.channel = packetList[CHANNEL_POS]
-                    self.rawRSSI = packetList[RSSI_POS]
                     self.RSSI = -self.rawRSSI
-                    self.eventCounter = parseLittleEndian(packetList[EVENTCOUNTER_POS:EVENTCOUNTER_POS+2])
-
-                    self.timestamp = parseLittleEndian(packetList[TIMESTAMP_POS:TIMESTAMP_POS+4])
-                    if self.is_parser:
-                        if test_log:
-                            test_log.write(f'Packet counter: {self.packetCounter}\n')
-                            test_log.write(f'Timestamp: {self.timestamp} us\n')
-
-                    if self.is_parser:
-                        if self.packet_reader:
-                            if file_type == 1:
-                                self.end_to_start = self.timestamp
-                                if test_log:
-                                    test_log.write(f'[Delta time (end to start): {self.end_to_start} us\n')
-                            else:
-                                if self.packet_reader.lastReceivedTimestampPacket:
-                                    last_packet_timestamp = self.packet_reader.lastReceivedTimestampPacket.timestamp
-                                    start_to_start = self.timestamp - last_packet_timestamp
-
-                                    last_packet_time = self.packet_reader.getPacketTime(self)
-                                    self.end_to_start = start_to_start - last_packet_time
-                                    if test_log:
-                                        test_log.write(f'[Packet time (start to end): {last_packet_time} us\n')
-                                        test_log.write(f'[Delta time (end to start): {self.end_to_start} us\n')
-                                        test_log.write(f'[Delta time (start to start): {start_to_start} us\n')
-                        else:
-                            if test_log:
-                                test_log.write(f'packet_reader is None.\n')
-
-                        if test_log:
-                            test_log.write(f'\n')
+                    if self.is_parser and self.packet_reader:
+                        end_to_start = self.packet_reader.timingAnalyzer.packetTiming(self, self.packet_reader,
+                                                                                      file_type)
+                        if end_to_start is not None:
+                            self.end_to_start = end_to_start
                     #
                     # For the pcapng parser, no need to modify the data.
                     #
                     if not self.is_parser:
                         # The hardware adds a padding byte which isn't sent on air.
-                        # We remove it, and update the payload length in the packet list.
+                        # We remove it, and update the payload length in the buffer, with a single copy.
                         if self.phy == PHY_CODED:
-                            self.packetList.pop(BLEPACKET_POS+6+1)
+                            padding = BLEPACKET_POS+6+1
                         else:
-                            self.packetList.pop(BLEPACKET_POS+6)
+                            padding = BLEPACKET_POS+6
                         self.payloadLength -= 1
 
                         if self.protover >= PROTOVER_V2:
-                            # Write updated payload length back to the packet list.
-                            payloadLength = toLittleEndian(self.payloadLength, 2)
-                            packetList[PAYLOAD_LEN_POS  ] = payloadLength[0]
-                            packetList[PAYLOAD_LEN_POS+1] = payloadLength[1]
+                            header = PAYLOAD_LENGTH.pack(self.payloadLength)
                         else:  # PROTOVER_V1
-                            packetList[PAYLOAD_LEN_POS_V1] = self.payloadLength
+                            header = bytes([packetList[0], self.payloadLength])
+                        view = memoryview(packetList)
+                        packetList = b''.join((header, view[PROTOVER_POS:padding], view[padding+1:]))
+                        self.buffer = packetList
                 else:
                     logging.info("Invalid BLE Header Length " + str(packetList))
                     self.valid = False
@@ -529,85 +563,14 @@ class Packet:
                             packet_type = (PACKET_TYPE_ADVERTISING
                                            if address == ADV_ACCESS_ADDRESS else
                                            PACKET_TYPE_DATA)
-                        if self.is_parser:
-                            types = ['PACKET_TYPE_UNKNOWN', 'PACKET_TYPE_ADVERTISING', 'PACKET_TYPE_DATA']
-                            # print(f'\tpacket_type: {types[packet_type]}')
-
                         # Parse BLE packet
-                        self.blePacket = BlePacket(packet_type, packetList[BLEPACKET_POS:], self.phy,
-                                                   pcapng_parser=self.is_parser)
-
-                        if self.is_parser:
-                            if self.blePacket.advType == PDU_TYPE_CONNECT_IND and \
-                                    self.packet_reader.last_ble_packet is not None:  # Avoid the 1st packet is CONNECT_IND
-                                self.packet_reader.detected_connection = True
-                            elif packet_type != PACKET_TYPE_DATA:
-                                self.packet_reader.detected_connection = False
-                                if conn_timing_state == CONN_TIMING_ST_DONE:
-                                    conn_timing_state = CONN_TIMING_ST_INIT
-
-                        #
-                        # check connection timing
-                        #
-                        if self.packet_reader is not None:
-                            if self.packet_reader.detected_connection and conn_timing_state == CONN_TIMING_ST_INIT:
-                                conn_timing_state = CONN_TIMING_ST_REQ
-                                msg = f'CONNECT_REQ: packet cnt: {self.packetCounter}'
-                                print(f'{msg}')
-                            elif conn_timing_state == CONN_TIMING_ST_REQ and packet_type == PACKET_TYPE_DATA:
-                                conn_timing_state = CONN_TIMING_ST_DONE
-                                conn_timing_time = self.end_to_start
-                                msg = f'CONNECTION DONE: packet cnt: {self.packetCounter}, time: {conn_timing_time}'
-                                print(f'{msg}\n')
-
-                        #
-                        # Check PHY switch
-                        #
-                        if self.is_parser:
-                            if packet_type == PACKET_TYPE_DATA and self.blePacket.llid == 3:
-                                if len(self.blePacket.payload) == 6:  # Control Opcode, TX PHYs, RX PHYs, CRC
-                                    if self.blePacket.payload[0] == 0x16:  # LL_PHY_REQ
-                                        phy_switch_state = PHY_SW_ST_REQ
-                                        phy_switch_start = self.packet_time_from_pcap
-                                        payload = self.blePacket.payload.hex()
-                                        msg = f'LL_PHY_REQ:\n\tpacket cnt: {self.packetCounter}'                \
-                                              f'\n\tself.packet_time_from_pcap: {self.packet_time_from_pcap}'
-                                        print(msg)
-                                        test_log.write(f'{msg}\n')
-
-                            if phy_switch_state == PHY_SW_ST_REQ:
-                                if self.phy != PHY_1M:
-                                    phy_switch_state = PHY_SW_ST_DONE
-                                    phy_switch_end = self.packet_time_from_pcap
-                                    phy_switch_time = phy_switch_end - phy_switch_start
-                                    msg = f'new PHY applied:\n'                                             \
-                                          f'\tself.phy: {self.phy}\n'                                       \
-                                          f'\tself.packet_time_from_pcap: {self.packet_time_from_pcap}\n'   \
-                                          f'\tPHY switch time: {phy_switch_time*1E3:.3f} ms'
-                                    print(f'{msg}\n')
-
-                        #
-                        # Check T_IFS
-                        #
-                        if self.packet_reader is not None                               \
-                                and self.packet_reader.last_ble_packet is not None      \
-                                and self.blePacket is not None                          \
-                                and phy_switch_state == PHY_SW_ST_INIT:
-                            # With advertising packet and data packet
-                            if packet_type == PACKET_TYPE_DATA and self.packet_reader.detected_connection:
-                                if not self.direction:      # False: slave to master
-                                    test_tifs_log.write(f'Packet cnt: {self.packetCounter}\n')
-                                    test_tifs_log.write(f'{self.end_to_start}\n\n')
-
-                                    all_tifs.append(self.end_to_start)
-
-                                    if self.end_to_start < 149 or self.end_to_start > 151:
-                                        msg = f'T_IFS FAIL! Packet counter: {self.packetCounter}, '\
-                                              f'{self.end_to_start}, {self.packet_time_from_pcap}'
-                                        print(f'{msg}')
-
-                        if self.packet_reader is not None:
-                            self.packet_reader.last_ble_packet = self.blePacket
+                        self.blePacket = BlePacket(packet_type, packetList, self.phy,
+                                                   pcapng_parser=self.is_parser, offset=BLEPACKET_POS)
+
+                        if self.is_parser and self.packet_reader is not None:
+                            self.packet_reader.timingAnalyzer.analyzePacket(self, packet_type, self.packet_reader,
+                                                                            self.packet_time_from_pcap,
+                                                                            self.end_to_start)
 
                     except Exception as e:
                         logging.exception("blePacket error %s" % str(e))
@@ -620,13 +583,13 @@ class Packet:
                 self.OK = False
         elif self.id == PING_RESP:
             if self.protover < PROTOVER_V3:
-                self.version = parseLittleEndian(packetList[PAYLOAD_POS:PAYLOAD_POS+2])
+                self.version = int.from_bytes(packetList[PAYLOAD_POS:PAYLOAD_POS+2], "little")
         elif self.id == RESP_VERSION:
-            self.version = ''.join([chr(i) for i in packetList[PAYLOAD_POS:]])
+            self.version = bytes(packetList[PAYLOAD_POS:]).decode("latin-1")
         elif self.id == RESP_TIMESTAMP:
-            self.timestamp = parseLittleEndian(packetList[PAYLOAD_POS:PAYLOAD_POS+4])
+            self.timestamp = int.from_bytes(packetList[PAYLOAD_POS:PAYLOAD_POS+4], "little")
         elif self.id == SWITCH_BAUD_RATE_RESP or self.id == SWITCH_BAUD_RATE_REQ:
-            self.baudRate = parseLittleEndian(packetList[PAYLOAD_POS:PAYLOAD_POS+4])
+            self.baudRate = int.from_bytes(packetList[PAYLOAD_POS:PAYLOAD_POS+4], "little")
         else:
             logging.info("Unknown packet ID")
 
@@ -641,8 +604,13 @@ class Packet:
         self.phy = (self.flags >> 4) & 7
         self.OK = self.crcOK and (self.micOK or not self.encrypted)
 
+    # Materialise the packet as a byte list. Prefer getBytes() which does not copy.
     def getList(self):
-        return self.packetList
+        return list(self.buffer)
+
+    # The packet in the Nordic BLE format, without the padding byte added by the sniffer hardware.
+    def getBytes(self):
+        return self.buffer
 
     def validatePacketList(self, packetList):
         try:
@@ -656,21 +624,25 @@ class Packet:
 
 
 class BlePacket:
-    def __init__(self, type, packetList, phy, pcapng_parser=False):
+    __slots__ = ("buffer", "rxAddrType", "txAddrType", "advType", "is_parser", "type", "accessAddress", "coded",
+                 "codingIndicator", "llid", "sn", "nesn", "md", "length", "payloadPos",
+                 # Decoded on first access, see decodeAdvData()
+                 "advDataDecoded", "_advAddress", "_scanAddress", "_adStructures", "_name")
+
+    # The BLE packet is read from packetList, the buffer of the UART packet, starting at offset (the access
+    # address). Only the reference to the buffer is kept, the payload is a memoryview created on access.
+    # The header fields are decoded here. The addresses, AD structures and name of advertising packets are
+    # decoded on first access, as most packets are only written to the capture file.
+    def __init__(self, type, packetList, phy, pcapng_parser=False, offset=0):
+        self.buffer = packetList
         self.rxAddrType = None
         self.txAddrType = None
         self.advType = None
         self.is_parser = pcapng_parser
         self.type = type
+        self.advDataDecoded = False
 
-        offset = 0
         offset = self.extractAccessAddress(packetList, offset)
-        if self.is_parser:
-            data = bytearray(self.accessAddress)
-            data.reverse()
-            msg = ''.join(format(x, '02x') for x in data)
-            #print(f'\tAccess Address: 0x{msg}')
-
         offset = self.extractFormat(packetList, phy, offset)
 
         if self.type == PACKET_TYPE_ADVERTISING:
@@ -678,44 +650,61 @@ class BlePacket:
         else:
             offset = self.extractConnHeader(packetList, offset)
 
-        if self.is_parser and self.advType is not None:
-            if self.advType < len(PDU_Types):
-                # print(f'\tPDU Type: {self.advType}, {PDU_Types[self.advType]}')
-                pass
-            else:
-                # print(f'\tPDU Type: {self.advType}, UNKNOWN')
-                pass
-
-        if self.is_parser and self.rxAddrType is not None:
-            pass
-            #print(f'\trxAddrType: {self.rxAddrType}')
-
-        if self.is_parser and self.txAddrType is not None:
-            pass
-            #print(f'\ttxAddrType: {self.txAddrType}')
-
         offset = self.extractLength(packetList, offset)
-        self.payload = packetList[offset:]
-
-        if self.type == PACKET_TYPE_ADVERTISING:
-            offset = self.extractAddresses(packetList, offset)
-            if self.is_parser:
-                data = bytearray(self.advAddress)
-                data.reverse()
-                msg = ':'.join(format(x, '02x') for x in data)
-                # print(f'\tAdvertising Address: {msg}')
-                # msg = ' '.join(format(x, '02x') for x in self.scanAddress)
-                # print(f'Scan Address: {self.scanAddress}')
-
-            self.extractName(packetList, offset)
+        self.payloadPos = offset
 
     def __repr__(self):
-        return "BLE packet, AAddr: "+str(self.accessAddress)
+        return "BLE packet, AAddr: "+str(list(self.accessAddress))
+
+    @property
+    def payload(self):
+        return memoryview(self.buffer)[self.payloadPos:]
+
+    @property
+    def advAddress(self):
+        self.decodeAdvData()
+        return self._advAddress
+
+    @property
+    def scanAddress(self):
+        self.decodeAdvData()
+        return self._scanAddress
+
+    # List of (AD type, data) tuples of an advertising packet, the data is a memoryview
+    @property
+    def adStructures(self):
+        self.decodeAdvData()
+        return self._adStructures
+
+    @property
+    def name(self):
+        self.decodeAdvData()
+        return self._name
+
+    # Decode the addresses, AD structures and name of an advertising packet. The result is cached in the packet.
+    # These attributes do not exist for data packets.
+    def decodeAdvData(self):
+        if self.advDataDecoded or self.type != PACKET_TYPE_ADVERTISING:
+            return
+        self.advDataDecoded = True
+        offset = self.extractAddresses(self.buffer, self.payloadPos)
+        self.extractName(self.buffer, offset)
 
     def extractAccessAddress(self, packetList, offset):
-        self.accessAddress = packetList[offset:offset+4]
+        self.accessAddress = bytes(packetList[offset:offset+4])
         return offset + 4
 
+    # Read a 6 byte device address. The live capture stores it as a byte list in display order
+    # followed by the address type, the parser keeps the bytes as they are on air.
+    def readAddress(self, packetList, offset, addrType, reverse=False):
+        addr = packetList[offset:offset+6]
+        if self.is_parser and not reverse:
+            return bytes(addr)
+        addr = list(addr)
+        addr.reverse()
+        addr.append(addrType)
+        return addr
+
     def extractFormat(self, packetList, phy, offset):
         self.coded = phy == PHY_CODED
         if self.coded:
@@ -743,37 +732,17 @@ class BlePacket:
         scanAddr = None
 
         if self.advType in [0, 1, 2, 4, 6]:
-            addr = packetList[offset:offset+6]
-            if self.is_parser:
-                pass
-            else:
-                addr.reverse()
-                addr += [self.txAddrType]
+            addr = self.readAddress(packetList, offset, self.txAddrType)
             offset += 6
 
         if self.advType in [3, 5]:
-            scanAddr = packetList[offset:offset+6]
-            if self.is_parser:
-                pass
-            else:
-                scanAddr.reverse()
-                scanAddr += [self.txAddrType]
+            scanAddr = self.readAddress(packetList, offset, self.txAddrType)
             offset += 6
-            addr = packetList[offset:offset+6]
-            if self.is_parser:
-                pass
-            else:
-                addr.reverse()
-                addr += [self.rxAddrType]
+            addr = self.readAddress(packetList, offset, self.rxAddrType)
             offset += 6
 
         if self.advType == 1:
-            scanAddr = packetList[offset:offset+6]
-            if self.is_parser:
-                pass
-            else:
-                scanAddr.reverse()
-                scanAddr += [self.rxAddrType]
+            scanAddr = self.readAddress(packetList, offset, self.rxAddrType)
             offset += 6
 
         if self.advType == 7:
@@ -785,43 +754,45 @@ class BlePacket:
             ext_header_offset += 1
 
             if flags & 0x01:
-                addr = packetList[ext_header_offset:ext_header_offset+6]
-                addr.reverse()
-                addr += [self.txAddrType]
+                addr = self.readAddress(packetList, ext_header_offset, self.txAddrType, reverse=True)
                 ext_header_offset += 6
 
             if flags & 0x02:
-                scanAddr = packetList[ext_header_offset:ext_header_offset+6]
-                scanAddr.reverse()
-                scanAddr += [self.rxAddrType]
+                scanAddr = self.readAddress(packetList, ext_header_offset, self.rxAddrType, reverse=True)
                 ext_header_offset += 6
 
             offset += ext_header_len
 
-        self.advAddress = addr
-        self.scanAddress = scanAddr
+        self._advAddress = addr
+        self._scanAddress = scanAddr
         return offset
 
-    def extractName(self, packetList, offset):
-        name = ""
+    def extractAdStructures(self, packetList, offset):
+        adStructures = []
         if self.advType in [0, 2, 4, 6, 7]:
+            view = memoryview(packetList)
             i = offset
             while i < len(packetList):
                 length = packetList[i]
                 if (i+length+1) > len(packetList) or length == 0:
                     break
-                type = packetList[i+1]
-                if type == 8 or type == 9:
-                    nameList = packetList[i+2:i+length+1]
-                    name = ""
-                    for j in nameList:
-                        name += chr(j)
+                adStructures.append((packetList[i+1], view[i+2:i+length+1]))
                 i += (length+1)
+        self._adStructures = adStructures
+
+    def extractName(self, packetList, offset):
+        self.extractAdStructures(packetList, offset)
+
+        name = ""
+        if self.advType in [0, 2, 4, 6, 7]:
+            for type, data in self._adStructures:
+                if type == 8 or type == 9:
+                    name = bytes(data).decode("latin-1")
             name = '"'+name+'"'
         elif (self.advType == 1):
             name = "[ADV_DIRECT_IND]"
 
-        self.name = name
+        self._name = name
 
     def extractLength(self, packetList, offset):
         self.length = packetList[offset]
@@ -0,0 +1,100 @@
+# Copyright (c) Nordic Semiconductor ASA
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form, except as embedded into a Nordic
+#    Semiconductor ASA integrated circuit in a product or a software update for
+#    such product, must reproduce the above copyright notice, this list of
+#    conditions and the following disclaimer in the documentation and/or other
+#    materials provided with the distribution.
+#
+# 3. Neither the name of Nordic Semiconductor ASA nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#    software without specific prior written permission.
+#
+# 4. This software, with or without modification, must only be used with a
+#    Nordic Semiconductor ASA integrated circuit.
+#
+# 5. Any software provided in binary form under this license must not be reverse
+#    engineered, decompiled, modified and/or disassembled.
+#
+# THIS SOFTWARE IS PROVIDED BY NORDIC SEMICONDUCTOR ASA "AS IS" AND ANY EXPRESS
+# OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES
+# OF MERCHANTABILITY, NONINFRINGEMENT, AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL NORDIC SEMICONDUCTOR ASA OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE
+# GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT
+# OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import logging
+
+
+DEFAULT_PACKET_BUFFER_SIZE = 100000
+
+
+class PacketBuffer:
+    """Fixed capacity ring buffer holding the most recent packets.
+
+    Appending never copies the stored packets; once the buffer is full the oldest packet is overwritten.
+    The sequence number of the latest packet with each packet counter value is indexed, so a packet can be
+    found by its packet counter without scanning the buffer. Callers are responsible for the locking.
+    """
+    def __init__(self, capacity=DEFAULT_PACKET_BUFFER_SIZE):
+        if capacity <= 0:
+            raise ValueError("Invalid packet buffer size: " + str(capacity))
+        self.capacity = capacity
+        self._slots = [None] * capacity
+        # Sequence numbers of the oldest packet and of the next packet to append
+        self._first = 0
+        self._next = 0
+        # Packet counter -> sequence number of the latest packet with that counter
+        self._packetCounterIndex = {}
+        self.overwritten = 0
+
+    def __len__(self):
+        return self._next - self._first
+
+    def append(self, packet):
+        if len(self) == self.capacity:
+            self._popOldest()
+            self.overwritten += 1
+            if self.overwritten == 1:
+                logging.info("packet buffer full (%d packets), overwriting the oldest packets" % self.capacity)
+
+        self._slots[self._next % self.capacity] = packet
+        self._packetCounterIndex[packet.packetCounter] = self._next
+        self._next += 1
+
+    def findByPacketCounter(self, packetCounter):
+        sequence = self._packetCounterIndex.get(packetCounter)
+        if sequence is None:
+            return None
+        return self._slots[sequence % self.capacity]
+
+    # Remove and return the [number] oldest packets (-1 means all), oldest first.
+    def take(self, number=-1):
+        if number < 0 or number > len(self):
+            number = len(self)
+        return [self._popOldest() for _ in range(number)]
+
+    def clear(self):
+        self._slots = [None] * self.capacity
+        self._first = self._next
+        self._packetCounterIndex.clear()
+
+    def _popOldest(self):
+        slot = self._first % self.capacity
+        packet = self._slots[slot]
+        self._slots[slot] = None
+        if self._packetCounterIndex.get(packet.packetCounter) == self._first:
+            del self._packetCounterIndex[packet.packetCounter]
+        self._first += 1
+        return packet
@@ -73,8 +73,84 @@ def create_packet(packet: bytes, timestamp_seconds: float):
     timestamp_floor = int(timestamp_seconds)
     timestamp_offset_us = int((timestamp_seconds - timestamp_floor) * 1_000_000)
 
-    return struct.pack("<LLLL",
-                       timestamp_floor,
-                       timestamp_offset_us,
-                       len(packet),
-                       len(packet)) + packet
+    return PACKET_HEADER.pack(timestamp_floor,
+                              timestamp_offset_us,
+                              len(packet),
+                              len(packet)) + packet
+
+
+class PacketEncoder:
+    """Encode PCAP packets into one reusable buffer.
+
+    The records are encoded in place, the header with PACKET_HEADER.pack_into() and the packet copied from its
+    buffer, so that many packets are written to the file with a single write() and no intermediate bytes objects.
+    The buffer grows to the largest batch and is reused after write_to().
+
+    Args:
+        size (int): initial size of the buffer in bytes.
+    """
+
+    def __init__(self, size=4096):
+        self.buffer = bytearray(size)
+        self.length = 0
+        self.packets = 0
+
+    def __len__(self):
+        return self.length
+
+    def _reserve(self, size):
+        end = self.length + size
+        if end > len(self.buffer):
+            self.buffer.extend(bytes(max(end - len(self.buffer), len(self.buffer))))
+        return end
+
+    def add(self, packet, timestamp_seconds: float, board_id=None):
+        """Add a PCAP packet.
+
+        Args:
+            packet: Packet in the Nordic BLE packet format, any bytes-like object.
+            timestamp_seconds (float): a relative timestamp in seconds.
+            board_id (int): the board ID written before the packet, None if the packet starts with it.
+        """
+        length = len(packet) if board_id is None else len(packet) + 1
+        offset = self.length
+        end = self._reserve(PACKET_HEADER.size + length)
+
+        timestamp_floor = int(timestamp_seconds)
+        timestamp_offset_us = int((timestamp_seconds - timestamp_floor) * 1_000_000)
+        PACKET_HEADER.pack_into(self.buffer, offset, timestamp_floor, timestamp_offset_us, length, length)
+        offset += PACKET_HEADER.size
+
+        if board_id is not None:
+            self.buffer[offset] = board_id
+            offset += 1
+        self.buffer[offset:end] = packet
+        self.length = end
+        self.packets += 1
+
+    def add_packet(self, packet):
+        """Add a sniffer Packet, with its board ID and time."""
+        self.add(packet.getBytes(), packet.time, packet.boardId)
+
+    def add_packets(self, packets):
+        """Add sniffer Packets."""
+        for packet in packets:
+            self.add(packet.getBytes(), packet.time, packet.boardId)
+
+    def getvalue(self):
+        """Get a copy of the encoded packets."""
+        return bytes(self.buffer[:self.length])
+
+    def write_to(self, file):
+        """Write the encoded packets to file with a single write, and clear the buffer."""
+        try:
+            if self.length:
+                with memoryview(self.buffer) as view, view[:self.length] as data:
+                    file.write(data)
+        finally:
+            self.clear()
+
+    def clear(self):
+        """Clear the encoded packets, keeping the buffer."""
+        self.length = 0
+        self.packets = 0
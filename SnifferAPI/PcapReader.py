@@ -0,0 +1,344 @@
+# Copyright (c) Nordic Semiconductor ASA
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form, except as embedded into a Nordic
+#    Semiconductor ASA integrated circuit in a product or a software update for
+#    such product, must reproduce the above copyright notice, this list of
+#    conditions and the following disclaimer in the documentation and/or other
+#    materials provided with the distribution.
+#
+# 3. Neither the name of Nordic Semiconductor ASA nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#    software without specific prior written permission.
+#
+# 4. This software, with or without modification, must only be used with a
+#    Nordic Semiconductor ASA integrated circuit.
+#
+# 5. Any software provided in binary form under this license must not be reverse
+#    engineered, decompiled, modified and/or disassembled.
+#
+# THIS SOFTWARE IS PROVIDED BY NORDIC SEMICONDUCTOR ASA "AS IS" AND ANY EXPRESS
+# OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES
+# OF MERCHANTABILITY, NONINFRINGEMENT, AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL NORDIC SEMICONDUCTOR ASA OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE
+# GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT
+# OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import mmap
+import os
+import struct
+
+from . import Exceptions
+
+
+# See:
+# - https://github.com/pcapng/pcapng
+# - https://www.tcpdump.org/manpages/pcap-savefile.5.html
+PCAP_MAGIC = 0xa1b2c3d4
+PCAP_MAGIC_NS = 0xa1b23c4d
+PCAP_GLOBAL_HEADER_LENGTH = 24
+PCAP_PACKET_HEADER_LENGTH = 16
+
+PCAPNG_SECTION_HEADER_BLOCK = 0x0a0d0d0a
+PCAPNG_INTERFACE_DESCRIPTION_BLOCK = 1
+PCAPNG_ENHANCED_PACKET_BLOCK = 6
+PCAPNG_BYTE_ORDER_MAGIC = 0x1a2b3c4d
+PCAPNG_OPTION_END = 0
+PCAPNG_OPTION_IF_TSRESOL = 9
+
+DEFAULT_TIMESTAMP_RESOLUTION = 1e-6
+
+
+def unpack_timestamp_resolution(value):
+    """Get the timestamp resolution in seconds from the if_tsresol option value."""
+    base = 2 if value & 0x80 else 10
+    return base ** -(value & 0x7f)
+
+
+def unpack_pcapng_resolution(buffer, byte_order, offset, end):
+    """Get the timestamp resolution in seconds from the options between offset and end of an interface block."""
+    option = struct.Struct(byte_order + "HH")
+    while offset + 4 <= end:
+        code, length = option.unpack_from(buffer, offset)
+        if code == PCAPNG_OPTION_END:
+            break
+        if code == PCAPNG_OPTION_IF_TSRESOL and length == 1:
+            return unpack_timestamp_resolution(buffer[offset + 4])
+        offset += 4 + (length + 3) // 4 * 4
+    return DEFAULT_TIMESTAMP_RESOLUTION
+
+
+def unpack_pcap_header(buffer):
+    """Get the record header struct, ticks per second and resolution from the pcap global header."""
+    magic, = struct.unpack_from("<L", buffer, 0)
+    byte_order = "<" if magic in (PCAP_MAGIC, PCAP_MAGIC_NS) else ">"
+    magic, = struct.unpack_from(byte_order + "L", buffer, 0)
+    # Integer arithmetic first, so the timestamps are the same as in a pcapng file with the same resolution
+    if magic == PCAP_MAGIC_NS:
+        return struct.Struct(byte_order + "LLLL"), 1_000_000_000, 1e-9
+    if magic == PCAP_MAGIC:
+        return struct.Struct(byte_order + "LLLL"), 1_000_000, DEFAULT_TIMESTAMP_RESOLUTION
+    raise Exceptions.InvalidCaptureFile("not a pcap file")
+
+
+class CaptureFileReader:
+    """Read the packet records of a pcap or pcapng capture file.
+
+    The file is memory mapped and the records are returned as memoryview slices of the mapping, so no packet data is
+    copied. The slices are only valid until the reader is closed.
+
+    Example:
+        with CaptureFileReader("capture.pcap") as reader:
+            for timestamp, packet in reader:
+                ...
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, "rb") as f:
+            try:
+                self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:  # An empty file can not be mapped
+                raise Exceptions.InvalidCaptureFile("empty capture file: %s" % filename)
+        self.buffer = memoryview(self._map)
+
+        if len(self.buffer) < 4:
+            self.close()
+            raise Exceptions.InvalidCaptureFile("capture file too short: %s" % filename)
+
+        magic = struct.unpack_from("<L", self.buffer)[0], struct.unpack_from(">L", self.buffer)[0]
+        if magic[0] == PCAPNG_SECTION_HEADER_BLOCK:
+            self.pcapng = True
+        elif PCAP_MAGIC in magic or PCAP_MAGIC_NS in magic:
+            self.pcapng = False
+        else:
+            self.close()
+            raise Exceptions.InvalidCaptureFile("not a pcap or pcapng file: %s" % filename)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __iter__(self):
+        buffer = self.buffer
+        for timestamp, offset, length in self.records():
+            yield timestamp, buffer[offset:offset+length]
+
+    def close(self):
+        if self._map is None:
+            return
+        try:
+            self.buffer.release()
+            self._map.close()
+        except BufferError:
+            # Record slices are still referenced, the mapping is released with them
+            pass
+        self._map = None
+
+    # Returns a list of (timestamp in seconds, offset, length) of the packet records in the file.
+    # A truncated record at the end of the file, e.g. from a capture which is still running, is ignored.
+    def index(self):
+        return list(self.records())
+
+    # Generator of (timestamp in seconds, offset, length) of the packet records in the file.
+    def records(self):
+        if self.pcapng:
+            return self._pcapngRecords()
+        return self._pcapRecords()
+
+    def _pcapRecords(self):
+        buffer = self.buffer
+        end = len(buffer)
+        if end < PCAP_GLOBAL_HEADER_LENGTH:
+            return
+
+        header, ticks_per_second, resolution = unpack_pcap_header(buffer)
+        offset = PCAP_GLOBAL_HEADER_LENGTH
+        while offset + PCAP_PACKET_HEADER_LENGTH <= end:
+            seconds, fraction, included_length, _ = header.unpack_from(buffer, offset)
+            offset += PCAP_PACKET_HEADER_LENGTH
+            if offset + included_length > end:
+                break
+            yield (seconds * ticks_per_second + fraction) * resolution, offset, included_length
+            offset += included_length
+
+    def _pcapngRecords(self):
+        buffer = self.buffer
+        end = len(buffer)
+        byte_order = "<"
+        resolutions = []
+
+        offset = 0
+        while offset + 12 <= end:
+            block_type, = struct.unpack_from(byte_order + "L", buffer, offset)
+            if block_type == PCAPNG_SECTION_HEADER_BLOCK:
+                # The byte order can change with every section
+                byte_order = "<" if struct.unpack_from("<L", buffer, offset + 8)[0] == PCAPNG_BYTE_ORDER_MAGIC else ">"
+                resolutions = []
+            block_length, = struct.unpack_from(byte_order + "L", buffer, offset + 4)
+            if block_length < 12 or offset + block_length > end:
+                break
+
+            if block_type == PCAPNG_INTERFACE_DESCRIPTION_BLOCK:
+                resolutions.append(unpack_pcapng_resolution(buffer, byte_order, offset + 16,
+                                                            offset + block_length - 4))
+            elif block_type == PCAPNG_ENHANCED_PACKET_BLOCK:
+                interface, high, low, captured_length = struct.unpack_from(byte_order + "LLLL", buffer, offset + 8)
+                if interface >= len(resolutions):
+                    raise Exceptions.InvalidCaptureFile("unknown interface %d in %s" % (interface, self.filename))
+                yield ((high << 32) | low) * resolutions[interface], offset + 28, captured_length
+
+            offset += block_length
+
+
+class CaptureFileFollower:
+    """Read the packet records of a pcap or pcapng capture file while it is still being written, e.g. by
+    CaptureFileHandler.
+
+    read() returns the records appended since the previous call as (timestamp in seconds, bytes). A record which is
+    only partly written yet is returned by a later call. The file does not need to exist yet, and when it is
+    replaced by a new capture file (rolled over or cleared), reading starts over with the new file.
+
+    Example:
+        with CaptureFileFollower("capture.pcap") as follower:
+            while capturing:
+                for timestamp, packet in follower.read():
+                    ...
+                time.sleep(0.2)
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.restarts = 0
+        self._file = None
+        self._data = bytearray()
+        self._pcapng = None
+        self._header = None
+        self._byteOrder = "<"
+        self._resolutions = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def read(self):
+        if self._replaced():
+            self._restart()
+        if self._file is None:
+            try:
+                self._file = open(self.filename, "rb")
+            except FileNotFoundError:
+                return []
+
+        self._data += self._file.read()
+        return self._records()
+
+    # True when the file at filename is no longer the one being read, or it got shorter than what was read
+    def _replaced(self):
+        if self._file is None:
+            return False
+        try:
+            current = os.stat(self.filename)
+        except FileNotFoundError:
+            return False
+        opened = os.fstat(self._file.fileno())
+        return current.st_ino != opened.st_ino or current.st_dev != opened.st_dev \
+            or opened.st_size < self._file.tell()
+
+    def _restart(self):
+        self.close()
+        self._data.clear()
+        self._pcapng = None
+        self._header = None
+        self._byteOrder = "<"
+        self._resolutions = []
+        self.restarts += 1
+
+    def _records(self):
+        data = self._data
+        if self._pcapng is None:
+            if len(data) < 4:
+                return []
+            self._pcapng = struct.unpack_from("<L", data)[0] == PCAPNG_SECTION_HEADER_BLOCK
+        if self._pcapng:
+            return self._pcapngRecords()
+        return self._pcapRecords()
+
+    def _pcapRecords(self):
+        data = self._data
+        if self._header is None:
+            if len(data) < PCAP_GLOBAL_HEADER_LENGTH:
+                return []
+            try:
+                self._header = unpack_pcap_header(data)
+            except Exceptions.InvalidCaptureFile:
+                raise Exceptions.InvalidCaptureFile("not a pcap or pcapng file: %s" % self.filename)
+            del data[:PCAP_GLOBAL_HEADER_LENGTH]
+
+        header, ticks_per_second, resolution = self._header
+        records = []
+        offset = 0
+        end = len(data)
+        while offset + PCAP_PACKET_HEADER_LENGTH <= end:
+            seconds, fraction, included_length, _ = header.unpack_from(data, offset)
+            if offset + PCAP_PACKET_HEADER_LENGTH + included_length > end:
+                break
+            start = offset + PCAP_PACKET_HEADER_LENGTH
+            offset = start + included_length
+            records.append(((seconds * ticks_per_second + fraction) * resolution, bytes(data[start:offset])))
+        del data[:offset]
+        return records
+
+    # The complete blocks of a pcapng file, as CaptureFileReader._pcapngRecords() reads them
+    def _pcapngRecords(self):
+        data = self._data
+        records = []
+        offset = 0
+        end = len(data)
+        while offset + 12 <= end:
+            block_type, = struct.unpack_from(self._byteOrder + "L", data, offset)
+            if block_type == PCAPNG_SECTION_HEADER_BLOCK:
+                # The byte order can change with every section
+                self._byteOrder = "<" if struct.unpack_from("<L", data, offset + 8)[0] == PCAPNG_BYTE_ORDER_MAGIC \
+                    else ">"
+                self._resolutions = []
+            byte_order = self._byteOrder
+            block_length, = struct.unpack_from(byte_order + "L", data, offset + 4)
+            if block_length < 12:
+                raise Exceptions.InvalidCaptureFile("invalid pcapng block in %s" % self.filename)
+            if offset + block_length > end:
+                break
+
+            if block_type == PCAPNG_INTERFACE_DESCRIPTION_BLOCK:
+                self._resolutions.append(unpack_pcapng_resolution(data, byte_order, offset + 16,
+                                                                  offset + block_length - 4))
+            elif block_type == PCAPNG_ENHANCED_PACKET_BLOCK:
+                interface, high, low, captured_length = struct.unpack_from(byte_order + "LLLL", data, offset + 8)
+                if interface >= len(self._resolutions):
+                    raise Exceptions.InvalidCaptureFile("unknown interface %d in %s" % (interface, self.filename))
+                start = offset + 28
+                records.append((((high << 32) | low) * self._resolutions[interface],
+                                bytes(data[start:start + captured_length])))
+
+            offset += block_length
+        del data[:offset]
+        return records
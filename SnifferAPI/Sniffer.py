@@ -34,7 +34,6 @@
 # LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT
 # OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
-import datetime
 import logging
 from . import Logger
 from . import UART
@@ -42,7 +41,8 @@ import sys
 import os
 import threading
 from . import SnifferCollector
-from .Packet import test_log
+from . import PacketBuffer
+from . import CaptureWriter
 
 try:
     from .version import VERSION_STRING
@@ -65,12 +65,23 @@ class Sniffer(threading.Thread, SnifferCollector.SnifferCollector):
     # Sniffer constructor. portnum argument is optional. If not provided,
     # the software will try to locate the firwmare automatically (may take time).
     # NOTE: portnum is 0-indexed, while Windows names are 1-indexed
+    # packet_buffer_size is the number of packets kept for getPackets(), the oldest packets are overwritten.
+    # capture_queue_size is the number of packets waiting to be written to the capture file and capture sinks,
+    # packets are dropped from the capture when it is full.
+    # If collect_stats is True, the per-stage counters and timers of getStats() are collected. With
+    # stats_dump_interval set, the stats are logged every stats_dump_interval seconds.
     def __init__(self, portnum=None, baudrate=UART.SNIFFER_OLD_DEFAULT_BAUDRATE, auto_test=False,
-                 given_name=None, **kwargs):
+                 given_name=None, packet_buffer_size=PacketBuffer.DEFAULT_PACKET_BUFFER_SIZE,
+                 capture_queue_size=CaptureWriter.DEFAULT_WRITE_QUEUE_SIZE, collect_stats=False,
+                 stats_dump_interval=None, **kwargs):
         threading.Thread.__init__(self)
         self._packetReader = None
         SnifferCollector.SnifferCollector.__init__(self, portnum, baudrate=baudrate, auto_test=auto_test,
-                                                   given_name=given_name, **kwargs)
+                                                   given_name=given_name, packet_buffer_size=packet_buffer_size,
+                                                   capture_queue_size=capture_queue_size,
+                                                   collect_stats=collect_stats, **kwargs)
+        if stats_dump_interval:
+            self.startStatsDump(stats_dump_interval)
 
         self.daemon = True
 
@@ -79,7 +90,7 @@ class Sniffer(threading.Thread, SnifferCollector.SnifferCollector):
     # API STARTS HERE
 
     # Get [number] number of packets since last fetch (-1 means all)
-    # Note that the packet buffer is limited to about 80000 packets.
+    # Note that the packet buffer is limited to packet_buffer_size packets (100000 by default).
     # Returns: A list of Packet objects
     def getPackets(self, number=-1):
         return self._getPackets(number)
@@ -100,6 +111,38 @@ class Sniffer(threading.Thread, SnifferCollector.SnifferCollector):
     def follow(self, device=None, followOnlyAdvertisements=False, followOnlyLegacy=False, followCoded=False):
         self._startFollowing(device, followOnlyAdvertisements, followOnlyLegacy, followCoded)
 
+    # Add a capture sink, a callable which is called with every captured Packet on the capture writer thread,
+    # in the same order as the capture file is written.
+    # Returns nothing
+    def addCaptureSink(self, sink):
+        self._captureWriter.addSink(sink)
+
+    # Remove a capture sink added with addCaptureSink().
+    # Returns nothing
+    def removeCaptureSink(self, sink):
+        self._captureWriter.removeSink(sink)
+
+    # Get the sniffer statistics: counters and per-stage timers (only collected while stats are enabled),
+    # and gauges such as queue depths and error counts, which are always available.
+    # Returns: A dict with "enabled", "time", "counters", "timers" and "gauges"
+    def getStats(self):
+        return self._metrics.snapshot()
+
+    # Enable or disable collecting the counters and timers of getStats().
+    # Returns nothing
+    def setStatsEnabled(self, enabled):
+        self._metrics.enabled = enabled
+
+    # Log the stats every interval seconds, as one line with the given output function.
+    # Returns nothing
+    def startStatsDump(self, interval, output=logging.info):
+        self._metrics.startDump(interval, output)
+
+    # Stop logging the stats started with startStatsDump().
+    # Returns nothing
+    def stopStatsDump(self):
+        self._metrics.stopDump()
+
     # Clear the list of devices
     def clearDevices(self):
         self._clearDevices()
@@ -181,10 +224,7 @@ class Sniffer(threading.Thread, SnifferCollector.SnifferCollector):
     # If join is True, join the sniffer thread until it quits.
     # Returns nothing.
     def doExit(self, caller, join=False):
-        if test_log:
-            msg = f'{str(datetime.datetime.now())} - from {caller}, Sniffer, doExit().\n'
-            print(msg)
-            test_log.write(msg)
+        logging.info(f'from {caller}, Sniffer, doExit()')
         self._doExit()
         if join:
             self.join()
@@ -197,6 +237,18 @@ class Sniffer(threading.Thread, SnifferCollector.SnifferCollector):
     def missedPackets(self):
         return self._missedPackets
 
+    # The number of UART frames dropped because the packet processing could not keep up with the sniffer.
+    @property
+    def droppedFrames(self):
+        uart = self._getUart()
+        return uart.droppedFrames if uart is not None else 0
+
+    # Statistics of the capture writer queue: packets queued, written, dropped because the queue was full, pending,
+    # the queue size and its peak, and the number of sink errors.
+    @property
+    def captureWriterStats(self):
+        return self._captureWriter.stats
+
     # The number of packets which were sniffed in the last BLE connection. From CONNECT_REQ until link loss/termination.
     @property
     def packetsInLastConnection(self):
@@ -34,12 +34,11 @@
 # LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT
 # OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
-import datetime
-from . import Packet, Exceptions, CaptureFiles, Devices, Notifications
+from . import Packet, Exceptions, CaptureFiles, CaptureWriter, Devices, Metrics, Notifications, PacketBuffer
 import time, sys, threading, subprocess, os, logging, copy
-from pprint import pprint
 from serial import SerialException
 from .Types import *
+from .Trace import tracer, INFO, DEBUG, VERBOSE, CAT_PIPE, CAT_CAPTURE
 
 STATE_INITIALIZING = 0
 STATE_SCANNING = 1
@@ -48,23 +47,32 @@ STATE_FOLLOWING = 2
 new_phy_packet = False
 
 class SnifferCollector(Notifications.Notifier):
-    def __init__(self, portnum=None, baudrate=None, auto_test=False, given_name=None, *args, **kwargs):
+    def __init__(self, portnum=None, baudrate=None, auto_test=False, given_name=None,
+                 packet_buffer_size=PacketBuffer.DEFAULT_PACKET_BUFFER_SIZE,
+                 capture_queue_size=CaptureWriter.DEFAULT_WRITE_QUEUE_SIZE, collect_stats=False, *args, **kwargs):
         Notifications.Notifier.__init__(self, *args, **kwargs)
+        self._metrics = Metrics.Metrics(enabled=collect_stats)
         self._portnum = portnum
         self._fwversion = "Unknown version"
         self._setState(STATE_INITIALIZING)
         self._captureHandler = CaptureFiles.CaptureFileHandler(auto_test=auto_test, given_name=given_name,
                                                                capture_file_path=kwargs.get("capture_file_path", None))
+        # The capture file and any other capture sinks are written on the capture writer thread, which flushes the
+        # capture file when no packet arrived for its flush interval
+        self._captureWriter = CaptureWriter.CaptureWriter([self._captureHandler.writePacket],
+                                                          queueSize=capture_queue_size, metrics=self._metrics,
+                                                          onIdle=self._captureHandler.flush,
+                                                          idleTimeout=self._captureHandler.flushInterval)
         self._exit = False
         self._connectionAccessAddress = None
         self._packetListLock = threading.RLock()
         self.auto_test = auto_test
 
         with self._packetListLock:
-            self._packets = []
+            self._packets = PacketBuffer.PacketBuffer(packet_buffer_size)
 
         self._packetReader = Packet.PacketReader(self._portnum, baudrate=baudrate,
-                                                 callbacks=[("*", self.passOnNotification)])
+                                                 callbacks=[("*", self.passOnNotification)], metrics=self._metrics)
         self._devices = Devices.DeviceList(callbacks=[("*", self.passOnNotification)])
 
         self._missedPackets = 0
@@ -82,10 +90,47 @@ class SnifferCollector(Notifications.Notifier):
         self._last_time = None
         self._last_timestamp = 0
         self._boardId = self._makeBoardId()
+        self._addGauges()
 
     def __del__(self):
         self._doExit()
 
+    # Queue depths and error counts which are kept anyway, read when the stats are taken.
+    # The packet reader is looked up on every read since it is replaced when the port changes.
+    def _addGauges(self):
+        gauges = {
+            "uart.read_queue_depth": self._uartGauge(lambda uart: len(uart.read_queue)),
+            "uart.read_queue_peak": self._uartGauge(lambda uart: uart.read_queue_peak),
+            "uart.dropped_frames": self._uartGauge(lambda uart: uart.dropped_frames),
+            "slip.discarded_bytes": self._uartGauge(lambda uart: uart.slip_decoder.discardedBytes),
+            "slip.escape_errors": self._uartGauge(lambda uart: uart.slip_decoder.escapeErrors),
+            "packet.counter_gaps": lambda: self._packetReader.packetGaps,
+            "packet.missing": lambda: self._packetReader.packetsMissing,
+            "packet.processed": lambda: self._nProcessedPackets,
+            "packet.missed": lambda: self._missedPackets,
+            "packet.buffered": lambda: len(self._packets),
+            "packet.overwritten": lambda: self._packets.overwritten,
+            "capture.queue_depth": lambda: len(self._captureWriter.write_queue),
+            "capture.queue_peak": lambda: self._captureWriter.write_queue_peak,
+            "capture.dropped": lambda: self._captureWriter.dropped_packets,
+            "capture.sink_errors": lambda: self._captureWriter.sink_errors,
+        }
+        for name, read in gauges.items():
+            self._metrics.addGauge(name, read)
+
+    # The UART of the packet reader, None before the port is opened or when it failed to open
+    def _getUart(self):
+        if self._packetReader is None:
+            return None
+        return self._packetReader.uart
+
+    # A gauge reading a UART value, 0 while there is no UART
+    def _uartGauge(self, read):
+        def gauge():
+            uart = self._getUart()
+            return read(uart) if uart is not None else 0
+        return gauge
+
     def _setup(self):
         self._packetReader.setup()
 
@@ -130,7 +175,8 @@ class SnifferCollector(Notifications.Notifier):
         global new_phy_packet
 
         if new_phy_packet:
-            pprint(packet)
+            if tracer.debug:
+                tracer.trace(DEBUG, CAT_PIPE, "125.1", "first packet after PHY change: %r", packet)
             new_phy_packet = False
 
         packet.boardId = self._boardId
@@ -157,14 +203,13 @@ class SnifferCollector(Notifications.Notifier):
         self._appendPacket(packet)
 
         self.notify("NEW_BLE_PACKET", {"packet": packet})
-        # TRACE: 124, write the packet to pcap file
-        self._captureHandler.writePacket(packet)
+        if tracer.verbose:
+            tracer.trace(VERBOSE, CAT_CAPTURE, "124", "capture packet %d", packet.packetCounter)
+        self._captureWriter.put(packet)
 
         self._nProcessedPackets += 1
         if packet.OK:
             try:
-                if new_phy_packet:
-                    print(f'-- {packet.blePacket.type}')
                 if packet.blePacket.type == PACKET_TYPE_ADVERTISING:
 
                     if self.state == STATE_FOLLOWING and packet.blePacket.advType == 5:
@@ -186,10 +231,6 @@ class SnifferCollector(Notifications.Notifier):
             except Exception as e:
                 logging.exception("packet processing error %s" % str(e))
                 self.notify("PACKET_PROCESSING_ERROR", {"errorString": str(e)})
-        else:
-            if new_phy_packet:
-                print(f'packet.OK: {packet.OK}')
-                new_phy_packet = False
 
     def _continuouslyPipe(self):
         global new_phy_packet
@@ -199,7 +240,6 @@ class SnifferCollector(Notifications.Notifier):
         while not self._exit:
             try:
                 packet = self._packetReader.getPacket(timeout=12)
-                #TRACE: 123  # This is the real time captured packet.
 
                 if packet is None or not packet.valid:
                     raise Exceptions.InvalidPacketException("")
@@ -210,49 +250,59 @@ class SnifferCollector(Notifications.Notifier):
             except (SerialException, ValueError):
                 logging.exception("UART read error")
                 logging.error("Lost contact with sniffer hardware.")
+                # Keep the last trace points for the post-mortem
+                tracer.dump(logging.error)
                 self._doExit()
             except Exceptions.InvalidPacketException:
                 pass
             else:
-                #print(f'<5 {packet.packetCounter}')
-                #if packet.id == EVENT_PACKET_DATA_PDU or packet.id == EVENT_PACKET_ADV_PDU or packet.id == PING_RESP:
+                if tracer.verbose:
+                    tracer.trace(VERBOSE, CAT_PIPE, "123", "packet %d id %d", packet.packetCounter, packet.id)
                 if packet.id == EVENT_PACKET_DATA_PDU or packet.id == EVENT_PACKET_ADV_PDU:
                     if last_packet_id == 2 and packet.id == 6:
-                        print(f'\n5.1 changed from ADV to DATA @ {packet.packetCounter}\n')
+                        if tracer.info:
+                            tracer.trace(INFO, CAT_PIPE, "125.1", "changed from ADV to DATA @ %d",
+                                         packet.packetCounter)
                     if last_packet_id == 6 and packet.id == 14:
-                        print(f"\n{str(datetime.datetime.now())} NEW PHY PACKET should be seen here @ {packet.packetCounter}\n")
+                        if tracer.info:
+                            tracer.trace(INFO, CAT_PIPE, "125.1", "new PHY packet should be seen here @ %d",
+                                         packet.packetCounter)
                         new_phy_packet = True
-                    self._processBLEPacket(packet)
-                    # TRACE 125.1
+                    if self._metrics.enabled:
+                        start = time.perf_counter()
+                        self._processBLEPacket(packet)
+                        self._metrics.addTime("packet.process", time.perf_counter() - start)
+                    else:
+                        self._processBLEPacket(packet)
                 elif packet.id == EVENT_FOLLOW:
                     # This packet has no value for the user.
-                    print(f'5.x')
                     pass
                 elif packet.id == EVENT_CONNECT:
-                    # TRACE 125.2
-                    print(f'5.2 {packet.packetCounter}')
+                    if tracer.info:
+                        tracer.trace(INFO, CAT_PIPE, "125.2", "connect @ %d", packet.packetCounter)
                     self._connectEventPacketCounterValue = packet.packetCounter
                     self._inConnection = True
                     # copy it because packets are eventually deleted
                     self._currentConnectRequest = copy.copy(self._findPacketByPacketCounter(self._connectEventPacketCounterValue-1))
                 elif packet.id == EVENT_DISCONNECT:
-                    # TRACE 125.3
-                    print(f'5.3')
+                    if tracer.info:
+                        tracer.trace(INFO, CAT_PIPE, "125.3", "disconnect @ %d", packet.packetCounter)
                     if self._inConnection:
                         self._packetsInLastConnection = packet.packetCounter - self._connectEventPacketCounterValue
                         self._inConnection = False
                 elif packet.id == SWITCH_BAUD_RATE_RESP and self._switchingBaudRate:
-                    print(f'5.4')
                     self._switchingBaudRate = False
+                    if tracer.info:
+                        tracer.trace(INFO, CAT_PIPE, "126", "baud rate response: %d, proposed: %d",
+                                     packet.baudRate, self._proposedBaudRate)
                     if packet.baudRate == self._proposedBaudRate:
-                        print(f'5.4.1')
                         self._packetReader.switchBaudRate(self._proposedBaudRate)
                     else:
-                        print(f'5.4.2')
                         self._switchBaudRate(packet.baudRate)
                 
                 elif packet.id == PING_RESP:
-                    #print(f'\n5.5 {packet.packetCounter} {packet.id}\n')
+                    if tracer.debug:
+                        tracer.trace(DEBUG, CAT_PIPE, "127", "ping response @ %d", packet.packetCounter)
                     if hasattr(packet, 'version'):
                         versions = { 1116: '3.1.0',
                                     1115: '3.0.0',
@@ -263,15 +313,16 @@ class SnifferCollector(Notifications.Notifier):
                             self._fwversion = versions.get(packet.version, 'SVN rev: %d' % packet.version)
                         else:
                             self._fwversion = versions.get(packet.version, 'SVN rev: %d' % 1112)  # choose the oldest
-                        #print("Firmware version %s" % self._fwversion)
                 
                 elif packet.id == RESP_VERSION:
-                    print(f'5.6 {packet.packetCounter}')
+                    if tracer.debug:
+                        tracer.trace(DEBUG, CAT_PIPE, "127", "version response @ %d", packet.packetCounter)
                     self._fwversion = packet.version
                     print("Firmware version %s" % self._fwversion)
                 elif packet.id == RESP_TIMESTAMP:
                     # Use current time as timestamp reference
-                    print(f'5.7 {packet.packetCounter}')
+                    if tracer.debug:
+                        tracer.trace(DEBUG, CAT_PIPE, "127", "timestamp response @ %d", packet.packetCounter)
                     self._last_time = time.time()
                     self._last_timestamp = packet.timestamp
 
@@ -279,21 +330,14 @@ class SnifferCollector(Notifications.Notifier):
                     usecs = int((self._last_time - int(self._last_time)) * 1_000_000)
                     print(f'Firmware timestamp {self._last_timestamp} reference: '
                                  f'{time.strftime("%b %d %Y %X", lt)}.{usecs} {time.strftime("%Z", lt)}')
-                else:
-                    if packet.id == REQ_FOLLOW:
-                        print("\nREQ_FOLLOW\n")
-                    else:
-                        print(f'5.8 UNKNOWN packet.id')
+                elif tracer.debug:
+                    tracer.trace(DEBUG, CAT_PIPE, "128", "unhandled packet id %d @ %d", packet.id, packet.packetCounter)
 
                 last_packet_id = packet.id
 
     def _findPacketByPacketCounter(self, packetCounterValue):
         with self._packetListLock:
-            for i in range(-1, -1-len(self._packets), -1):
-                # iterate backwards through packets
-                if self._packets[i].packetCounter == packetCounterValue:
-                    return self._packets[i]
-        return None
+            return self._packets.findByPacketCounter(packetCounterValue)
 
     def _startScanning(self, findScanRsp = False, findAux = False, scanCoded = False):
         msg = "starting scan"
@@ -312,6 +356,12 @@ class SnifferCollector(Notifications.Notifier):
         self.notify("APP_EXIT")
         if self._packetReader:
             self._packetReader.doExit("SnifferCollector, _doExit")
+        if self._captureWriter.close():
+            self._captureHandler.close()
+        else:
+            # Closing the file under the writer would fail its next write, the packets it still has are lost
+            logging.warning("capture file left open, the capture writer is still writing")
+        self._metrics.stopDump()
         # Clear method references to avoid uncollectable cyclic references
         self.clearCallbacks()
         self._devices.clearCallbacks()
@@ -328,16 +378,12 @@ class SnifferCollector(Notifications.Notifier):
 
     def _appendPacket(self, packet):
         with self._packetListLock:
-            if len(self._packets) > 100000:
-                self._packets = self._packets[20000:]
             self._packets.append(packet)
 
     def _getPackets(self, number = -1):
         with self._packetListLock:
-            returnList = self._packets[0:number]
-            self._packets = self._packets[number:]
-        return returnList
+            return self._packets.take(number)
 
     def _clearPackets(self):
         with self._packetListLock:
-            del self._packets[:]
+            self._packets.clear()
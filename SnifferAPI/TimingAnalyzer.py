@@ -0,0 +1,338 @@
+# Copyright (c) Nordic Semiconductor ASA
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form, except as embedded into a Nordic
+#    Semiconductor ASA integrated circuit in a product or a software update for
+#    such product, must reproduce the above copyright notice, this list of
+#    conditions and the following disclaimer in the documentation and/or other
+#    materials provided with the distribution.
+#
+# 3. Neither the name of Nordic Semiconductor ASA nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#    software without specific prior written permission.
+#
+# 4. This software, with or without modification, must only be used with a
+#    Nordic Semiconductor ASA integrated circuit.
+#
+# 5. Any software provided in binary form under this license must not be reverse
+#    engineered, decompiled, modified and/or disassembled.
+#
+# THIS SOFTWARE IS PROVIDED BY NORDIC SEMICONDUCTOR ASA "AS IS" AND ANY EXPRESS
+# OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES
+# OF MERCHANTABILITY, NONINFRINGEMENT, AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL NORDIC SEMICONDUCTOR ASA OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE
+# GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT
+# OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import math
+
+from .Types import *
+
+# PHY switching state
+PHY_SW_ST_INIT = 0
+PHY_SW_ST_REQ = 1
+PHY_SW_ST_UPDATE = 2
+PHY_SW_ST_CHANGING = 3
+PHY_SW_ST_DONE = 4
+
+# Connection timing state
+CONN_TIMING_ST_INIT = 0
+CONN_TIMING_ST_REQ = 1
+CONN_TIMING_ST_DONE = 2
+
+# LL control PDU opcode
+LL_PHY_REQ = 0x16
+
+# T_IFS limits of the verification, in us
+TIFS_MIN = 148
+TIFS_MAX = 152
+# PHY switch time limit in seconds, and connection timing limit in us
+PHY_SWITCH_TIME_MAX = 70.0 / 1E3
+CONN_TIMING_MAX = 8800
+
+# Histogram bins kept by TifsStats before the bin width is doubled
+MAX_HISTOGRAM_BINS = 4096
+# Samples kept by TifsStats for a first look at the readings
+FIRST_SAMPLES = 20
+
+
+class TifsStats:
+    # Streaming T_IFS statistics: count, min and max with where they were seen, mean and variance, quantiles and
+    # out of spec counters, updated per sample without keeping the samples.
+    #
+    # The quantiles come from a histogram at 1 us resolution, which is exact as T_IFS values are whole us. When the
+    # samples spread over more than MAX_HISTOGRAM_BINS bins, the bin width is doubled, which bounds the memory for
+    # any capture at the cost of quantiles rounded down to the bin width.
+    def __init__(self):
+        self.count = 0
+        self.min = None
+        self.max = None
+        # Sample index and packet counter of the first min and max
+        self.minIndex = None
+        self.maxIndex = None
+        self.minPacketCounter = None
+        self.maxPacketCounter = None
+        self.total = 0
+        self._mean = 0.0
+        self._m2 = 0.0
+        self.belowSpec = 0
+        self.aboveSpec = 0
+        self.first = []
+        self.binWidth = 1
+        self.bins = {}
+
+    def __len__(self):
+        return self.count
+
+    # Whether a T_IFS sample is within the limits of the verification
+    @staticmethod
+    def sampleInSpec(value):
+        return TIFS_MIN <= value <= TIFS_MAX
+
+    def add(self, value, packetCounter=None):
+        index = self.count
+        self.count += 1
+        if self.min is None or value < self.min:
+            self.min, self.minIndex, self.minPacketCounter = value, index, packetCounter
+        if self.max is None or value > self.max:
+            self.max, self.maxIndex, self.maxPacketCounter = value, index, packetCounter
+
+        # The mean is total / count, as sum() / len() of the samples. The variance uses Welford's online algorithm.
+        self.total += value
+        delta = value - self._mean
+        self._mean += delta / self.count
+        self._m2 += delta * (value - self._mean)
+
+        if value < TIFS_MIN:
+            self.belowSpec += 1
+        elif value > TIFS_MAX:
+            self.aboveSpec += 1
+
+        if index < FIRST_SAMPLES:
+            self.first.append(value)
+
+        key = value // self.binWidth
+        self.bins[key] = self.bins.get(key, 0) + 1
+        if len(self.bins) > MAX_HISTOGRAM_BINS:
+            self._widenBins()
+
+    def _widenBins(self):
+        while len(self.bins) > MAX_HISTOGRAM_BINS:
+            self.binWidth *= 2
+            bins = {}
+            for key, n in self.bins.items():
+                bins[key // 2] = bins.get(key // 2, 0) + n
+            self.bins = bins
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+    @property
+    def variance(self):
+        return self._m2 / (self.count - 1) if self.count > 1 else 0.0
+
+    @property
+    def stdev(self):
+        return math.sqrt(self.variance)
+
+    @property
+    def inSpec(self):
+        return self.count > 0 and self.belowSpec == 0 and self.aboveSpec == 0
+
+    # The k-th smallest sample, 0-based, rounded down to the bin width
+    def kth(self, k):
+        seen = 0
+        for key in sorted(self.bins):
+            seen += self.bins[key]
+            if seen > k:
+                return key * self.binWidth
+        return None
+
+    def quantile(self, fraction):
+        if self.count == 0:
+            return None
+        return self.kth(min(self.count - 1, int(fraction * self.count)))
+
+    # The median as statistics.median() computes it, the mean of the middle two samples for an even count
+    def median(self):
+        if self.count == 0:
+            return None
+        if self.count % 2:
+            return self.kth(self.count // 2)
+        return (self.kth(self.count // 2 - 1) + self.kth(self.count // 2)) / 2
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "min": self.min,
+            "max": self.max,
+            "min_packet_counter": self.minPacketCounter,
+            "max_packet_counter": self.maxPacketCounter,
+            "mean": self.mean,
+            "stdev": self.stdev if self.count else None,
+            "median": self.median(),
+            "p1": self.quantile(0.01),
+            "p99": self.quantile(0.99),
+            "below_spec": self.belowSpec,
+            "above_spec": self.aboveSpec,
+        }
+
+
+class TimingAnalyzer:
+    # T_IFS, PHY switch and connection timing of the BLE packets read by a parser PacketReader from a capture file.
+    # Each analysis has its own TimingAnalyzer, so that several captures can be analysed at the same time.
+    #
+    # info_log and tifs_log are optional file names, the packet timing and the T_IFS values are written to them.
+    # The files are only opened when they are given, close() closes them.
+    # output is called with the connection, PHY switch and T_IFS failure messages, they are printed by default.
+    def __init__(self, info_log=None, tifs_log=None, output=print):
+        self.info_log = open(info_log, "w") if info_log else None
+        self.tifs_log = open(tifs_log, "w") if tifs_log else None
+        self.output = output
+        self.reset()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def reset(self):
+        self.tifs = TifsStats()
+
+        # search "Check PHY switch" to locate the code
+        self.phy_switch_state = PHY_SW_ST_INIT
+        self.phy_switch_start = None
+        self.phy_switch_end = None
+        self.phy_switch_time = None
+
+        self.conn_timing_state = CONN_TIMING_ST_INIT
+        self.conn_timing_time = None
+
+    def close(self):
+        for log in (self.info_log, self.tifs_log):
+            if log is not None:
+                log.close()
+        self.info_log = None
+        self.tifs_log = None
+
+    # The first failed check of the results so far, or None. The checks can fail as soon as the packet which fails
+    # them is analyzed, so a capture which is still running can be stopped early.
+    def checkFailure(self):
+        tifs = self.tifs
+        if tifs.belowSpec or tifs.aboveSpec:
+            return f'T_IFS out of spec: min {tifs.min} at packet {tifs.minPacketCounter}, ' \
+                   f'max {tifs.max} at packet {tifs.maxPacketCounter}'
+        if self.phy_switch_time is not None and self.phy_switch_time > PHY_SWITCH_TIME_MAX:
+            return f'PHY switch time {self.phy_switch_time * 1E3:.3f} ms > {PHY_SWITCH_TIME_MAX * 1E3:.0f} ms'
+        if self.conn_timing_time is not None and self.conn_timing_time > CONN_TIMING_MAX:
+            return f'connection timing {self.conn_timing_time} us > {CONN_TIMING_MAX} us'
+        return None
+
+    def writeInfo(self, msg):
+        if self.info_log is not None:
+            self.info_log.write(msg)
+
+    # The time from the end of the previous BLE packet to the start of this one, in us, or None without a previous
+    # packet. file_type 1 captures store it in the timestamp field already.
+    def packetTiming(self, packet, reader, file_type):
+        self.writeInfo(f'Packet counter: {packet.packetCounter}\n')
+        self.writeInfo(f'Timestamp: {packet.timestamp} us\n')
+
+        end_to_start = None
+        if file_type == 1:
+            end_to_start = packet.timestamp
+            self.writeInfo(f'[Delta time (end to start): {end_to_start} us\n')
+        elif reader.lastReceivedTimestampPacket:
+            last_packet_timestamp = reader.lastReceivedTimestampPacket.timestamp
+            start_to_start = packet.timestamp - last_packet_timestamp
+
+            last_packet_time = reader.getPacketTime(packet)
+            end_to_start = start_to_start - last_packet_time
+            self.writeInfo(f'[Packet time (start to end): {last_packet_time} us\n')
+            self.writeInfo(f'[Delta time (end to start): {end_to_start} us\n')
+            self.writeInfo(f'[Delta time (start to start): {start_to_start} us\n')
+
+        self.writeInfo(f'\n')
+        return end_to_start
+
+    # Follow the connection, PHY switch and T_IFS of a parsed BLE packet, received at packet_time (in s) and
+    # end_to_start us after the end of the previous one.
+    def analyzePacket(self, packet, packet_type, reader, packet_time, end_to_start):
+        ble_packet = packet.blePacket
+
+        if ble_packet.advType == PDU_TYPE_CONNECT_IND and \
+                reader.last_ble_packet is not None:  # Avoid the 1st packet is CONNECT_IND
+            reader.detected_connection = True
+        elif packet_type != PACKET_TYPE_DATA:
+            reader.detected_connection = False
+            if self.conn_timing_state == CONN_TIMING_ST_DONE:
+                self.conn_timing_state = CONN_TIMING_ST_INIT
+
+        #
+        # check connection timing
+        #
+        if reader.detected_connection and self.conn_timing_state == CONN_TIMING_ST_INIT:
+            self.conn_timing_state = CONN_TIMING_ST_REQ
+            msg = f'CONNECT_REQ: packet cnt: {packet.packetCounter}'
+            self.output(f'{msg}')
+        elif self.conn_timing_state == CONN_TIMING_ST_REQ and packet_type == PACKET_TYPE_DATA:
+            self.conn_timing_state = CONN_TIMING_ST_DONE
+            self.conn_timing_time = end_to_start
+            msg = f'CONNECTION DONE: packet cnt: {packet.packetCounter}, time: {self.conn_timing_time}'
+            self.output(f'{msg}\n')
+
+        #
+        # Check PHY switch
+        #
+        if packet_type == PACKET_TYPE_DATA and ble_packet.llid == 3:
+            if len(ble_packet.payload) == 6:  # Control Opcode, TX PHYs, RX PHYs, CRC
+                if ble_packet.payload[0] == LL_PHY_REQ:
+                    self.phy_switch_state = PHY_SW_ST_REQ
+                    self.phy_switch_start = packet_time
+                    msg = f'LL_PHY_REQ:\n\tpacket cnt: {packet.packetCounter}'                \
+                          f'\n\tself.packet_time_from_pcap: {packet_time}'
+                    self.output(msg)
+                    self.writeInfo(f'{msg}\n')
+
+        if self.phy_switch_state == PHY_SW_ST_REQ:
+            if packet.phy != PHY_1M:
+                self.phy_switch_state = PHY_SW_ST_DONE
+                self.phy_switch_end = packet_time
+                self.phy_switch_time = self.phy_switch_end - self.phy_switch_start
+                msg = f'new PHY applied:\n'                                             \
+                      f'\tself.phy: {packet.phy}\n'                                     \
+                      f'\tself.packet_time_from_pcap: {packet_time}\n'        \
+                      f'\tPHY switch time: {self.phy_switch_time*1E3:.3f} ms'
+                self.output(f'{msg}\n')
+
+        #
+        # Check T_IFS
+        #
+        if reader.last_ble_packet is not None and self.phy_switch_state == PHY_SW_ST_INIT:
+            # With advertising packet and data packet
+            if packet_type == PACKET_TYPE_DATA and reader.detected_connection:
+                if not packet.direction:      # False: slave to master
+                    if self.tifs_log is not None:
+                        self.tifs_log.write(f'Packet cnt: {packet.packetCounter}\n')
+                        self.tifs_log.write(f'{end_to_start}\n\n')
+
+                    self.tifs.add(end_to_start, packet.packetCounter)
+
+                    if not self.tifs.sampleInSpec(end_to_start):
+                        msg = f'T_IFS FAIL! Packet counter: {packet.packetCounter}, '\
+                              f'{end_to_start}, {packet_time}'
+                        self.output(f'{msg}')
+
+        reader.last_ble_packet = ble_packet
@@ -0,0 +1,134 @@
+# Copyright (c) Nordic Semiconductor ASA
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form, except as embedded into a Nordic
+#    Semiconductor ASA integrated circuit in a product or a software update for
+#    such product, must reproduce the above copyright notice, this list of
+#    conditions and the following disclaimer in the documentation and/or other
+#    materials provided with the distribution.
+#
+# 3. Neither the name of Nordic Semiconductor ASA nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#    software without specific prior written permission.
+#
+# 4. This software, with or without modification, must only be used with a
+#    Nordic Semiconductor ASA integrated circuit.
+#
+# 5. Any software provided in binary form under this license must not be reverse
+#    engineered, decompiled, modified and/or disassembled.
+#
+# THIS SOFTWARE IS PROVIDED BY NORDIC SEMICONDUCTOR ASA "AS IS" AND ANY EXPRESS
+# OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES
+# OF MERCHANTABILITY, NONINFRINGEMENT, AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL NORDIC SEMICONDUCTOR ASA OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE
+# GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT
+# OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import collections
+import logging
+import time
+
+# Trace levels, a trace point is emitted when its level is at or below the configured level
+OFF = 0
+INFO = 1
+DEBUG = 2
+VERBOSE = 3  # per packet trace points
+
+LEVEL_NAMES = {"off": OFF, "info": INFO, "debug": DEBUG, "verbose": VERBOSE}
+
+# Trace categories
+CAT_UART = "uart"        # commands sent to the sniffer firmware
+CAT_PACKET = "packet"    # UART packet decoding
+CAT_PIPE = "pipe"        # packet dispatch in SnifferCollector
+CAT_CAPTURE = "capture"  # packets written to the capture file and sinks
+CAT_TIMING = "timing"    # live timing analysis of the captured packets
+
+CATEGORIES = (CAT_UART, CAT_PACKET, CAT_PIPE, CAT_CAPTURE, CAT_TIMING)
+
+DEFAULT_RING_SIZE = 10000
+
+
+class Tracer:
+    # Trace points are guarded by the level flags, so that a disabled trace point costs one attribute lookup and
+    # its message is never formatted:
+    #     if tracer.verbose:
+    #         tracer.trace(VERBOSE, CAT_PIPE, "123", "packet %d id %d", packet.packetCounter, packet.id)
+    #
+    # Enabled trace points are printed to the console, logged and/or kept in a ring buffer which can be dumped
+    # after the fact. Ring buffer entries are formatted when they are traced, so that they do not keep the packets
+    # and buffers passed as format arguments alive.
+    def __init__(self):
+        self.level = OFF
+        self.categories = None
+        self.console = False
+        self.log = False
+        self.ring = None
+        self._setFlags()
+
+    # level: OFF, INFO, DEBUG or VERBOSE, or one of the LEVEL_NAMES
+    # categories: the categories to trace, None for all
+    # console: print trace points to stdout
+    # log: log trace points with logging.debug
+    # ringSize: keep the last ringSize trace points for dump(), 0 to disable the ring buffer
+    def configure(self, level=None, categories=None, console=None, log=None, ringSize=None):
+        if level is not None:
+            self.level = LEVEL_NAMES[level.lower()] if isinstance(level, str) else level
+        if categories is not None:
+            self.categories = frozenset(categories) if categories else None
+        if console is not None:
+            self.console = console
+        if log is not None:
+            self.log = log
+        if ringSize is not None:
+            self.ring = collections.deque(maxlen=ringSize) if ringSize > 0 else None
+        self._setFlags()
+
+    def _setFlags(self):
+        routed = self.console or self.log or self.ring is not None
+        self.info = routed and self.level >= INFO
+        self.debug = routed and self.level >= DEBUG
+        self.verbose = routed and self.level >= VERBOSE
+
+    def trace(self, level, category, traceId, msg, *args):
+        if level > self.level or (self.categories is not None and category not in self.categories):
+            return
+        line = format_trace(category, traceId, msg, args)
+        if self.ring is not None:
+            self.ring.append((time.time(), line))
+        if self.console:
+            print(line)
+        if self.log:
+            logging.debug(line)
+
+    # Write the trace points kept in the ring buffer, oldest first, with the given output function
+    def dump(self, output=print):
+        if self.ring is None:
+            return
+        for timestamp, line in list(self.ring):
+            lt = time.localtime(timestamp)
+            usecs = int((timestamp - int(timestamp)) * 1_000_000)
+            output(f'{time.strftime("%X", lt)}.{usecs:06d} {line}')
+
+    def clear(self):
+        if self.ring is not None:
+            self.ring.clear()
+
+
+def format_trace(category, traceId, msg, args):
+    if args:
+        msg = msg % args
+    return f'[{traceId} {category}] {msg}'
+
+
+# The tracer shared by the sniffer modules, configure it in place with tracer.configure()
+tracer = Tracer()
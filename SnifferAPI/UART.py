@@ -52,6 +52,8 @@ if os.name == "posix":
 SNIFFER_OLD_DEFAULT_BAUDRATE = 460800
 # Baudrates that should be tried (add more if required)
 SNIFFER_BAUDRATES = [1000000, 460800]
+# Number of decoded frames the read queue holds before new frames are dropped
+DEFAULT_FRAME_QUEUE_SIZE = 20000
 
 
 def find_sniffer(write_data=False):
@@ -109,8 +111,9 @@ def find_sniffer_baudrates(port, write_data=False):
 
 
 class Uart:
-    def __init__(self, portnum=None, baudrate=None):
+    def __init__(self, portnum=None, baudrate=None, frameQueueSize=DEFAULT_FRAME_QUEUE_SIZE, metrics=None):
         self.ser = None
+        self.metrics = metrics
         try:
             if baudrate is not None and baudrate not in SNIFFER_BAUDRATES:
                 raise Exception("Invalid baudrate: " + str(baudrate))
@@ -135,8 +138,13 @@ class Uart:
                 self.ser = None
             raise
 
+        # The worker thread decodes the SLIP stream and queues complete frames
+        self.slip_decoder = Packet.SlipDecoder()
         self.read_queue = collections.deque()
         self.read_queue_has_data = Event()
+        self.read_queue_size = frameQueueSize
+        self.read_queue_peak = 0
+        self.dropped_frames = 0
 
         self.worker_thread = Thread(target=self._read_worker)
         self.reading = True
@@ -150,7 +158,12 @@ class Uart:
                 # Read any data available, or wait for at least one byte
                 data_read = self.ser.read(self.ser.in_waiting or 1)
                 #logging.info('type: {}'.format(data_read.__class__))
-                self._read_queue_extend(data_read)
+                frames = self.slip_decoder.feed(data_read)
+                if self.metrics is not None and self.metrics.enabled:
+                    self.metrics.count("uart.reads")
+                    self.metrics.count("uart.bytes_read", len(data_read))
+                    self.metrics.count("uart.frames_decoded", len(frames))
+                self._read_queue_extend(frames)
             except serial.SerialException as e:
                 logging.info("Unable to read UART: %s" % e)
                 self.reading = False
@@ -180,9 +193,19 @@ class Uart:
     def switchBaudRate(self, newBaudRate):
         self.ser.baudrate = newBaudRate
 
-    def readByte(self, timeout=None):
-        r = self._read_queue_get(timeout)
-        return r
+    # Return the next decoded SLIP frame as bytes, or None if no frame was received within the timeout.
+    def readFrame(self, timeout=None):
+        return self._read_queue_get(timeout)
+
+    # The number of frames dropped because the read queue was full
+    @property
+    def droppedFrames(self):
+        return self.dropped_frames
+
+    # The highest number of frames waiting in the read queue so far
+    @property
+    def frameQueuePeak(self):
+        return self.read_queue_peak
 
     def writeList(self, array):
         try:
@@ -194,9 +217,17 @@ class Uart:
             self.ser.close()
             raise e
 
-    def _read_queue_extend(self, data):
-        if len(data) > 0:
-            self.read_queue.extend(data)
+    def _read_queue_extend(self, frames):
+        if len(frames) > 0:
+            room = self.read_queue_size - len(self.read_queue)
+            if room < len(frames):
+                # Drop what does not fit rather than letting the queue grow without bound
+                if self.dropped_frames == 0:
+                    logging.warning("UART read queue full (%d frames), dropping frames" % self.read_queue_size)
+                self.dropped_frames += len(frames) - max(room, 0)
+                frames = frames[:max(room, 0)]
+            self.read_queue.extend(frames)
+            self.read_queue_peak = max(self.read_queue_peak, len(self.read_queue))
             self.read_queue_has_data.set()
 
     def _read_queue_get(self, timeout=None):
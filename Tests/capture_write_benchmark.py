@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+"""
+Measure how many packets per second CaptureFileHandler writes to the pcap file.
+
+The "before" numbers use the previous writer, which opened, appended to and closed the file for every packet.
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from SnifferAPI import CaptureFiles, Pcap
+from packet_footprint import make_frames, make_packets
+
+PACKET_NUM = 50000
+
+
+def write_packet_unbuffered(filename, packet):
+    """The previous CaptureFileHandler.writePacket()."""
+    with open(filename, "ab") as f:
+        f.write(Pcap.create_packet(bytes([packet.boardId]) + packet.getBytes(), packet.time))
+
+
+def run_unbuffered(directory, packets):
+    handler = CaptureFiles.CaptureFileHandler(capture_file_path=os.path.join(directory, "before.pcap"), clear=True)
+    handler.close()
+    start = time.perf_counter()
+    for packet in packets:
+        write_packet_unbuffered(handler.filename, packet)
+    return len(packets) / (time.perf_counter() - start), os.path.getsize(handler.filename)
+
+
+def run_buffered(directory, packets):
+    handler = CaptureFiles.CaptureFileHandler(capture_file_path=os.path.join(directory, "after.pcap"), clear=True)
+    start = time.perf_counter()
+    for packet in packets:
+        handler.writePacket(packet)
+    handler.close()
+    return len(packets) / (time.perf_counter() - start), os.path.getsize(handler.filename)
+
+
+if __name__ == "__main__":
+    packets = make_packets(make_frames(PACKET_NUM))
+
+    with tempfile.TemporaryDirectory() as directory:
+        before, before_size = run_unbuffered(directory, packets)
+        after, after_size = run_buffered(directory, packets)
+
+    print(f'{PACKET_NUM} packets')
+    print(f'open/append/close per packet: {before:10.0f} packets/s')
+    print(f'buffered writer:              {after:10.0f} packets/s ({after / before:.1f}x)')
+    if before_size != after_size:
+        print(f'File sizes differ: {before_size} != {after_size}')
+        sys.exit(1)
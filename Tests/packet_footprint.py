@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""
+Measure the memory kept alive per captured packet.
+
+SnifferCollector keeps up to 100000 packets, so the footprint of Packet and BlePacket decides how much memory
+a long capture uses. This script builds packets the way the live capture does and fails if the average retained
+size goes over the target.
+"""
+
+import gc
+import os
+import struct
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from SnifferAPI import Packet
+from SnifferAPI.Types import *
+
+# Average bytes retained per packet, including the packet buffer
+TARGET_BYTES_PER_PACKET = 1024
+PACKET_NUM = 20000
+
+
+def make_frame(packet_counter, event_id, flags, ble_packet):
+    """Build a decoded UART frame as sent by the sniffer, including the padding byte after the BLE header."""
+    ble_packet = ble_packet[:6] + b'\x00' + ble_packet[6:]
+    payload = struct.pack("<BBBBHL", Packet.BLE_HEADER_LENGTH, flags, 37, 60, packet_counter, packet_counter * 1250)
+    payload += ble_packet
+    return struct.pack("<HBHB", len(payload), PROTOVER_V3, packet_counter, event_id) + payload
+
+
+def make_frames(number):
+    adv_data = b'\x02\x01\x06\x07\x09Periph'
+    adv_ind = Packet.ADV_ACCESS_ADDRESS + bytes([0x40, 6 + len(adv_data)]) + bytes(range(6)) + adv_data + b'\x00' * 3
+    data_pdu = b'\x01\x02\x03\x04' + bytes([0x0e, 4]) + b'\x01\x02\x03\x04' + b'\x00' * 3
+
+    frames = []
+    for i in range(number):
+        if i % 4 == 0:
+            frames.append(make_frame(i % Packet.PACKET_COUNTER_CAP, EVENT_PACKET_ADV_PDU, 0x01, adv_ind))
+        else:
+            frames.append(make_frame(i % Packet.PACKET_COUNTER_CAP, EVENT_PACKET_DATA_PDU, 0x03, data_pdu))
+    return frames
+
+
+def make_packets(frames):
+    """Decode the frames into packets with board ID 0, 1 ms apart, as the capture writer receives them."""
+    packets = [Packet.Packet(frame) for frame in frames]
+    now = time.time()
+    for i, packet in enumerate(packets):
+        packet.boardId = 0
+        packet.time = now + i * 0.001
+    return packets
+
+
+def measure(frames):
+    gc.collect()
+    tracemalloc.start()
+    packets = [Packet.Packet(frame) for frame in frames]
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    assert all(packet.OK for packet in packets)
+    return size / len(packets)
+
+
+if __name__ == "__main__":
+    frames = make_frames(PACKET_NUM)
+    bytes_per_packet = measure(frames)
+
+    print(f'{PACKET_NUM} packets, {bytes_per_packet:.0f} bytes per packet (target: {TARGET_BYTES_PER_PACKET})')
+    if bytes_per_packet > TARGET_BYTES_PER_PACKET:
+        print("Packet footprint: FAIL")
+        sys.exit(1)
+    print("Packet footprint: PASS")
@@ -3,16 +3,14 @@
 import ble_test 
 import os
 
-from SnifferAPI.Packet import all_tifs
-
 if __name__ == "__main__":
     file = "../Temp/phy4.pcapng"
     file_path = os.path.expanduser(file)
     print(f'captured file: {file_path}')
 
-    ble_test.parse_phy_timing_test_results(0, file_path)
+    analyzer = ble_test.parse_phy_timing_test_results(0, file_path)
 
-    res = ble_test.check_results(3)
+    res = ble_test.check_results(3, analyzer)
 
 
     
\ No newline at end of file
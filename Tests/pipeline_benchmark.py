@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+"""
+Benchmark the capture pipeline, from the UART byte stream to the pcap file.
+
+Each stage runs separately on synthetic frames (see packet_footprint.py), and then the whole pipeline end-to-end:
+
+    slip_decode      Packet.SlipDecoder.feed() on the SLIP encoded stream, per frame
+    packet           Packet.Packet() construction
+    pcap_create      Pcap.create_packet()
+    pcap_encode      Pcap.PacketEncoder.add_packet(), written with one write per 64 kB
+    capture_write    CaptureFileHandler.writePacket()
+    process          SnifferCollector._processBLEPacket()
+    end_to_end       SLIP decode, Packet, _processBLEPacket() until the capture writer thread wrote the packet
+    pty              (with --pty) the emulated board on a pty to the Sniffer capture writer, at --rate packets/s
+
+For each stage it reports the throughput in packets per second, the p50 and p99 latency per packet and the memory
+blocks and bytes allocated per packet and still alive after the stage. The results can be saved as JSON and
+compared with an earlier run:
+
+    python3 Tests/pipeline_benchmark.py --output before.json
+    python3 Tests/pipeline_benchmark.py --compare before.json
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from SnifferAPI import CaptureFiles, Packet, Pcap, SnifferCollector
+from packet_footprint import make_frames, make_packets
+from sniffer_emulator import SnifferEmulator, slip_encode
+
+PACKET_NUM = 20000
+# Bytes per read from the emulated UART
+CHUNK_SIZE = 4096
+DEFAULT_PTY_RATE = 10000
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def measure_allocations(run):
+    """Blocks and bytes allocated by run() which are still alive when it returns what it created."""
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    result = run()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    stats = after.compare_to(before, "filename")
+    del result
+    return sum(s.count_diff for s in stats), sum(s.size_diff for s in stats)
+
+
+def summarize(number, elapsed, latencies, allocations):
+    blocks, size = allocations
+    return {
+        "packets": number,
+        "packets_per_second": round(number / elapsed),
+        "p50_us": round(percentile(latencies, 0.50) * 1E6, 2),
+        "p99_us": round(percentile(latencies, 0.99) * 1E6, 2),
+        "alloc_blocks_per_packet": round(blocks / number, 2),
+        "alloc_bytes_per_packet": round(size / number, 1),
+    }
+
+
+def timed(items, operation):
+    """Run operation on every item, returns the total time and the time of every call."""
+    latencies = []
+    clock = time.perf_counter
+    start = clock()
+    for item in items:
+        t = clock()
+        operation(item)
+        latencies.append(clock() - t)
+    return clock() - start, latencies
+
+
+def make_collector(directory):
+    collector = SnifferCollector.SnifferCollector(capture_file_path=os.path.join(directory, "bench.pcap"))
+    # Protocol version 3 packets are timed from the sniffer timestamps once a reference is known
+    collector._last_time = time.time()
+    collector._last_timestamp = 0
+    return collector
+
+
+def bench_slip_decode(frames):
+    chunks = [slip_encode(frame) for frame in frames]
+
+    def run():
+        decoder = Packet.SlipDecoder()
+        return [decoder.feed(chunk) for chunk in chunks]
+
+    elapsed, latencies = timed(chunks, Packet.SlipDecoder().feed)
+    return summarize(len(frames), elapsed, latencies, measure_allocations(run))
+
+
+def bench_packet(frames):
+    elapsed, latencies = timed(frames, Packet.Packet)
+    return summarize(len(frames), elapsed, latencies, measure_allocations(lambda: make_packets(frames)))
+
+
+def bench_pcap_create(packets):
+    def create(packet):
+        return Pcap.create_packet(bytes([packet.boardId]) + packet.getBytes(), packet.time)
+
+    elapsed, latencies = timed(packets, create)
+    return summarize(len(packets), elapsed, latencies, measure_allocations(lambda: [create(p) for p in packets]))
+
+
+def bench_pcap_encode(packets):
+    encoder = Pcap.PacketEncoder()
+
+    def encode(packet):
+        encoder.add_packet(packet)
+        if len(encoder) >= CaptureFiles.DEFAULT_WRITE_BUFFER_SIZE:
+            encoder.clear()
+
+    elapsed, latencies = timed(packets, encode)
+
+    def run():
+        for packet in packets:
+            encode(packet)
+        return encoder
+
+    return summarize(len(packets), elapsed, latencies, measure_allocations(run))
+
+
+def bench_capture_write(packets, directory):
+    handler = CaptureFiles.CaptureFileHandler(capture_file_path=os.path.join(directory, "write.pcap"), clear=True)
+    elapsed, latencies = timed(packets, handler.writePacket)
+    handler.close()
+
+    def run():
+        for packet in packets:
+            handler.writePacket(packet)
+        handler.close()
+
+    return summarize(len(packets), elapsed, latencies, measure_allocations(run))
+
+
+def bench_process(packets, directory):
+    collector = make_collector(directory)
+    elapsed, latencies = timed(packets, collector._processBLEPacket)
+
+    def run():
+        for packet in packets:
+            collector._processBLEPacket(packet)
+        return collector._getPackets()
+
+    allocations = measure_allocations(run)
+    collector._doExit()
+    return summarize(len(packets), elapsed, latencies, allocations)
+
+
+def bench_end_to_end(frames, directory):
+    stream = b''.join(slip_encode(frame) for frame in frames)
+    chunks = [stream[i:i + CHUNK_SIZE] for i in range(0, len(stream), CHUNK_SIZE)]
+
+    def run(measure):
+        collector = make_collector(directory)
+        written = {}
+        collector._captureWriter.addSink(lambda packet: written.setdefault(id(packet), time.perf_counter()))
+
+        decoder = Packet.SlipDecoder()
+        received = {}
+        start = time.perf_counter()
+        for chunk in chunks:
+            t = time.perf_counter()
+            for frame in decoder.feed(chunk):
+                packet = Packet.Packet(frame)
+                received[id(packet)] = t
+                collector._processBLEPacket(packet)
+        collector._captureWriter.close()
+        elapsed = time.perf_counter() - start
+        # The collector keeps the packets, so their ids are unique
+        packets = collector._getPackets()
+        collector._doExit()
+        if measure:
+            return elapsed, [written[key] - t for key, t in received.items() if key in written]
+        return packets
+
+    elapsed, latencies = run(True)
+    return summarize(len(frames), elapsed, latencies, measure_allocations(lambda: run(False)))
+
+
+def bench_pty(frames, directory, rate):
+    from SnifferAPI import Sniffer
+
+    with SnifferEmulator(frames, rate=rate) as emulator:
+        emulator.sendTimes = []
+        sniffer = Sniffer.Sniffer(emulator.port, 1000000, capture_file_path=os.path.join(directory, "pty.pcap"))
+        written = {}
+        sniffer.addCaptureSink(lambda packet: written.setdefault(packet.packetCounter, time.perf_counter()))
+        sniffer.start()
+        sniffer.scan()
+        emulator.finished.wait()
+
+        # Wait until the sniffer has caught up
+        stats = sniffer.captureWriterStats
+        while stats["written"] + sniffer.droppedFrames + stats["dropped"] < len(frames):
+            time.sleep(0.01)
+            if not sniffer.is_alive():
+                break
+            stats = sniffer.captureWriterStats
+        sniffer.doExit("pipeline_benchmark", join=True)
+
+    sent = dict(emulator.sendTimes)
+    latencies = [written[counter] - sent[counter] for counter in sent if counter in written]
+    elapsed = max(written.values()) - min(sent.values())
+    result = summarize(len(latencies), elapsed, latencies, (0, 0))
+    result["dropped"] = len(frames) - len(latencies)
+    result["rate"] = rate
+    del result["alloc_blocks_per_packet"], result["alloc_bytes_per_packet"]
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(number, pty_rate=None):
+    frames = make_frames(number)
+    packets = make_packets(frames)
+    stages = {}
+    with tempfile.TemporaryDirectory() as directory:
+        stages["slip_decode"] = bench_slip_decode(frames)
+        stages["packet"] = bench_packet(frames)
+        stages["pcap_create"] = bench_pcap_create(packets)
+        stages["pcap_encode"] = bench_pcap_encode(packets)
+        stages["capture_write"] = bench_capture_write(packets, directory)
+        stages["process"] = bench_process(make_packets(frames), directory)
+        stages["end_to_end"] = bench_end_to_end(frames, directory)
+        if pty_rate:
+            stages["pty"] = bench_pty(frames, directory, pty_rate)
+
+    return {
+        "commit": git_commit(),
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "stages": stages,
+    }
+
+
+def print_results(results, baseline=None):
+    print(f'commit: {results["commit"]}, python {results["python"]}, {results["platform"]}')
+    print(f'{"stage":<14} {"packets/s":>10} {"p50 us":>9} {"p99 us":>9} {"blocks/pkt":>11} {"bytes/pkt":>10}')
+    for name, stage in results["stages"].items():
+        line = f'{name:<14} {stage["packets_per_second"]:>10} {stage["p50_us"]:>9} {stage["p99_us"]:>9} ' \
+               f'{stage.get("alloc_blocks_per_packet", "-"):>11} {stage.get("alloc_bytes_per_packet", "-"):>10}'
+        if baseline is not None and name in baseline["stages"]:
+            before = baseline["stages"][name]
+            line += f'   throughput {stage["packets_per_second"] / before["packets_per_second"]:.2f}x, ' \
+                    f'p99 {stage["p99_us"] / before["p99_us"]:.2f}x'
+        print(line)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the sniffer capture pipeline")
+    parser.add_argument("--packets", type=int, default=PACKET_NUM, help="number of synthetic packets")
+    parser.add_argument("--output", help="save the results to this JSON file")
+    parser.add_argument("--compare", help="compare with the results in this JSON file")
+    parser.add_argument("--pty", action="store_true", help="also run the Sniffer against the pty board emulator")
+    parser.add_argument("--rate", type=float, default=DEFAULT_PTY_RATE, help="emulator packets per second")
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.packets, args.rate if args.pty else None)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_results(results, baseline)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
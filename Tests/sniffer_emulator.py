@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+"""
+Emulate an nRF Sniffer board on a pseudo-terminal.
+
+The emulator speaks the sniffer UART protocol (SLIP framed packets, see SnifferAPI/Types.py) on the master side of
+a pty pair. The slave side (SnifferEmulator.port) can be opened by UART.Uart and Sniffer.Sniffer like a real board.
+It answers PING_REQ, REQ_VERSION, REQ_TIMESTAMP and SWITCH_BAUD_RATE_REQ, and once scanning is requested it
+replays the BLE packets of a capture file (Examples/*.pcapng, or a pcap file written by the sniffer) at a given
+packet rate and/or UART baud rate.
+
+Example:
+    python3 Tests/sniffer_emulator.py Examples/1M_to_S8.pcapng --rate 10000 --repeat 0
+"""
+
+import argparse
+import os
+import pty
+import select
+import struct
+import sys
+import threading
+import time
+import tty
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from SnifferAPI import Packet, PcapReader
+from SnifferAPI.Types import *
+
+DEFAULT_VERSION = "4.1.1"
+# PING_RESP payload, firmware versions before RESP_VERSION was added
+DEFAULT_PING_VERSION = 1116
+
+
+def slip_encode(data):
+    """SLIP encode one UART packet."""
+    data = data.replace(bytes([SLIP_ESC]), bytes([SLIP_ESC, SLIP_ESC_ESC]))
+    data = data.replace(bytes([SLIP_START]), bytes([SLIP_ESC, SLIP_ESC_START]))
+    data = data.replace(bytes([SLIP_END]), bytes([SLIP_ESC, SLIP_ESC_END]))
+    return bytes([SLIP_START]) + data + bytes([SLIP_END])
+
+
+def to_uart_frame(record):
+    """Convert a captured packet (without the board ID) back to the packet sent by the board.
+
+    The sniffer removes the padding byte after the BLE header before the packet is saved, add it back.
+    """
+    record = bytearray(record)
+    if len(record) > Packet.BLEPACKET_POS + 6 and record[Packet.ID_POS] in (EVENT_PACKET_ADV_PDU,
+                                                                            EVENT_PACKET_DATA_PDU):
+        phy = (record[Packet.FLAGS_POS] >> 4) & 7
+        padding = Packet.BLEPACKET_POS + 6 + (1 if phy == PHY_CODED else 0)
+        record.insert(padding, 0)
+        if record[Packet.PROTOVER_POS] == PROTOVER_V1:
+            record[Packet.PAYLOAD_LEN_POS_V1] += 1
+        else:
+            struct.pack_into("<H", record, Packet.PAYLOAD_LEN_POS,
+                             struct.unpack_from("<H", record, Packet.PAYLOAD_LEN_POS)[0] + 1)
+    return bytes(record)
+
+
+def load_capture(filename):
+    """Read the UART packets to replay from a pcap or pcapng capture file."""
+    with PcapReader.CaptureFileReader(filename) as reader:
+        return [to_uart_frame(bytes(data[1:])) for _, data in reader if len(data) > Packet.HEADER_LENGTH]
+
+
+class SnifferEmulator:
+    """A sniffer board on a pty, replaying captured packets.
+
+    Args:
+        frames: UART packets to replay, e.g. from load_capture()
+        rate: packets per second, None for as fast as the pty takes them
+        baudrate: emulated UART speed in baud (10 bits per byte), None for no limit
+        repeat: number of times the frames are replayed, 0 for forever
+        version: the firmware version sent in RESP_VERSION
+    """
+
+    def __init__(self, frames, rate=None, baudrate=None, repeat=1, version=DEFAULT_VERSION):
+        self.frames = frames
+        self.rate = rate
+        self.baudrate = baudrate
+        self.repeat = repeat
+        self.version = version
+
+        self.packetCounter = 0
+        self.sentPackets = 0
+        self.sentBytes = 0
+        self.requests = []
+        # Set to a list to record (packet counter, time.perf_counter()) when each replayed packet is written
+        self.sendTimes = None
+        self.scanning = threading.Event()
+        self.finished = threading.Event()
+        self.running = True
+        self._writeLock = threading.Lock()
+        self._counterLock = threading.Lock()
+
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.master)
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+
+        self._reader = threading.Thread(target=self._readRequests, daemon=True)
+        self._replayer = threading.Thread(target=self._replay, daemon=True)
+        self._reader.start()
+        self._replayer.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if not self.running:
+            return
+        self.running = False
+        self.scanning.set()
+        self._replayer.join()
+        self._reader.join()
+        os.close(self.master)
+        os.close(self.slave)
+
+    # Start replaying without waiting for REQ_SCAN_CONT
+    def startReplay(self):
+        self.scanning.set()
+
+    def _nextCounter(self):
+        with self._counterLock:
+            counter = self.packetCounter
+            self.packetCounter = (self.packetCounter + 1) % Packet.PACKET_COUNTER_CAP
+            return counter
+
+    def _write(self, data):
+        view = memoryview(data)
+        while view and self.running:
+            try:
+                _, writable, _ = select.select([], [self.master], [], 0.1)
+                if writable:
+                    written = os.write(self.master, view)
+                    view = view[written:]
+                    self.sentBytes += written
+            except OSError:
+                self.running = False
+
+    def _sendPacket(self, id, payload=b''):
+        header = struct.pack("<HBHB", len(payload), PROTOVER_V3, self._nextCounter(), id)
+        with self._writeLock:
+            self._write(slip_encode(header + payload))
+
+    def _handleRequest(self, frame):
+        if len(frame) < Packet.HEADER_LENGTH:
+            return
+        id = frame[Packet.ID_POS]
+        payload = frame[Packet.HEADER_LENGTH:]
+        self.requests.append(id)
+
+        if id == PING_REQ:
+            self._sendPacket(PING_RESP, struct.pack("<H", DEFAULT_PING_VERSION))
+        elif id == REQ_VERSION:
+            self._sendPacket(RESP_VERSION, self.version.encode("latin-1"))
+        elif id == REQ_TIMESTAMP:
+            # The timestamp of the next replayed packet, so that the host time reference matches the replay
+            self._sendPacket(RESP_TIMESTAMP, struct.pack("<L", self._nextTimestamp()))
+        elif id == SWITCH_BAUD_RATE_REQ:
+            self._sendPacket(SWITCH_BAUD_RATE_RESP, bytes(payload[:4]))
+        elif id == REQ_SCAN_CONT or id == REQ_FOLLOW:
+            self.scanning.set()
+
+    def _nextTimestamp(self):
+        for frame in self.frames:
+            if frame[Packet.ID_POS] in (EVENT_PACKET_ADV_PDU, EVENT_PACKET_DATA_PDU) \
+                    and len(frame) >= Packet.BLEPACKET_POS:
+                return struct.unpack_from("<L", frame, Packet.TIMESTAMP_POS)[0]
+        return 0
+
+    def _readRequests(self):
+        decoder = Packet.SlipDecoder()
+        while self.running:
+            try:
+                readable, _, _ = select.select([self.master], [], [], 0.1)
+                if readable:
+                    data = os.read(self.master, 4096)
+                    for frame in decoder.feed(data):
+                        self._handleRequest(frame)
+            except OSError:
+                # The slave side was closed
+                time.sleep(0.01)
+
+    def _encodedFrames(self):
+        # The packet counter is rewritten so that the host sees no gaps in it
+        for frame in self.frames:
+            frame = bytearray(frame)
+            counter = self._nextCounter()
+            struct.pack_into("<H", frame, Packet.PACKETCOUNTER_POS, counter)
+            yield counter, slip_encode(bytes(frame))
+
+    def _writeBatch(self, batch):
+        with self._writeLock:
+            self._write(b''.join(encoded for _, encoded in batch))
+        self.sentPackets += len(batch)
+        if self.sendTimes is not None:
+            now = time.perf_counter()
+            self.sendTimes.extend((counter, now) for counter, _ in batch)
+
+    def _replay(self):
+        self.scanning.wait()
+        start = time.perf_counter()
+        due = 0.0
+        iteration = 0
+        while self.running and (self.repeat == 0 or iteration < self.repeat):
+            batch = []
+            for counter, encoded in self._encodedFrames():
+                if not self.running:
+                    break
+                batch.append((counter, encoded))
+                due += max(1.0 / self.rate if self.rate else 0.0,
+                           len(encoded) * 10.0 / self.baudrate if self.baudrate else 0.0)
+                # Write what is due in batches, sleeping when ahead of the schedule
+                ahead = start + due - time.perf_counter()
+                if ahead > 0.001 or len(batch) >= 64:
+                    self._writeBatch(batch)
+                    batch = []
+                    if ahead > 0.001:
+                        time.sleep(ahead)
+            if batch:
+                self._writeBatch(batch)
+            iteration += 1
+        self.finished.set()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Emulate an nRF Sniffer board on a pty")
+    parser.add_argument("capture", help="pcap or pcapng file with the packets to replay")
+    parser.add_argument("--rate", type=float, default=None, help="packets per second (default: no limit)")
+    parser.add_argument("--baudrate", type=int, default=None, help="emulated UART baud rate (default: no limit)")
+    parser.add_argument("--repeat", type=int, default=1, help="number of replays, 0 for forever (default: 1)")
+    parser.add_argument("--version", default=DEFAULT_VERSION, help="firmware version string")
+    args = parser.parse_args()
+
+    frames = load_capture(args.capture)
+    with SnifferEmulator(frames, rate=args.rate, baudrate=args.baudrate, repeat=args.repeat,
+                         version=args.version) as emulator:
+        print(f'Sniffer emulator on {emulator.port}, {len(frames)} packets from {args.capture}')
+        try:
+            while not emulator.finished.wait(1.0):
+                pass
+        except KeyboardInterrupt:
+            pass
+        print(f'Sent {emulator.sentPackets} packets, {emulator.sentBytes} bytes')
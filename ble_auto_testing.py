@@ -38,9 +38,8 @@ from BLE_hci import run_terminal
 from datetime import datetime
 from nrf_sniffer_ble import run_sniffer as exe_sniffer
 from os.path import exists
-from pcapng_file_parser import parse_pcapng_file, all_tifs
+from pcapng_file_parser import parse_pcapng_file
 from pprint import pprint
-import statistics
 from subprocess import call, Popen, PIPE, CalledProcessError, STDOUT
 from threading import Thread
 import time
@@ -199,23 +198,19 @@ def run_parser(file_type: int, pcapng_file: str) -> int:
         Args:
             file_type:
                 0: Wireshark saved pcapng file
-                1: pcap file converted pcapng file
-            pcapng_file: the saved sniffer pcapng file name with path
+                1: pcap file captured by the sniffer, or that file converted to pcapng
+            pcapng_file: the saved sniffer pcap or pcapng file name with path
 
         Returns:
             err_code: or test result, 0, pass, 1, fail, 2, no TIFS captured
     """
-    parse_pcapng_file(file_type, pcapng_file)
+    tifs = parse_pcapng_file(file_type, pcapng_file).tifs
 
     res = 0
-    if len(all_tifs) > 0:
-        max_tifs = max(all_tifs)
-        min_tifs = min(all_tifs)
-        avg = sum(all_tifs) / len(all_tifs)
-
-        print(f'TIFS, total: {len(all_tifs)}, max: {max_tifs}, min: {min_tifs}, average: {avg:.1f}, '
-              f'median: {statistics.median(all_tifs)}')
-        if max_tifs <= 152 and min_tifs >= 148:
+    if tifs.count > 0:
+        print(f'TIFS, total: {tifs.count}, max: {tifs.max}, min: {tifs.min}, average: {tifs.mean:.1f}, '
+              f'median: {tifs.median()}')
+        if tifs.inSpec:
             print( "                TIFS verification: PASS")
             res = 0
         else:
@@ -281,7 +276,7 @@ def get_args():
     parser.add_argument('--tp0', help='BLE hci serial port for board 0 TRACE msg', default="/dev/ttyUSB8")
     parser.add_argument('--tp1', help='BLE hci serial port for board 1 TRACE msg', default="/dev/ttyUSB5")
     parser.add_argument('--time', help='test time in seconds', type=int, default=30)
-    parser.add_argument('--tshark', help='tshark program to convert pcap to pcapng', default=
+    parser.add_argument('--tshark', help='tshark program to convert pcap to pcapng (not needed by the parser)', default=
                         "/usr/bin/tshark")
     parser.add_argument('--phy', help='phy', default=2)
     
@@ -334,13 +329,9 @@ def run_tifs_test(args) -> int:
 
     # Parse the saved file.
     if exists(pcap_file):
-        # Need to convert pcap file to pcapng format.
-        pcapng_file = pcap_file.replace(".pcap", ".pcapng")
-        convert_pcap_to_pcapng(pcap_file, pcapng_file, args.tshark)
-
-        # Parse the results.
+        # Parse the results, the parser reads the pcap file directly.
         file_type = 1
-        result = run_parser(file_type, pcapng_file)
+        result = run_parser(file_type, pcap_file)
 
         if result == 0:
             return 0
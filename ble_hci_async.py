@@ -0,0 +1,301 @@
+#! /usr/bin/env python3
+
+################################################################################
+# Copyright (C) 2022 Analog Devices, Inc., All Rights Reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL MAXIM INTEGRATED BE LIABLE FOR ANY CLAIM, DAMAGES
+# OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+# ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+#
+# Except as contained in this notice, the name of Maxim Integrated
+# Products, Inc. shall not be used except as stated in the Maxim Integrated
+# Products, Inc. Branding Policy.
+#
+# The mere transfer of this software does not imply any licenses
+# of trade secrets, proprietary technology, copyrights, patents,
+# trademarks, maskwork rights, or any other form of intellectual
+# property whatsoever. Maxim Integrated Products, Inc. retains all
+# ownership rights.
+#
+###############################################################################
+
+
+## asyncio HCI consoles.
+#
+# Drives any number of boards from one asyncio event loop: BleHciConsole reads
+# the HCI and trace serial ports of every board with non-blocking reads when the
+# loop sees data on them, instead of with a thread per port (see HciReader).
+# AsyncHciConsole makes the commands and the event waits of a console coroutines.
+#
+# The ports are watched with loop.add_reader(), which needs a selector event
+# loop and serial ports with a file descriptor (Linux, macOS).
+#
+# Example, two boards connecting and switching to the 2M PHY:
+#   python3 ble_hci_async.py --hci /dev/ttyUSB0 /dev/ttyUSB1 --phy 2
+################################################################################
+
+import argparse
+import asyncio
+import queue
+import sys
+import threading
+import time
+
+from ble_hci_console import (HCI_CMD_ADV_ENABLE, HCI_CMD_DISCONNECT, HCI_CMD_RESET, BleHciConsole, addrCommand,
+                             advParamCommand, createConnCommand, defaultAdvInterval, defaultBaud, defaultCmdTimeout,
+                             defaultConnInterval, defaultSupTimeout, isConnectionComplete, isPhyUpdateComplete,
+                             phyCommand, setupCommands)
+
+# Seconds the connection runs before and after the PHY switch
+MEASURE_TIME = 3
+# Seconds to wait for a connection or a PHY update
+CONNECT_TIMEOUT = 5
+
+defaultAddrs = ["00:11:22:33:44:21", "00:11:22:33:44:22"]
+
+
+## Event loop thread.
+#
+# Runs an asyncio event loop on a daemon thread, for the consoles of blocking
+# code: BleHciConsole({..., "loop": hciLoop.loop}) reads its ports on it.
+################################################################################
+class HciLoop:
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+    ## Run a coroutine on the loop.
+    #
+    # Blocks until it is done and returns its result.
+    ################################################################################
+    def run(self, coro, timeout=None):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result(timeout)
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+
+class AsyncHciConsole:
+    ## Coroutines of a console.
+    #
+    # console is a BleHciConsole reading its ports on the running loop. Use as
+    # "async with AsyncHciConsole(console) as board:" to close its ports when done.
+    ################################################################################
+    def __init__(self, console):
+        self.console = console
+        self.id = console.id
+        self.loop = console.loop
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.console.stopReader()
+        for port in (self.console.port, self.console.trace_port):
+            if port is not None and port.is_open:
+                port.close()
+
+    ## Send HCI command.
+    #
+    # Sends the command when the controller has a command credit. By default waits
+    # for and prints its Command Complete or Command Status, and returns it as an
+    # HciPacket, None if the controller did not respond within the timeout.
+    ################################################################################
+    async def send_command(self, packet, resp=True, print_cmd=True, timeout=defaultCmdTimeout):
+        deadline = self.loop.time() + timeout
+        while not self.console.takeCredit():
+            remaining = deadline - self.loop.time()
+            # Send anyway if the controller does not give a credit back in time
+            if remaining <= 0 or not await self.console.waitPackets(remaining):
+                self.console.takeCredit(force=True)
+                break
+
+        future = self.console.writePacket(packet, resp, print_cmd)
+        if not resp:
+            return None
+
+        try:
+            evt = await asyncio.wait_for(asyncio.wrap_future(future), timeout)
+        except asyncio.TimeoutError:
+            self.console.dropPending(future)
+            return None
+
+        if evt is not None:
+            self.console.printEvent(evt)
+        return evt
+
+    ## Wait for an HCI event.
+    #
+    # Returns the next event or ACL packet, None if nothing arrives within the timeout.
+    ################################################################################
+    async def wait_event(self, print_evt=True, timeout=1.0):
+        deadline = self.loop.time() + timeout
+        while True:
+            try:
+                packet = self.console.events.get_nowait()
+                break
+            except queue.Empty:
+                remaining = deadline - self.loop.time()
+                if remaining <= 0 or not await self.console.waitPackets(remaining):
+                    return None
+
+        if print_evt:
+            self.console.printEvent(packet)
+        return packet
+
+    ## Wait for an HCI event matching a predicate.
+    #
+    # Reads the events until predicate(packet) is true, e.g. isConnectionComplete.
+    # Returns the matching HciPacket, or None if none arrives within the timeout.
+    ################################################################################
+    async def wait_for_event(self, predicate, timeout=defaultCmdTimeout, print_evt=True):
+        deadline = self.loop.time() + timeout
+        while True:
+            remaining = deadline - self.loop.time()
+            if remaining <= 0:
+                return None
+            packet = await self.wait_event(print_evt=print_evt, timeout=remaining)
+            if packet is None:
+                return None
+            if predicate(packet):
+                return packet
+
+    ## Print the events received for a few seconds.
+    ################################################################################
+    async def wait_events(self, seconds=2, print_evt=True):
+        deadline = self.loop.time() + seconds
+        while self.loop.time() < deadline:
+            await self.wait_event(print_evt=print_evt, timeout=deadline - self.loop.time())
+
+    ## Commands.
+    #
+    # The same HCI commands as the BleHciConsole functions of the same name.
+    ################################################################################
+    async def resetFunc(self):
+        return await self.send_command(HCI_CMD_RESET)
+
+    async def addrFunc(self, addr):
+        return await self.send_command(addrCommand(addr))
+
+    async def advFunc(self, interval=defaultAdvInterval, connect=True, stats=False):
+        for cmd in setupCommands(stats):
+            await self.send_command(cmd)
+
+        await self.send_command(advParamCommand(interval, connect))
+        return await self.send_command(HCI_CMD_ADV_ENABLE)
+
+    async def initFunc(self, addr, interval=defaultConnInterval, timeout=defaultSupTimeout, stats=False):
+        for cmd in setupCommands(stats):
+            await self.send_command(cmd)
+
+        return await self.send_command(createConnCommand(addr, interval, timeout))
+
+    async def phyFunc(self, phy):
+        return await self.send_command(phyCommand(phy))
+
+    async def disconFunc(self):
+        return await self.send_command(HCI_CMD_DISCONNECT)
+
+
+## PHY timing test on a pair of boards.
+#
+# The slave advertises, the master connects to it, and after measureTime seconds
+# the slave switches the PHY. Each step starts as soon as the one before is done.
+# Returns the seconds to the connection and to the PHY update, None if it failed.
+################################################################################
+async def phy_timing_test(master, slave, masterAddr, slaveAddr, newPhy, measureTime=MEASURE_TIME):
+    start = time.monotonic()
+    res = {"master": master.id, "slave": slave.id, "connected": None, "phy_updated": None}
+
+    await asyncio.gather(master.resetFunc(), slave.resetFunc())
+    await asyncio.gather(master.addrFunc(masterAddr), slave.addrFunc(slaveAddr))
+
+    await slave.advFunc()
+    await master.initFunc(slaveAddr)
+    if await master.wait_for_event(isConnectionComplete, timeout=CONNECT_TIMEOUT) is None:
+        return res
+    res["connected"] = time.monotonic() - start
+    await asyncio.sleep(measureTime)
+
+    await slave.phyFunc(newPhy)
+    if await slave.wait_for_event(isPhyUpdateComplete, timeout=CONNECT_TIMEOUT) is not None:
+        res["phy_updated"] = time.monotonic() - start
+    await asyncio.sleep(measureTime)
+
+    await asyncio.gather(master.resetFunc(), slave.resetFunc())
+    return res
+
+
+## Run the PHY timing test on pairs of boards.
+#
+# Boards 0 and 1 are a pair, 2 and 3 the next one and so on. All the pairs run
+# at the same time in one event loop.
+################################################################################
+async def run_boards(hciPorts, monPorts, addrs, newPhy, measureTime=MEASURE_TIME, baud=defaultBaud):
+    loop = asyncio.get_running_loop()
+    boards = []
+    for i, port in enumerate(hciPorts):
+        params = {"serialPort": port, "id": str(i + 1), "baud": baud, "loop": loop}
+        if i < len(monPorts):
+            params["monPort"] = monPorts[i]
+        boards.append(AsyncHciConsole(BleHciConsole(params)))
+
+    try:
+        tests = []
+        for i in range(0, len(boards) - 1, 2):
+            tests.append(phy_timing_test(boards[i], boards[i + 1], addrs[i], addrs[i + 1], newPhy, measureTime))
+        return await asyncio.gather(*tests)
+    finally:
+        for board in boards:
+            board.close()
+
+
+def board_addr(index):
+    if index < len(defaultAddrs):
+        return defaultAddrs[index]
+    return "00:11:22:33:%0.2X:%0.2X" % (0x44 + index // 2, 0x21 + index % 2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the PHY timing test on pairs of boards in one event loop")
+    parser.add_argument('--hci', nargs='+', required=True, help="HCI serial ports, master and slave of each pair")
+    parser.add_argument('--mon', nargs='*', default=[], help="trace serial ports, in the order of --hci")
+    parser.add_argument('--addr', nargs='*', default=[], help="board addresses, in the order of --hci")
+    parser.add_argument('--phy', default="2", help="new PHY, 1: 1M, 2: 2M, 3: S8, 4: S2, default: 2")
+    parser.add_argument('--time', type=float, default=MEASURE_TIME, help="seconds on each PHY")
+    parser.add_argument('--baud', type=int, default=defaultBaud, help="serial port baud rate")
+    args = parser.parse_args()
+
+    if len(args.hci) < 2 or len(args.hci) % 2:
+        print("Give the HCI ports of pairs of boards")
+        sys.exit(1)
+
+    addrs = args.addr + [board_addr(i) for i in range(len(args.addr), len(args.hci))]
+    results = asyncio.run(run_boards(args.hci, args.mon, addrs, args.phy, args.time, args.baud))
+
+    failed = 0
+    for res in results:
+        print(f'boards {res["master"]}/{res["slave"]}: connected: {res["connected"]}, '
+              f'PHY updated: {res["phy_updated"]}')
+        if res["connected"] is None or res["phy_updated"] is None:
+            failed += 1
+    sys.exit(1 if failed else 0)
@@ -33,13 +33,16 @@
 #
 ###############################################################################
 
-import codecs
+import asyncio
 import datetime
 import os
+import queue
 import serial
+import struct
 import sys
 import threading
-from time import sleep
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from time import monotonic, sleep
 
 
 # Setup the default serial port settings
@@ -59,6 +62,59 @@ defaultInitAddr = defaultDevAddr
 # Magic value for the exit function to properly return
 exitFuncMagic = 999
 
+# H4 packet types
+HCI_PACKET_CMD = 0x01
+HCI_PACKET_ACL = 0x02
+HCI_PACKET_EVT = 0x04
+
+# The packet types which start the packets read from the controller
+H4_PACKET_START = (bytes([HCI_PACKET_ACL]), bytes([HCI_PACKET_EVT]))
+
+# HCI event codes
+HCI_EVT_DISCONNECT_COMPLETE = 0x05
+HCI_EVT_CMD_COMPLETE = 0x0E
+HCI_EVT_CMD_STATUS = 0x0F
+HCI_EVT_NUM_COMPLETED_PACKETS = 0x13
+HCI_EVT_LE_META = 0x3E
+
+# LE Meta subevent codes
+HCI_LE_SUBEVT_CONN_COMPLETE = 0x01
+HCI_LE_SUBEVT_ENH_CONN_COMPLETE = 0x0A
+HCI_LE_SUBEVT_PHY_UPDATE_COMPLETE = 0x0C
+
+# Seconds to wait for the Command Complete or Command Status of a command
+defaultCmdTimeout = 1.0
+
+# Events queued for wait_event(), the oldest are dropped when nobody reads them
+maxQueuedEvents = 1000
+
+# Command Complete: Num_HCI_Command_Packets, Command_Opcode, Status of the return parameters
+CMD_COMPLETE = struct.Struct("<BHB")
+# Command Complete without return parameters, e.g. of HCI_NOP
+CMD_COMPLETE_NOP = struct.Struct("<BH")
+# Command Status: Status, Num_HCI_Command_Packets, Command_Opcode
+CMD_STATUS = struct.Struct("<BBH")
+# ACL data header: Handle and flags, Data_Total_Length
+ACL_HEADER = struct.Struct("<HH")
+
+# Return parameters after the status of the connection stats vendor command:
+# rxDataOk, rxDataCRC, rxDataTO, txData, errTrans
+CONN_STATS = struct.Struct("<LLLLL")
+# Return parameters after the status of LE Test End: Num_Packets
+TEST_END = struct.Struct("<H")
+# Return parameters after the status of LE Read Buffer Size:
+# LE_ACL_Data_Packet_Length, Total_Num_LE_ACL_Data_Packets
+LE_BUFFER_SIZE = struct.Struct("<HB")
+# Return parameters after the status of Read Buffer Size, used when the controller
+# has no separate LE buffers: ACL_Data_Packet_Length, SCO_Data_Packet_Length,
+# Total_Num_ACL_Data_Packets
+BUFFER_SIZE = struct.Struct("<HBH")
+# Number Of Completed Packets: Connection_Handle, Num_Completed_Packets of each handle
+COMPLETED_PACKETS = struct.Struct("<HH")
+
+# Seconds the host ACL test waits for the controller to complete the last packets
+defaultAclDrainTimeout = 1.0
+
 
 ## Convert integer to hex.
 #
@@ -119,7 +175,713 @@ def parseBytes32(byteString):
     return int(byteString[3] + byteString[2] + byteString[1] + byteString[0], 16)
 
 
-class BleHciConsole:
+## Little endian hex string of a 16 bit value.
+################################################################################
+def hex16(value):
+    return "%0.2X%0.2X" % (value & 0xFF, (value >> 8) & 0xFF)
+
+
+## HCI commands.
+#
+# The HCI commands sent by BleHciConsole, BLE_hci and AsyncHciConsole, as hex
+# strings for send_command(). They are only encoded here, so the consoles send
+# the same bytes.
+################################################################################
+HCI_CMD_RESET = "01030C00"
+# Vendor specific: reset the connection stats
+HCI_CMD_RESET_CONN_STATS = "0102FF00"
+# LE Set Default PHY: no preference, all PHYs
+HCI_CMD_DEFAULT_PHY = "01312003" + "00" + "07" + "07"
+HCI_CMD_ADV_ENABLE = "010A200101"
+# Disconnect handle 0, reason 0x16 Local Host Term
+HCI_CMD_DISCONNECT = "01060403000016"
+
+# Set Event Mask, Set Event Mask Page 2, Set Event Mask, LE Set Event Mask: all events
+HCI_CMDS_EVENT_MASKS = ("01010C08FFFFFFFFFFFFFFFF", "01630C08FFFFFFFFFFFFFFFF",
+                        "01010C08FFFFFFFFFFFFFFFF", "01012008FFFFFFFFFFFFFFFF")
+
+
+## Connection setup commands.
+#
+# The commands sent before advertising or initiating: the event masks, the
+# connection stats reset if stats is set, and the default PHY.
+################################################################################
+def setupCommands(stats=False):
+    cmds = list(HCI_CMDS_EVENT_MASKS)
+    if stats:
+        cmds.append(HCI_CMD_RESET_CONN_STATS)
+    cmds.append(HCI_CMD_DEFAULT_PHY)
+    return cmds
+
+
+## Set BD address command.
+#
+# Vendor specific command setting the public BD address, e.g. "00:11:22:33:44:55".
+################################################################################
+def addrCommand(addr):
+    return "01F0FF06" + parseBdAddr(addr)
+
+
+## Set advertising parameters command.
+#
+# interval is a hex string in units of 0.625 ms. Connectable advertising is
+# ADV_IND, otherwise ADV_NONCONN_IND. Own and peer address types are public, the
+# bogus peer address allows any peer to connect, all 3 advertising channels, no
+# filtering.
+################################################################################
+def advParamCommand(interval, connect=True):
+    advType = "00" if connect else "03"
+    advInterval = hex16(int(interval, 16))
+    peerAddr = "000000000000"
+    return "0106200F" + advInterval + advInterval + advType + "0000" + peerAddr + "0700"
+
+
+## Create connection command.
+#
+# Connects to the public address addr, with the connection interval and the
+# supervision timeout given as hex strings, from a public address, no latency.
+################################################################################
+def createConnCommand(addr, interval, timeout):
+    connInterval = hex16(int(interval, 16))
+    supTimeout = hex16(int(timeout, 16))
+    ownAddrType = "00"
+    connLatency = "0000"
+    return "010D2019A000A00000" + "00" + parseBdAddr(addr) + ownAddrType + connInterval + connInterval + \
+        connLatency + supTimeout + "0F100F10"
+
+
+## PHY switch command.
+#
+# LE Set PHY of connection handle 0 to the same TX and RX PHY, phy is "1": 1M,
+# "2": 2M, "3": Coded S8 or "4": Coded S2. Assumes that we can't do asymmetric
+# PHY settings.
+################################################################################
+def phyCommand(phy):
+    phyBits = "01"
+    phyOptions = "0000"
+    if (phy == "4"):
+        phyBits = "04"
+        phyOptions = "0100"
+    elif (phy == "3"):
+        phyBits = "04"
+        phyOptions = "0200"
+    elif (phy == "2"):
+        phyBits = "02"
+    elif (phy != "1"):
+        print("Invalid PHY selection, using 1M")
+
+    return "01322007" + "0000" + "00" + phyBits + phyBits + phyOptions
+
+
+## HCI packet.
+#
+# An ACL data packet or an HCI event received from the controller, as read from
+# the H4 stream: the packet type, the rest of the header and the payload. The
+# fields are decoded once when the packet is received. params is a memoryview of
+# the parameters after the decoded fields: the return parameters after the status
+# of a Command Complete, the parameters after the subevent code of an LE Meta
+# event, the data of an ACL packet. The hex string is only made when printing.
+################################################################################
+class HciPacket:
+    evtCode = None
+    subEvtCode = None
+    numCmdPackets = None
+    opcode = None
+    status = None
+    handle = None
+    # Offset of the params in the payload
+    paramsPos = 0
+
+    def __init__(self, packetType, header, payload):
+        self.packetType = packetType
+        self.header = header
+        self.payload = payload
+
+        if packetType == HCI_PACKET_EVT:
+            evtCode = self.evtCode = header[0]
+            if evtCode == HCI_EVT_CMD_COMPLETE:
+                if len(payload) >= 4:
+                    self.numCmdPackets, self.opcode, self.status = CMD_COMPLETE.unpack_from(payload)
+                    self.paramsPos = 4
+                elif len(payload) == 3:
+                    self.numCmdPackets, self.opcode = CMD_COMPLETE_NOP.unpack_from(payload)
+                    self.paramsPos = 3
+            elif evtCode == HCI_EVT_CMD_STATUS and len(payload) >= 4:
+                self.status, self.numCmdPackets, self.opcode = CMD_STATUS.unpack_from(payload)
+                self.paramsPos = 4
+            elif evtCode == HCI_EVT_LE_META and payload:
+                self.subEvtCode = payload[0]
+                self.paramsPos = 1
+        elif packetType == HCI_PACKET_ACL:
+            self.handle = ACL_HEADER.unpack_from(header)[0] & 0x0FFF
+
+    def isEvent(self):
+        return self.packetType == HCI_PACKET_EVT
+
+    @property
+    def params(self):
+        return memoryview(self.payload)[self.paramsPos:]
+
+    ## The packet as a hex string, as it is printed
+    def __str__(self):
+        return "%0.2X" % self.packetType + self.header.hex().upper() + self.payload.hex().upper()
+
+
+## H4 parser.
+#
+# Splits the H4 byte stream from the controller into HciPackets. The bytes of an
+# incomplete packet are kept for the next feed(). Bytes which do not start a
+# packet are discarded up to the next packet and counted in droppedBytes, the
+# error is printed once per resync.
+################################################################################
+class H4Parser:
+    def __init__(self):
+        self.buf = bytearray()
+        self.droppedBytes = 0
+        self.resyncing = False
+
+    def feed(self, data):
+        buf = self.buf
+        buf += data
+        packets = []
+
+        # Parse from pos and drop the parsed bytes once, at the end
+        pos = 0
+        size = len(buf)
+        while pos < size:
+            packetType = buf[pos]
+            if packetType == HCI_PACKET_ACL:
+                if size - pos < 5:
+                    break
+                hdrLen = 4
+                packetLen = buf[pos + 3] + (buf[pos + 4] << 8)
+            elif packetType == HCI_PACKET_EVT:
+                if size - pos < 3:
+                    break
+                hdrLen = 2
+                packetLen = buf[pos + 2]
+            else:
+                if not self.resyncing:
+                    print("Error: unknown evt = " + str(packetType) + ", discarding up to the next packet")
+                    self.resyncing = True
+                # Skip to the next byte which can start a packet
+                nextPos = size
+                for startByte in H4_PACKET_START:
+                    found = buf.find(startByte, pos + 1, nextPos)
+                    if found >= 0:
+                        nextPos = found
+                self.droppedBytes += nextPos - pos
+                pos = nextPos
+                continue
+
+            self.resyncing = False
+            end = pos + 1 + hdrLen + packetLen
+            if size < end:
+                break
+            header = bytes(buf[pos + 1:pos + 1 + hdrLen])
+            packets.append(HciPacket(packetType, header, bytes(buf[pos + 1 + hdrLen:end])))
+            pos = end
+
+        del buf[:pos]
+        return packets
+
+
+## Event predicates.
+#
+# Readiness conditions for HciReader.wait_for_event().
+################################################################################
+def isConnectionComplete(packet):
+    return packet.subEvtCode in (HCI_LE_SUBEVT_CONN_COMPLETE, HCI_LE_SUBEVT_ENH_CONN_COMPLETE)
+
+
+def isDisconnectionComplete(packet):
+    return packet.evtCode == HCI_EVT_DISCONNECT_COMPLETE
+
+
+def isPhyUpdateComplete(packet):
+    return packet.subEvtCode == HCI_LE_SUBEVT_PHY_UPDATE_COMPLETE
+
+
+## ACL statistics.
+#
+# Data sent to and received from one connection by the host ACL test. TX counts
+# the packets the controller reported completed with Number Of Completed Packets.
+################################################################################
+class AclStats:
+    def __init__(self, handle):
+        self.handle = handle
+        self.txPackets = 0
+        self.txCompleted = 0
+        self.txBytes = 0
+        self.rxPackets = 0
+        self.rxBytes = 0
+        self.txStart = None
+        self.txEnd = None
+        self.rxStart = None
+        self.rxEnd = None
+        self.rxFirstLen = 0
+
+    @staticmethod
+    def kbps(numBytes, start, end):
+        if start is None or end is None or end <= start:
+            return 0.0
+        return numBytes * 8 / (end - start) / 1000
+
+    def txKbps(self):
+        return self.kbps(self.txBytes, self.txStart, self.txEnd)
+
+    # The first packet only starts the measurement, its bytes arrived before it
+    def rxKbps(self):
+        if self.rxPackets < 2:
+            return 0.0
+        return self.kbps(self.rxBytes - self.rxFirstLen, self.rxStart, self.rxEnd)
+
+    def __str__(self):
+        return (f"handle 0x{self.handle:04X} TX: {self.txCompleted}/{self.txPackets} packets, {self.txBytes} bytes, "
+                f"{self.txKbps():.1f} kbps  RX: {self.rxPackets} packets, {self.rxBytes} bytes, "
+                f"{self.rxKbps():.1f} kbps")
+
+
+## HCI reader.
+#
+# Reads the HCI packets from the controller and matches the Command Complete and
+# Command Status events to the commands sent. The class using it opens self.port
+# and calls startReader(), printCommand() and printEvent() print the packets sent
+# and received.
+#
+# The packets are read on a thread of their own, or with loop.add_reader() by an
+# asyncio event loop given to startReader(), which can read the ports of many
+# boards on one thread. The port must then be opened with timeout=0.
+################################################################################
+class HciReader:
+    def startReader(self, loop=None):
+        # Events which are not the response of a waited command, read by wait_event()
+        self.events = queue.Queue(maxsize=maxQueuedEvents)
+        self.droppedEvents = 0
+
+        # Commands waiting for their Command Complete or Command Status: [opcode, future, resp]
+        self.pendingCmds = []
+
+        # Number of commands the controller accepts, updated by Command Complete and Command Status
+        self.cmdCredits = 1
+        self.cmdLock = threading.Condition()
+
+        # Host ACL test: free ACL buffers in the controller, the stats of each connection
+        self.aclCredits = 0
+        self.aclBuffers = 0
+        self.aclPacketLen = 0
+        self.aclLock = threading.Condition()
+        self.aclStats = {}
+        self.aclActive = False
+
+        self.parser = H4Parser()
+        self.readerStop = False
+        self.loop = loop
+        if loop is None:
+            self.readerThread = threading.Thread(target=self.readPackets, daemon=True)
+            self.readerThread.start()
+        else:
+            # Futures of the loop resolved when packets were handled, see waitPackets()
+            self.packetWaiters = []
+            self.loopReaders = []
+            self.addLoopReader(self.port, self.readAvailable)
+
+    def stopReader(self):
+        self.readerStop = True
+        if self.loop is not None:
+            for fd in self.loopReaders:
+                self.callOnLoop(self.loop.remove_reader, fd)
+            self.loopReaders = []
+
+    ## Watch a port on the loop.
+    #
+    # Calls callback on the loop when port has data, until stopReader().
+    ################################################################################
+    def addLoopReader(self, port, callback):
+        fd = port.fileno()
+        self.loopReaders.append(fd)
+        self.callOnLoop(self.loop.add_reader, fd, callback)
+
+    def callOnLoop(self, func, *args):
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+
+        if running is self.loop:
+            func(*args)
+        else:
+            self.loop.call_soon_threadsafe(func, *args)
+
+    ## Wait for packets on the loop.
+    #
+    # Returns after the next packets were handled, False if none arrive within the
+    # timeout. Must be awaited on the loop given to startReader().
+    ################################################################################
+    async def waitPackets(self, timeout):
+        waiter = self.loop.create_future()
+        self.packetWaiters.append(waiter)
+        try:
+            await asyncio.wait_for(waiter, timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            if waiter in self.packetWaiters:
+                self.packetWaiters.remove(waiter)
+
+    def printCommand(self, packet):
+        print(str(datetime.datetime.now()) + f" {self.id}> {packet}")
+
+    ## Read HCI packets.
+    #
+    # Reads the H4 stream from the serial port on the reader thread. Command Complete
+    # and Command Status events resolve the commands sent, the other packets are
+    # queued for wait_event().
+    ################################################################################
+    def readPackets(self):
+        while not self.readerStop:
+            try:
+                data = self.port.read(size=max(1, self.port.in_waiting))
+            except (serial.SerialException, OSError, TypeError, AttributeError):
+                # The port was closed
+                return
+            self.feed(data)
+
+    ## Read the HCI port on the loop.
+    #
+    # Called by the event loop when the HCI port has data, reads what was received
+    # without blocking.
+    ################################################################################
+    def readAvailable(self):
+        try:
+            data = self.port.read(max(1, self.port.in_waiting))
+        except (serial.SerialException, OSError, TypeError, AttributeError):
+            # The port was closed
+            self.stopReader()
+            return
+        self.feed(data)
+
+        waiters, self.packetWaiters = self.packetWaiters, []
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    def feed(self, data):
+        for packet in self.parser.feed(data):
+            try:
+                self.handlePacket(packet)
+            except Exception as e:
+                # Keep reading, the commands sent later must still get their responses
+                print(str(datetime.datetime.now()) + f" {self.id}< Error: handling {packet}: {e!r}")
+
+    ## Handle an HCI packet.
+    #
+    # Updates the command credits and resolves the oldest command sent with the
+    # opcode of a Command Complete or Command Status.
+    ################################################################################
+    def handlePacket(self, packet):
+        # While the host ACL test runs its packets are counted, not queued
+        if packet.evtCode == HCI_EVT_NUM_COMPLETED_PACKETS:
+            self.aclCompleted(packet)
+            if self.aclActive:
+                return
+        elif packet.packetType == HCI_PACKET_ACL and self.aclActive:
+            self.aclReceived(packet)
+            return
+
+        numCmdPackets = packet.numCmdPackets
+        if numCmdPackets is None:
+            self.queueEvent(packet)
+            return
+
+        with self.cmdLock:
+            self.cmdCredits = numCmdPackets
+            pending = None
+            for cmd in self.pendingCmds:
+                if cmd[0] == packet.opcode:
+                    pending = cmd
+                    self.pendingCmds.remove(cmd)
+                    break
+            self.cmdLock.notify_all()
+
+        if pending is None:
+            self.queueEvent(packet)
+        else:
+            _, future, resp = pending
+            future.set_result(packet)
+            if not resp:
+                # Nobody waits for the response, print it with the other events
+                self.queueEvent(packet)
+
+    ## Queue an HCI event.
+    #
+    # Queues the packet for wait_event(). When the queue is full the oldest event
+    # is dropped and counted in droppedEvents, the reader thread never blocks.
+    ################################################################################
+    def queueEvent(self, packet):
+        while True:
+            try:
+                self.events.put_nowait(packet)
+                return
+            except queue.Full:
+                pass
+            try:
+                self.events.get_nowait()
+            except queue.Empty:
+                continue
+            if self.droppedEvents == 0:
+                print(str(datetime.datetime.now()) + f" {self.id}< Error: event queue full ({maxQueuedEvents} events), "
+                      "dropping the oldest events")
+            self.droppedEvents += 1
+
+    ## Send HCI command asynchronously.
+    #
+    # Send a HCI command to the serial port when the controller has a command credit.
+    # Returns a future resolved with the HciPacket of the matching Command Complete
+    # or Command Status. Other packets, e.g. ACL data, resolve the future with None.
+    ################################################################################
+    def send_command_async(self, packet, resp=True, print_cmd=True, timeout=defaultCmdTimeout):
+        with self.cmdLock:
+            # Send anyway if the controller does not give a credit back in time
+            if not self.cmdLock.wait_for(lambda: self.cmdCredits > 0, timeout):
+                self.cmdCredits = 1
+
+            return self.writePacket(packet, resp, print_cmd)
+
+    ## Take a command credit.
+    #
+    # Returns False without waiting if the controller has no credit left, force
+    # takes one anyway.
+    ################################################################################
+    def takeCredit(self, force=False):
+        with self.cmdLock:
+            if self.cmdCredits <= 0 and not force:
+                return False
+            self.cmdCredits = max(self.cmdCredits, 1)
+            return True
+
+    ## Write an HCI packet.
+    #
+    # Writes the hex string packet to the controller once a credit was taken.
+    # Returns a concurrent.futures.Future resolved with the Command Complete or
+    # Command Status, with None right away for data packets.
+    ################################################################################
+    def writePacket(self, packet, resp=True, print_cmd=True):
+        data = bytearray.fromhex(packet)
+        future = Future()
+
+        if len(data) >= 3 and data[0] == HCI_PACKET_CMD:
+            opcode = data[1] | (data[2] << 8)
+            with self.cmdLock:
+                self.cmdCredits = max(self.cmdCredits - 1, 0)
+                self.pendingCmds.append([opcode, future, resp])
+        else:
+            future.set_result(None)
+
+        # Send the command and data
+        if print_cmd:
+            self.printCommand(packet)
+
+        self.port.write(data)
+
+        return future
+
+    ## Wait for a command response.
+    #
+    # Waits for the future returned by send_command_async(), returns the HciPacket
+    # or None if the controller did not respond within the timeout.
+    ################################################################################
+    def waitResponse(self, future, timeout=defaultCmdTimeout):
+        try:
+            return future.result(timeout)
+        except FutureTimeoutError:
+            self.dropPending(future)
+            return None
+
+    ## Drop a command without response.
+    #
+    # Forgets the command of future so the next command does not wait for its credit.
+    ################################################################################
+    def dropPending(self, future):
+        with self.cmdLock:
+            self.pendingCmds = [cmd for cmd in self.pendingCmds if cmd[1] is not future]
+            self.cmdCredits = max(self.cmdCredits, 1)
+            self.cmdLock.notify_all()
+
+    ## Wait for an HCI event matching a predicate.
+    #
+    # Reads the queued events until predicate(packet) is true, e.g. isConnectionComplete.
+    # The events read are printed when print_evt is set. Returns the matching
+    # HciPacket, or None if none arrives within the timeout.
+    ################################################################################
+    def wait_for_event(self, predicate, timeout=defaultCmdTimeout, print_evt=True):
+        deadline = monotonic() + timeout
+        while True:
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                return None
+            try:
+                packet = self.events.get(timeout=remaining)
+            except queue.Empty:
+                return None
+
+            if print_evt:
+                self.printEvent(packet)
+            if predicate(packet):
+                return packet
+
+    def printEvent(self, packet):
+        print(str(datetime.datetime.now()) + f" {self.id}<", str(packet))
+
+    ## Handle Number Of Completed Packets.
+    #
+    # Gives the ACL buffers of the completed packets back to the host ACL test.
+    ################################################################################
+    def aclCompleted(self, packet):
+        payload = packet.payload
+        if not payload:
+            return
+        numHandles = min(payload[0], (len(payload) - 1) // COMPLETED_PACKETS.size)
+
+        now = monotonic()
+        with self.aclLock:
+            for i in range(numHandles):
+                handle, count = COMPLETED_PACKETS.unpack_from(payload, 1 + i * COMPLETED_PACKETS.size)
+                self.aclCredits = min(self.aclCredits + count, self.aclBuffers)
+
+                stats = self.aclStats.get(handle & 0x0FFF)
+                if stats is not None:
+                    stats.txCompleted += count
+                    stats.txBytes += count * self.aclPacketLen
+                    stats.txEnd = now
+            self.aclLock.notify_all()
+
+    ## Count a received ACL packet.
+    #
+    # Called on the reader thread, the data is only counted.
+    ################################################################################
+    def aclReceived(self, packet):
+        stats = self.aclStats.get(packet.handle)
+        if stats is None:
+            stats = self.aclStats[packet.handle] = AclStats(packet.handle)
+
+        dataLen = len(packet.payload)
+        now = monotonic()
+        if stats.rxStart is None:
+            stats.rxStart = now
+            stats.rxFirstLen = dataLen
+        stats.rxPackets += 1
+        stats.rxBytes += dataLen
+        stats.rxEnd = now
+
+    ## Read the ACL buffer size.
+    #
+    # Returns the maximum ACL data length and the number of ACL buffers of the
+    # controller, from LE Read Buffer Size, or from Read Buffer Size when the
+    # controller shares its buffers with BR/EDR. None if the controller did not
+    # respond.
+    ################################################################################
+    def readAclBufferSize(self):
+        evt = self.send_command("01022000")
+        if evt is None or evt.status != 0 or len(evt.params) < LE_BUFFER_SIZE.size:
+            return None
+        packetLen, numPackets = LE_BUFFER_SIZE.unpack_from(evt.params)
+
+        if packetLen == 0 or numPackets == 0:
+            evt = self.send_command("01051000")
+            if evt is None or evt.status != 0 or len(evt.params) < BUFFER_SIZE.size:
+                return None
+            packetLen, _, numPackets = BUFFER_SIZE.unpack_from(evt.params)
+
+        return packetLen, numPackets
+
+    ## Host ACL throughput test.
+    #
+    # Sends ACL packets to the connections in handles for the given seconds, round
+    # robin, and counts the ACL packets received. A packet is sent for every ACL
+    # buffer the controller gives back with Number Of Completed Packets, the
+    # packets for all the free buffers in one write. With send=False the host only
+    # sinks the received packets. Returns the AclStats of each connection, None
+    # if the ACL buffer size could not be read.
+    ################################################################################
+    def aclThroughput(self, handles, packetLen=None, seconds=10, send=True):
+        bufferSize = self.readAclBufferSize()
+        if bufferSize is None:
+            print("Error: could not read the ACL buffer size")
+            return None
+        maxLen, numBuffers = bufferSize
+        if packetLen is None or packetLen > maxLen:
+            packetLen = maxLen
+
+        # The packets of each handle are built once, the data is a counting pattern
+        data = bytes(i & 0xFF for i in range(packetLen))
+        packets = [bytes([HCI_PACKET_ACL]) + ACL_HEADER.pack(handle & 0x0FFF, packetLen) + data
+                   for handle in handles]
+
+        with self.aclLock:
+            self.aclStats = {handle & 0x0FFF: AclStats(handle & 0x0FFF) for handle in handles}
+            self.aclBuffers = numBuffers
+            self.aclCredits = numBuffers
+            self.aclPacketLen = packetLen
+            self.aclActive = True
+        txStats = [self.aclStats[handle & 0x0FFF] for handle in handles]
+
+        deadline = monotonic() + seconds
+        try:
+            index = 0
+            while send:
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    break
+                with self.aclLock:
+                    if not self.aclLock.wait_for(lambda: self.aclCredits > 0, remaining):
+                        break
+                    count = self.aclCredits
+                    self.aclCredits = 0
+
+                batch = []
+                now = monotonic()
+                for _ in range(count):
+                    stats = txStats[index]
+                    if stats.txStart is None:
+                        stats.txStart = now
+                    stats.txPackets += 1
+                    batch.append(packets[index])
+                    index = (index + 1) % len(packets)
+                self.port.write(b"".join(batch))
+
+            if send:
+                # Wait for the packets still in the controller buffers
+                with self.aclLock:
+                    self.aclLock.wait_for(lambda: self.aclCredits >= self.aclBuffers, defaultAclDrainTimeout)
+            else:
+                sleep(max(0.0, deadline - monotonic()))
+        finally:
+            self.aclActive = False
+
+        return list(self.aclStats.values())
+
+    ## Host ACL function.
+    #
+    # Runs the host ACL throughput test and prints the goodput of each connection.
+    ################################################################################
+    def hostAclFunc(self, args):
+        handles = [int(handle, 0) for handle in args.handle]
+        packetLen = None
+        if args.packetLen:
+            packetLen = int(args.packetLen)
+
+        allStats = self.aclThroughput(handles, packetLen, float(args.time), send=not args.rx)
+        if allStats is None:
+            return None
+
+        for stats in allStats:
+            print(f"{self.id}  {stats}")
+        return allStats
+
+
+class BleHciConsole(HciReader):
     port = serial.Serial()
     serialPort = ""
 
@@ -135,6 +897,10 @@ class BleHciConsole:
             baudrate = defaultBaud
             if "baud" in params.keys():
                 baudrate = params['baud']
+
+            # Read the ports on this asyncio loop instead of threads, see HciReader
+            loop = params.get("loop")
+            portTimeout = 1.0 if loop is None else 0
             
             # Open serial port
             serialPort = params["serialPort"]
@@ -146,7 +912,7 @@ class BleHciConsole:
                 bytesize=serial.EIGHTBITS,
                 rtscts=False,
                 dsrdtr=False,
-                timeout=1.0
+                timeout=portTimeout
             )
             self.port.isOpen()
 
@@ -161,7 +927,7 @@ class BleHciConsole:
                         bytesize=serial.EIGHTBITS,
                         rtscts=False,
                         dsrdtr=False,
-                        timeout=1.0
+                        timeout=portTimeout
                     )
                     self.trace_port.isOpen()
 
@@ -174,9 +940,16 @@ class BleHciConsole:
             print(err)
             sys.exit(1)
 
+        self.startReader(loop)
+
         if self.trace_port != None:
-            TraceMsgThread = threading.Thread(target=self.monitorTraceMsg, daemon=True)
-            TraceMsgThread.start()
+            if loop is None:
+                TraceMsgThread = threading.Thread(target=self.monitorTraceMsg, daemon=True)
+                TraceMsgThread.start()
+            else:
+                self.traceLine = b""
+                self.traceFirst = True
+                self.addLoopReader(self.trace_port, self.readTraceMsg)
 
     ## Monitor the TRACE port
     #
@@ -195,6 +968,27 @@ class BleHciConsole:
                     else:
                         print(f'{str(datetime.datetime.now())} {self.id}  {msg}')
 
+    ## Read the TRACE port on the loop.
+    #
+    # Called by the event loop when the trace port has data, prints the complete lines.
+    ################################################################################
+    def readTraceMsg(self):
+        try:
+            self.traceLine += self.trace_port.read(max(1, self.trace_port.in_waiting))
+        except (serial.SerialException, OSError, TypeError, AttributeError):
+            self.loop.remove_reader(self.trace_port.fileno())
+            return
+
+        *lines, self.traceLine = self.traceLine.split(b"\n")
+        for line in lines:
+            msg = line.decode("utf-8", errors="replace").replace("\r", "")
+            if msg != "":
+                if self.traceFirst:
+                    print(f'\n{str(datetime.datetime.now())} {self.id}  {msg}')
+                    self.traceFirst = False
+                else:
+                    print(f'{str(datetime.datetime.now())} {self.id}  {msg}')
+
     def closeListenDiscon(self):
         # Close the listener thread if active
         self.listenDisconThread
@@ -217,6 +1011,9 @@ class BleHciConsole:
     ################################################################################
     def exitFunc(self, args):
 
+        # Stop the reader thread
+        self.stopReader()
+
         # Close the serial port
         if (self.port.open == True):
             self.port.flush()
@@ -237,86 +1034,61 @@ class BleHciConsole:
     ## Wait for an HCI event.
     #
     # Waits for an HCI event, optionally prints the received event.
-    # Will timeout on the serial port if nothing arrives.
+    # Returns the HciPacket, None if nothing arrives within the timeout.
     ################################################################################
-    def wait_event(self, print_evt=True, timeout=1.0, responded=""):
-        # Set the serial port timeout
-        self.port.timeout = timeout
-
-        # Receive the event
-        evt = self.port.read(size=1)
-        if (len(evt) == 0):
-            # TODO: Read flush
-            self.port.flush()
-            if responded == "":
+    def wait_event(self, print_evt=True, timeout=1.0, responded=None):
+        try:
+            packet = self.events.get(timeout=timeout)
+        except queue.Empty:
+            if responded is None:
                 #print(str(datetime.datetime.now()) + f" {self.id}< Error: response timeout")
                 pass
-            return ""
-
-        evt = int(codecs.encode(evt, 'hex_codec'), 16)
-        status_string = '%02X' % evt
-
-        # ACL data
-        if (evt == 2):
-            # Receive the rest of the header
-            hdr = self.port.read(size=4)
-            packet_len = hdr[2] + (hdr[3] << 8)
-            hdr = int(codecs.encode(hdr, 'hex_codec'), 16)
-            status_string += '%08X' % hdr
-
-        # HCI Event
-        elif (evt == 4):
-            # Receive the rest of the header
-            hdr = self.port.read(size=2)
-            packet_len = hdr[1]
-            hdr = int(codecs.encode(hdr, 'hex_codec'), 16)
-            status_string += '%04X' % hdr
-
-        else:
-            print("Error: unknown evt = " + str(evt))
-            return ""
-
-        payload = self.port.read(size=packet_len)
+            return None
 
         # Print the packet
         if (print_evt):
-            for i in range(0, packet_len):
-                status_string += '%02X' % payload[i]
-            print(str(datetime.datetime.now()) + f" {self.id}<", status_string)
+            self.printEvent(packet)
 
-        return status_string
+        return packet
 
     ## Wait for HCI events.
     #
     # Waits to receive HCI events, prints the timestamp every 30 seconds.
     ################################################################################
-    def wait_events(self, seconds=2, print_evt=True, last_resp=''):
+    def wait_events(self, seconds=2, print_evt=True, last_resp=None):
         # Read events from the device for a few seconds
         start_time = datetime.datetime.now()
         delta = datetime.datetime.now() - start_time
 
         while ((delta.seconds < seconds) or (seconds == 0)):
-            last_resp += self.wait_event(print_evt=print_evt, timeout=0.1, responded=last_resp)
+            evt = self.wait_event(print_evt=print_evt, timeout=0.1, responded=last_resp)
+            if evt is not None:
+                last_resp = evt
             delta = datetime.datetime.now() - start_time
             if ((delta.seconds > 30) and ((delta.seconds % 30) == 0)):
                 print(str(datetime.datetime.now()) + " |")
 
     ## Send HCI command.
     #
-    # Send a HCI command to the serial port. Will add a small delay and wait for
-    # and print an HCI event by default.
+    # Send a HCI command to the serial port. By default waits for and prints the
+    # Command Complete or Command Status of the command, and returns it as an
+    # HciPacket, None if the controller did not respond.
     ################################################################################
-    def send_command(self, packet, resp=True, delay=0.010, print_cmd=True):
-        sleep(delay)
+    def send_command(self, packet, resp=True, delay=0, print_cmd=True, timeout=defaultCmdTimeout):
+        if delay:
+            sleep(delay)
 
-        # Send the command and data
-        if print_cmd:
-            print(str(datetime.datetime.now()) + f" {self.id}> {packet}")
-        
-        self.port.write(bytearray.fromhex(packet))
+        future = self.send_command_async(packet, resp=resp, print_cmd=print_cmd, timeout=timeout)
+
+        if not resp:
+            return None
+
+        evt = self.waitResponse(future, timeout)
+        if evt is None:
+            return None
 
-        if resp:
-            return self.wait_event()
+        self.printEvent(evt)
+        return evt
 
     ## Parse connection stats event.
     #
@@ -328,19 +1100,9 @@ class BleHciConsole:
     ################################################################################
     def parseConnStatsEvt(self, evt):
         try:
-            # Offset into the event where the stats start, each stat is 32 bits, or
-            # 8 hex nibbles
-            i = 14
-            rxDataOk = int(evt[6 + i:8 + i] + evt[4 + i:6 + i] + evt[2 + i:4 + i] + evt[0 + i:2 + i], 16)
-            i += 8
-            rxDataCRC = int(evt[6 + i:8 + i] + evt[4 + i:6 + i] + evt[2 + i:4 + i] + evt[0 + i:2 + i], 16)
-            i += 8
-            rxDataTO = int(evt[6 + i:8 + i] + evt[4 + i:6 + i] + evt[2 + i:4 + i] + evt[0 + i:2 + i], 16)
-            i += 8
-            txData = int(evt[6 + i:8 + i] + evt[4 + i:6 + i] + evt[2 + i:4 + i] + evt[0 + i:2 + i], 16)
-            i += 8
-            errTrans = int(evt[6 + i:8 + i] + evt[4 + i:6 + i] + evt[2 + i:4 + i] + evt[0 + i:2 + i], 16)
-        except ValueError as err:
+            # The stats are 32 bit values after the status
+            rxDataOk, rxDataCRC, rxDataTO, txData, errTrans = CONN_STATS.unpack_from(evt.params)
+        except (AttributeError, struct.error) as err:
             print(err)
             return None
 
@@ -371,7 +1133,7 @@ class BleHciConsole:
             evt = self.wait_event(timeout=0.1)
             if (self.listenDisconStop):
                 sys.exit(1)
-            if ("040504" in evt):
+            if evt is not None and isDisconnectionComplete(evt):
                 if (self.listenDisconCommand != ""):
                     self.send_command(listenDisconCommand)
 
@@ -385,56 +1147,22 @@ class BleHciConsole:
     #  Sets the public BD address for the device.
     ################################################################################
     def addrFunc(self, args):
-        # Reorder the address
-        addrBytes = parseBdAddr(args.addr)
-
         # Send the vendor specific set address command
-        self.send_command("01F0FF06" + addrBytes)
+        self.send_command(addrCommand(args.addr))
 
     ## Start advertising function.
     #
     # Sends HCI commands to start advertising.
     ################################################################################
     def advFunc(self, args):
-        # Bogus address to use for commands, allows any peer to connect
-        peer_addr = "000000000000"
-
-        # Setup the event masks
-        self.send_command("01010C08FFFFFFFFFFFFFFFF")
-        self.send_command("01630C08FFFFFFFFFFFFFFFF")
-        self.send_command("01010C08FFFFFFFFFFFFFFFF")
-        self.send_command("01012008FFFFFFFFFFFFFFFF")
-
-        # Reset the connection stats
-        if (args.stats):
-            self.send_command("0102FF00")
-
-        # Set default PHY to enable all PHYs
-        self.send_command("01312003" + "00" + "07" + "07")
+        # Setup the event masks, reset the connection stats, enable all PHYs
+        for cmd in setupCommands(args.stats):
+            self.send_command(cmd)
 
-        advType = "03"  # Non connectable undirected advertising (ADV_NONCONN_IND)
-        if (args.connect == "True"):
-            advType = "00"  # Connectable and scannable undirected advertising (ADV_IND)
-
-        # Convert advertising interval string to int
-        advIntervalInt = int(args.interval, 16)
-
-        # Convert int to 2 hex bytes, LSB first
-        advInterval = "%0.2X" % (advIntervalInt & 0xFF)
-        advInterval += "%0.2X" % ((advIntervalInt & 0xFF00) >> 8)
-
-        # LeSetAdvParam(Advertising_Interval_Min=advInterval,
-        # Advertising_Interval_Max=advInterval,
-        # Advertising_Type=advType,
-        # Own_Address_Type=0 (public),
-        # Peer_Address_Type=0 (public),
-        # Peer_Address=peer_addr,
-        # Advertising_Channel_Map=7 (all 3 advertising channels),
-        # Advertising_Filter_Policy=0 (don't do any filtering))
-        self.send_command("0106200F" + advInterval + advInterval + advType + "0000" + peer_addr + "0700")
+        self.send_command(advParamCommand(args.interval, args.connect == "True"))
 
         # Start advertising
-        connCommand = "010A200101"
+        connCommand = HCI_CMD_ADV_ENABLE
 
         # Start a thread to listen for disconnection events and restart advertising
         if (args.maintain == True):
@@ -489,10 +1217,8 @@ class BleHciConsole:
     def scanFunc(self, args):
 
         # Setup the event masks
-        self.send_command("01010C08FFFFFFFFFFFFFFFF")
-        self.send_command("01630C08FFFFFFFFFFFFFFFF")
-        self.send_command("01010C08FFFFFFFFFFFFFFFF")
-        self.send_command("01012008FFFFFFFFFFFFFFFF")
+        for cmd in HCI_CMDS_EVENT_MASKS:
+            self.send_command(cmd)
 
         # Set scan parameters
         # Active scanning
@@ -512,40 +1238,12 @@ class BleHciConsole:
     # Sends HCI commands to start initiating and create a connection.
     ################################################################################
     def initFunc(self, args):
-        # Reorder the address
-        addrBytes = parseBdAddr(args.addr)
-
-        # Setup the event masks
-        self.send_command("01010C08FFFFFFFFFFFFFFFF")
-        self.send_command("01630C08FFFFFFFFFFFFFFFF")
-        self.send_command("01010C08FFFFFFFFFFFFFFFF")
-        self.send_command("01012008FFFFFFFFFFFFFFFF")
-
-        # Reset the connection stats
-        if (args.stats):
-            self.send_command("0102FF00")
-
-        # Set default PHY to enable all PHYs
-        self.send_command("01312003" + "00" + "07" + "07")
-
-        # Convert connection interval string to int
-        connIntervalInt = int(args.interval, 16)
-
-        # Convert int to 2 hex bytes, LSB first
-        connInterval = "%0.2X" % (connIntervalInt & 0xFF)
-        connInterval += "%0.2X" % ((connIntervalInt & 0xFF00) >> 8)
-
-        # Convert supervision timeout string to int
-        supTimeoutInt = int(args.timeout, 16)
-
-        # Convert int to 2 hex bytes, LSB first
-        supTimeout = "%0.2X" % (supTimeoutInt & 0xFF)
-        supTimeout += "%0.2X" % ((supTimeoutInt & 0xFF00) >> 8)
+        # Setup the event masks, reset the connection stats, enable all PHYs
+        for cmd in setupCommands(args.stats):
+            self.send_command(cmd)
 
         # Create the connection, using a public address for peer and local
-        ownAddrType = "00"
-        connLatency = "0000"
-        connCommand = "010D2019A000A00000" + "00" + addrBytes + ownAddrType + connInterval + connInterval + connLatency + supTimeout + "0F100F10"
+        connCommand = createConnCommand(args.addr, args.interval, args.timeout)
 
         # Start a thread to listen for disconnection events and restart the connection
         if (args.maintain == True):
@@ -635,21 +1333,7 @@ class BleHciConsole:
     # Assumes we're using connection handle 0000
     ################################################################################
     def phyFunc(self, args):
-        # Convert PHY options to bits
-        phy = "01"
-        phyOptions = "0000"
-        if (args.phy == "4"):
-            phy = "04"
-            phyOptions = "0100"
-        elif (args.phy == "3"):
-            phy = "04"
-            phyOptions = "0200"
-        elif (args.phy == "2"):
-            phy = "02"
-        elif (args.phy != "1"):
-            print("Invalid PHY selection, using 1M")
-
-        res = self.send_command("01322007" + "0000" + "00" + phy + phy + phyOptions)
+        res = self.send_command(phyCommand(args.phy))
         self.wait_events(3, last_resp=res)
 
     ## Rest function.
@@ -662,7 +1346,7 @@ class BleHciConsole:
         self.closeListenDiscon()
 
         # Send the HCI command for HCI Reset
-        self.send_command("01030C00")
+        self.send_command(HCI_CMD_RESET)
 
     ## Listen for events.
     #
@@ -742,11 +1426,13 @@ class BleHciConsole:
     ################################################################################
     def endTestFunc(self, args):
         # Send the end test command, store the event
-        evtString = self.send_command("011F2000")
+        evt = self.send_command("011F2000")
+        if evt is None or len(evt.params) < TEST_END.size:
+            print("Error: no test end event")
+            return None
 
         # Parse the event and print the number of received packets
-        evtData = int(evtString, 16)
-        rxPackets = int((evtData & 0xFF00) >> 8) + int((evtData & 0xFF) << 8)
+        rxPackets = TEST_END.unpack_from(evt.params)[0]
         print("Received PKTS  : " + str(rxPackets))
         return rxPackets
 
@@ -777,7 +1463,7 @@ class BleHciConsole:
     ################################################################################
     def disconFunc(self, args):
         # Send the disconnect command, handle 0, reason 0x16 Local Host Term
-        self.send_command("01060403000016")
+        self.send_command(HCI_CMD_DISCONNECT)
 
     ## Set channel map function.
     #
@@ -846,14 +1532,13 @@ class BleHciConsole:
         totalLen = "%0.2X" % (1 + 4)
 
         # Send the command and save the event
-        evtString = self.send_command("0101FF" + totalLen + readLenString + addrBytes)
-
-        # Get the data
-        evtString = evtString[14:]
+        evt = self.send_command("0101FF" + totalLen + readLenString + addrBytes)
+        if evt is None:
+            print("Error: no response")
+            return None
 
-        # Split the data into bytes
-        chunks, chunk_size = len(evtString), 2
-        evtBytes = [evtString[i:i + chunk_size] for i in range(0, chunks, chunk_size)]
+        # Get the data, after the status
+        evtBytes = bytes(evt.params)
 
         # Print the data
         startingAddr = int(args.addr, 16)
@@ -875,10 +1560,10 @@ class BleHciConsole:
             lineAddr = int(i / 4) * 4 + (4 - (i % 4)) - 1
 
             # Print spaces if we're padding the length
-            if (lineAddr >= readLen):
+            if (lineAddr >= readLen) or (lineAddr >= len(evtBytes)):
                 print("__", end="")
             else:
-                print(evtBytes[lineAddr], end="")
+                print("%0.2X" % evtBytes[lineAddr], end="")
 
             # Print a new line at the end of the 32 bit value
             if (i % 4 == 3):
@@ -119,6 +119,17 @@ class BleHciParser:
                                          formatter_class=argparse.RawTextHelpFormatter)
         sinkAcl_parser.set_defaults(func=self.hci_console.sinkAclFunc)
 
+        # parser for cmd "hostAcl"
+        hostAcl_parser = subs.add_parser('hostAcl', description="Send and sink ACL packets from the host, print the "
+                                         "throughput", formatter_class=argparse.RawTextHelpFormatter)
+        hostAcl_parser.add_argument('packetLen', nargs='?', default=None,
+                                    help="Number of bytes per ACL packet, decimal, default: controller buffer size")
+        hostAcl_parser.add_argument('-t', '--time', default="10", help="Seconds to run the test, default: 10")
+        hostAcl_parser.add_argument('--handle', nargs='+', default=["0"],
+                                    help="Connection handles to send to, round robin, default: 0")
+        hostAcl_parser.add_argument('--rx', action='store_true', help="Only sink the received ACL packets")
+        hostAcl_parser.set_defaults(func=self.hci_console.hostAclFunc)
+
         # parser for cmd "connStats"
         connStats_parser = subs.add_parser('connStats', help="Get the connection stats",
                                            formatter_class=argparse.RawTextHelpFormatter)
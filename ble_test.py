@@ -39,19 +39,20 @@ indicate which DUT the commands would go to. The input command format is:
 "DUT_ID command_str", in which DUT_ID is 0-based.
 """
 
-from ble_auto_testing import convert_pcap_to_pcapng, get_args
+from ble_auto_testing import get_args
+from ble_hci_async import HciLoop
 import datetime
 import io
-from nrf_sniffer_ble import capture_write, run_sniffer as exe_sniffer
+from nrf_sniffer_ble import capture_write, run_sniffer as exe_sniffer, stop_capture
 import os
 from os.path import exists
-from SnifferAPI import Packet
-from SnifferAPI.Packet import all_tifs
+from SnifferAPI.TimingAnalyzer import TimingAnalyzer, TIFS_MIN, TIFS_MAX, PHY_SWITCH_TIME_MAX, CONN_TIMING_MAX
+from SnifferAPI.LiveTimingAnalyzer import LiveTimingAnalyzer
+from SnifferAPI.PcapReader import CaptureFileReader
 from pcapng_file_parser import parse_pcapng_file
 from pprint import pprint
 from queue import Queue
 import shutil
-import statistics
 from subprocess import call, Popen, PIPE, CalledProcessError, STDOUT
 import sys
 from terminal import Terminal
@@ -111,11 +112,12 @@ def start_threads(sp0, sp1, tp0, tp1):
     terminal_thread = Terminal("terminal_thread")
     all_threads.append(terminal_thread)
 
-    # prepare the BLE HCI consoles
-    params = {'serialPort': sp0, 'monPort': tp0, 'id': "1"}
+    # prepare the BLE HCI consoles, one event loop reads the HCI and trace ports of both boards
+    hci_loop = HciLoop()
+    params = {'serialPort': sp0, 'monPort': tp0, 'id': "1", 'loop': hci_loop.loop}
     index = terminal_thread.add_hci_parser(params)
     #params['serialPort'] = sp1
-    params = {'serialPort': sp1, 'monPort': tp1, 'id': "2"}
+    params = {'serialPort': sp1, 'monPort': tp1, 'id': "2", 'loop': hci_loop.loop}
     index = terminal_thread.add_hci_parser(params)
 
     main_thread = threading.Thread(target=start_main, args=(all_threads, terminal_thread))
@@ -146,21 +148,18 @@ def phy_timing_test(terminal_thd, addr1, addr2, new_phy):
 
     time.sleep(0.5)
 
+    # The commands return when the controller responded to them, no delay is needed between them
     print(f'\nmaster: reset\n')
     terminal_thd.input_cmd(0, "reset")
-    time.sleep(0.5)
 
     print(f'\nslave: reset\n')
     terminal_thd.input_cmd(1, "reset")
-    time.sleep(0.5)
 
     print(f'\nmaster: set address {addr1}\n')
     terminal_thd.input_cmd(0, "addr " + addr1)
-    time.sleep(0.5)
 
     print(f'\nslave: set address {addr2}\n')
     terminal_thd.input_cmd(1, "addr " + addr2)
-    time.sleep(0.5)
 
     print(f'\nmaster: start to advertise\n')
     terminal_thd.input_cmd(0, "adv -l 5 -i 20")
@@ -181,18 +180,17 @@ def phy_timing_test(terminal_thd, addr1, addr2, new_phy):
 
     print(f'\nmaster: reset\n')
     terminal_thd.input_cmd(0, "reset")
-    time.sleep(0.5)
 
     print(f'\nslave: reset\n')
     terminal_thd.input_cmd(1, "reset")
-    time.sleep(0.5)
 
     terminal_thd.input = "exit"
 
     print(f'\n<<<<<< Finish PHY timing test ({phy_cmd[new_phy - 1]}).\n')
 
 
-def run_sniffer(interface_name: str, device_name: str, dev_adv_addr: str, timeout: int, queue: Queue) -> dict:
+def run_sniffer(interface_name: str, device_name: str, dev_adv_addr: str, timeout: int, queue: Queue,
+                captured_file: str = None, timing_analyzer: LiveTimingAnalyzer = None) -> dict:
     """Run the BLE packet sniffer on specified interface and device
 
         Example command:
@@ -214,7 +212,9 @@ def run_sniffer(interface_name: str, device_name: str, dev_adv_addr: str, timeou
             device_name: the BLE device name
             dev_adv_addr: the device advertising address in the BLE packet
             timeout: how long the sniffer should run
-            captured_file: the saved captured file path
+            queue: the captured file path is put in it when the sniffer finished
+            captured_file: the path to save the captured file to, a new file in output/ if None
+            timing_analyzer: analyzes the packets while they are captured
 
         Returns:
             None
@@ -232,6 +232,8 @@ def run_sniffer(interface_name: str, device_name: str, dev_adv_addr: str, timeou
     params["extcap_control_out"] = "EXTCAP_CONTROL_OUT"
     params["timeout"] = timeout
     params["dev_addr"] = dev_adv_addr
+    params["given_name"] = captured_file
+    params["timing_analyzer"] = timing_analyzer
 
     print(f'\nwait 3 secs for the reset and set addresses for boards')
     time.sleep(3)
@@ -244,6 +246,24 @@ def run_sniffer(interface_name: str, device_name: str, dev_adv_addr: str, timeou
     print(f'{str(datetime.datetime.now())} - Sniffer finished.')
 
 
+def stop_failed_test(failure: str):
+    """Stop the sniffer at the first failure found by the live timing analysis."""
+    print(f'\n{str(datetime.datetime.now())} - Test failed, stop the sniffer: {failure}\n')
+    stop_capture.set()
+
+
+def live_results_complete(live_analyzer: LiveTimingAnalyzer, captured_file: str) -> bool:
+    """True when the live timing analysis saw every packet saved in the captured file."""
+    if live_analyzer.packets == 0:
+        return False
+    with CaptureFileReader(captured_file) as reader:
+        saved = len(reader.index())
+    if live_analyzer.packets < saved:
+        print(f'Live timing analysis saw {live_analyzer.packets} of {saved} packets, parse the captured file.')
+        return False
+    return True
+
+
 def run_phy_timing_test(args, new_phy):
     if args.interface is None:
         interface = '/dev/ttyACM0-None'
@@ -282,7 +302,11 @@ def run_phy_timing_test(args, new_phy):
 
     term_thread = start_threads(sp0, sp1, args.tp0, args.tp1)
 
-    sniffer_thd = threading.Thread(target=run_sniffer, args=(interface, device, brd0_addr, timeout, q))
+    # The packets are analyzed while they are captured, so that the sniffer can stop as soon as the test fails
+    live_analyzer = LiveTimingAnalyzer(on_failure=stop_failed_test)
+
+    sniffer_thd = threading.Thread(target=run_sniffer,
+                                   args=(interface, device, brd0_addr, timeout, q, None, live_analyzer))
     sniffer_thd.daemon = True
     sniffer_thd.start()
 
@@ -290,34 +314,39 @@ def run_phy_timing_test(args, new_phy):
 
     sniffer_thd.join()  # wait the test to finish
 
+    for msg in live_analyzer.messages:
+        print(msg)
+
     if q.empty():  # check if there is captured file
-        return None
+        return None, None
     else:
         pcap_file = q.get()
         print(f'{str(datetime.datetime.now())} - Captured file: {pcap_file}')
 
         if exists(pcap_file):
-            # Need to convert pcap file to pcapng format.
-            pcapng_file = pcap_file.replace(".pcap", ".pcapng")
-            # "C:\\Program Files\\Wireshark\\tshark.exe"
-            convert_pcap_to_pcapng(pcap_file, pcapng_file, "/usr/bin/tshark")
-
-            return pcapng_file
+            # Without complete live results full_test() parses the file, it reads pcap directly.
+            if not live_results_complete(live_analyzer, pcap_file):
+                return pcap_file, None
+            return pcap_file, live_analyzer.analyzer
+        return None, None
 
 
 def parse_phy_timing_test_results(src, captured_file: str):
     """
     src
         0: wireshark saved pcapng file
-        1: ble_auto_testing captured pcap file, converted to pcapng
+        1: ble_auto_testing captured pcap file, or that file converted to pcapng
     """
     file_type = src  # see parse_pcapng_file() description
-    res = parse_pcapng_file(file_type, captured_file)
-    return res
+    analyzer = parse_pcapng_file(file_type, captured_file)
+    return analyzer
 
 
-def check_results(new_phy):
-    global all_tifs
+def check_results(new_phy, analyzer=None):
+    """Check the results of parse_phy_timing_test_results(), no analyzer means nothing was parsed."""
+    if analyzer is None:
+        analyzer = TimingAnalyzer()
+    tifs = analyzer.tifs
 
     phy_cmd = ["1M", "2M", "S8", "S2"]
     res = 0
@@ -325,27 +354,22 @@ def check_results(new_phy):
     #
     # check T_IFS
     #
-    if len(all_tifs) > 0:
-        first_readings = min(20, len(all_tifs))
-        print(f'The first {first_readings} readings:\n{all_tifs[0:first_readings]}')
-
-        max_tifs = max(all_tifs)
-        min_tifs = min(all_tifs)
-        avg = sum(all_tifs) / len(all_tifs)
+    if tifs.count > 0:
+        print(f'The first {len(tifs.first)} readings:\n{tifs.first}')
 
-        print(f'TIFS, total: {len(all_tifs)}, max: {max_tifs} at {all_tifs.index(max_tifs)}, '
-              f'min: {min_tifs} at {all_tifs.index(min_tifs)}, average: {avg:.1f}, median: {statistics.median(all_tifs)}')
+        print(f'TIFS, total: {tifs.count}, max: {tifs.max} at {tifs.maxIndex}, '
+              f'min: {tifs.min} at {tifs.minIndex}, average: {tifs.mean:.1f}, median: {tifs.median()}')
+        print(f'TIFS, stdev: {tifs.stdev:.2f}, p1: {tifs.quantile(0.01)}, p99: {tifs.quantile(0.99)}, '
+              f'below {TIFS_MIN}: {tifs.belowSpec}, above {TIFS_MAX}: {tifs.aboveSpec}')
 
         print(f"\n\n-------------------------------------------------------------------")
         print(f'                              PHY: {phy_cmd[new_phy - 1]}')
-        if max_tifs <= 152 and min_tifs >= 148:
+        if tifs.inSpec:
             print("                TIFS verification: PASS")
             res = 0
         else:
             print("                TIFS verification: FAIL")
             res = 1
-        
-        all_tifs.clear()  # clear for the next test
     else:
         print("No TIFS captured.")
         res = 2
@@ -353,11 +377,11 @@ def check_results(new_phy):
     #
     # check PHY switch time
     #
-    if Packet.phy_switch_time is None:
+    if analyzer.phy_switch_time is None:
         print("phy_switch_time is None.")
         res = 2
     else:
-        if Packet.phy_switch_time > 70.0 / 1E3:  # ms
+        if analyzer.phy_switch_time > PHY_SWITCH_TIME_MAX:
             print(f'PHY switch time verification ({phy_cmd[new_phy - 1]}): FAIL')
             res = 3
         else:
@@ -366,11 +390,11 @@ def check_results(new_phy):
     #
     # check connection timing
     #
-    if Packet.conn_timing_time is None:
+    if analyzer.conn_timing_time is None:
         print("connection_timing_time is None.")
         res = 2
     else:
-        if Packet.conn_timing_time > 8800:  # 8750
+        if analyzer.conn_timing_time > CONN_TIMING_MAX:  # 8750
             print(f'   Connection timing verification: FAIL')
             res = 4
         else:
@@ -384,21 +408,22 @@ def check_results(new_phy):
 def full_test(args, parse_captured_file, new_phy):
     global failed_files
     
+    analyzer = None
     if parse_captured_file:
         #captured_file = "/home/ying-cai/temp_one_time_use/ci_results/dev-ttyACM1-None__2022-12-06_14-29-12.pcapng"
         captured_file = "/home/ying-cai/Workspace/ble_auto_testing/output/dev-ttyACM0-None__2022-12-06_14-52-01.pcapng"
     else:
         # This test includes the connection, T_IFS, and PHY switch tests.
-        captured_file = run_phy_timing_test(args, new_phy)
+        captured_file, analyzer = run_phy_timing_test(args, new_phy)
         print(f'captured_file: {captured_file}')
 
     if captured_file is not None:
-        if exists(captured_file):
+        if analyzer is None and exists(captured_file):
             # for sniffer nrf version 4.1.0, there src type 0 although it is from pcap converted
             #                         4.0.0, src type 1
-            parse_phy_timing_test_results(0, captured_file)
+            analyzer = parse_phy_timing_test_results(0, captured_file)
 
-        res = check_results(new_phy)
+        res = check_results(new_phy, analyzer)
     else:
         res = 2
 
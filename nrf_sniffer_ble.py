@@ -47,10 +47,12 @@ import argparse
 import re
 import time
 import struct
+import threading
 import logging
 from pprint import pprint
 from SnifferAPI import Logger
-from SnifferAPI import Sniffer, UART, Devices, Pcap, Exceptions
+from SnifferAPI import Sniffer, UART, Devices, Pcap, Exceptions, Trace
+from SnifferAPI.Trace import tracer
 
 try:
     import serial
@@ -96,6 +98,8 @@ CTRL_KEY_TYPE_ADD_ADDR = 6
 CTRL_KEY_TYPE_FOLLOW_ADDR = 7
 
 fn_capture = None
+# Encodes the packets for the capture pipe, only used on the sniffer capture writer thread
+capture_encoder = Pcap.PacketEncoder()
 fn_ctrl_in = None
 fn_ctrl_out = None
 
@@ -122,6 +126,9 @@ last_parsed_packet_time = None
 # The RSSI capture filter value given from Wireshark.
 rssi_filter = 0
 
+# Set to end an automatic test capture before its timeout, e.g. when the test already failed.
+stop_capture = threading.Event()
+
 # The RSSI filtering is not on when in follow mode.
 in_follow_mode = False
 
@@ -270,18 +277,19 @@ def capture_write(message):
     fn_capture.flush()
 
 
-def new_packet(notification):
-    """A new Bluetooth LE packet has arrived"""
+def new_packet(packet):
+    """A new Bluetooth LE packet has arrived, called on the sniffer capture writer thread"""
     global last_parsed_packet_time
 
     if write_new_packets:
-        packet = notification.msg["packet"]
         last_parsed_packet_time = packet.time
 
         if rssi_filter == 0 or in_follow_mode is True or packet.RSSI > rssi_filter:
-            p = bytes([packet.boardId] + packet.getList())
-            capture_write(Pcap.create_packet(p, packet.time))
-            # TRACE: 130
+            capture_encoder.add_packet(packet)
+            capture_encoder.write_to(fn_capture)
+            fn_capture.flush()
+            if tracer.verbose:
+                tracer.trace(Trace.VERBOSE, Trace.CAT_CAPTURE, "130", "fifo packet %d", packet.packetCounter)
 
 
 def device_added(notification):
@@ -631,12 +639,17 @@ def teardown_extcap_log_handler():
 
 
 def sniffer_capture(interface, baudrate, fifo, control_in, control_out, auto_test=False, timeout=120, given_name=None,
-                    target_device=None, target_given_addr=None):
-    """Start the sniffer to capture packets"""
+                    target_device=None, target_given_addr=None, timing_analyzer=None):
+    """Start the sniffer to capture packets
+
+        timing_analyzer is an optional LiveTimingAnalyzer, which analyzes the packets while they are captured.
+    """
     global fn_capture, fn_ctrl_in, fn_ctrl_out, write_new_packets, extcap_log_handler
 
     sniffer = None
 
+    stop_capture.clear()
+
     try:
         fn_capture = open(fifo, 'wb', 0)
 
@@ -659,11 +672,13 @@ def sniffer_capture(interface, baudrate, fifo, control_in, control_out, auto_tes
             baudrate = get_default_baudrate(interface, fifo)
 
         sniffer = Sniffer.Sniffer(interface, baudrate, auto_test=auto_test, given_name=given_name)
-        sniffer.subscribe("NEW_BLE_PACKET", new_packet)
+        sniffer.addCaptureSink(new_packet)
         sniffer.subscribe("DEVICE_ADDED", device_added)
         sniffer.subscribe("DEVICE_UPDATED", device_added)
         sniffer.subscribe("DEVICE_REMOVED", device_removed)
         sniffer.subscribe("DEVICES_CLEARED", devices_cleared)
+        if timing_analyzer is not None:
+            timing_analyzer.attach(sniffer)
         sniffer.setAdvHopSequence([37, 38, 39])
         sniffer.setSupportedProtocolVersion(get_supported_protocol_version(extcap_version))
         logging.info("Sniffer created")
@@ -735,8 +750,10 @@ def sniffer_capture(interface, baudrate, fifo, control_in, control_out, auto_tes
                         print(f' curr time: {time.ctime(curr)}')
                         print(f'delta secs: {delta_secs} > {timeout}\n')
                         break
-                    
-                    time.sleep(1)
+
+                    if stop_capture.wait(1):
+                        print(f'\ncapture stopped after {delta_secs:.0f} secs\n')
+                        break
         else:
             logging.info("")
             # Start receiving packets
@@ -749,7 +766,7 @@ def sniffer_capture(interface, baudrate, fifo, control_in, control_out, auto_tes
                 if auto_test:
                     curr = time.time()
                     delta_secs = curr - start_time
-                    if delta_secs > timeout:
+                    if delta_secs > timeout or stop_capture.is_set():
                         logging.info(f'end time: {time.ctime(curr)}, totally {delta_secs:.0f} secs.')
                         logging.info("")
                         break
@@ -771,6 +788,8 @@ def sniffer_capture(interface, baudrate, fifo, control_in, control_out, auto_tes
         # Safe to use logging again.
         if sniffer:
             sniffer.doExit("sniffer_capture() finally")
+            if timing_analyzer is not None:
+                timing_analyzer.detach()
 
         if fn_capture is not None and not fn_capture.closed:
             fn_capture.close()
@@ -834,11 +853,26 @@ def goodbye():
     logging.info("Exiting PID {}".format(os.getpid()))
 
 
+def auto_test_capture_file(interface):
+    """The pcap file name of an automatic test capture on the interface, in the output directory"""
+    if interface[0] == '/':
+        name = interface[1:].replace("/", "-")
+    else:
+        name = interface.replace("/", "-")
+
+    name = name + "_" + "_" \
+           + datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S") + ".pcap"
+    # base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    base_dir = os.getcwd()
+    return os.path.join(base_dir, "output", name)
+
+
 def run_sniffer(params: dict):
     """Run the sniffer with input arguments
 
         Args:
-            params: the dict from input arguments
+            params: the dict from input arguments, with the automatic test, "given_name" can set the pcap file name
+                    and "timing_analyzer" a LiveTimingAnalyzer for the captured packets
 
         Returns:
             pcap file name
@@ -857,16 +891,7 @@ def run_sniffer(params: dict):
     try:
         logging.info(f'sniffer capture: {params}')
         if params["auto_test"]:
-            if interface[0] == '/':
-                name = interface[1:].replace("/", "-")
-            else:
-                name = interface.replace("/", "-")
-
-            name = name + "_" + "_" \
-                   + datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S") + ".pcap"
-            # base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-            base_dir = os.getcwd()
-            given_name = os.path.join(base_dir, "output", name)
+            given_name = params.get("given_name") or auto_test_capture_file(interface)
             print(f'\ncaptured file will be saved to: {given_name}\n')
         else:
             given_name = None
@@ -874,7 +899,8 @@ def run_sniffer(params: dict):
         sniffer_capture(interface, params["baudrate"], params["fifo"], params["extcap_control_in"],
                         params["extcap_control_out"], auto_test=params["auto_test"],
                         timeout=params["timeout"], given_name=given_name,
-                        target_device=params["device"], target_given_addr=params["dev_addr"])
+                        target_device=params["device"], target_given_addr=params["dev_addr"],
+                        timing_analyzer=params.get("timing_analyzer"))
     except KeyboardInterrupt:
         pass
     except Exception as e:
@@ -948,6 +974,12 @@ def parse_args():
     parser.add_argument("--timeout", type=int, help="timeout in secs for automatic test, default 120 secs", default=120)
     parser.add_argument("--dev-addr", help="device advertising address")
 
+    # Debug trace of the sniffer packet processing
+    parser.add_argument("--trace", choices=list(Trace.LEVEL_NAMES), default="off",
+                        help="trace level, printed and kept for the log on sniffer errors, default off")
+    parser.add_argument("--trace-categories", help="comma separated trace categories (%s), default all"
+                        % ",".join(Trace.CATEGORIES))
+
     logging.info("Started PID {}".format(os.getpid()))
 
     try:
@@ -973,6 +1005,10 @@ def parse_args():
     if len(sys.argv) <= 1:
         parser.exit("No arguments given!")
 
+    if args.trace != "off":
+        tracer.configure(level=args.trace, console=True, ringSize=Trace.DEFAULT_RING_SIZE,
+                         categories=args.trace_categories.split(",") if args.trace_categories else None)
+
     if args.extcap_version:
         extcap_version = args.extcap_version
 
@@ -3,141 +3,318 @@
 # @see https://github.com/pcapng/pcapng
 # @see https://www.tcpdump.org/linktypes/LINKTYPE_NORDIC_BLE.html
 #
-import copy
-from datetime import datetime
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import contextlib
+import glob
+import json
+import threading
 import logging
 import os
 from os.path import exists
-from SnifferAPI import Logger, Packet, Exceptions, SnifferCollector
+from SnifferAPI import Packet, PcapReader, Exceptions
+from SnifferAPI.TimingAnalyzer import TimingAnalyzer
 from SnifferAPI.Types import *
 import time
-from SnifferAPI.Packet import all_tifs
 import sys
-from pcapng import FileScanner
-from SnifferAPI.Packet import test_log
 
-def parse_pcapng_file(file_type, file):
-    """parse the saved pcapng file.
-        @see [python-pcapng wireshark 包解析](https://blog.csdn.net/weifengdq/article/details/117751828)
+CAPTURE_PATTERNS = ("*.pcapng", "*.pcap")
+# Seconds between reads of a capture file which is being written
+DEFAULT_POLL_INTERVAL = 0.2
+
+
+def parse_record(packet_reader, file_type, timestamp, packet_data):
+    """parse one capture file record, the board ID byte followed by the sniffer UART packet."""
+    try:
+        packet_list = bytes(packet_data[1:])
+        packet = Packet.Packet(packet_list, is_parser=True, packet_reader=packet_reader,
+                               file_type=file_type, packet_time_from_pcap=timestamp)
+
+        if packet.valid:
+            packet_reader.handlePacketCompatibility(packet)
+
+        if packet is None or not packet.valid:
+            raise Exceptions.InvalidPacketException("")
+    except Exceptions.InvalidPacketException:
+        pass
+    else:
+        if packet.id == EVENT_PACKET_DATA_PDU or packet.id == EVENT_PACKET_ADV_PDU:
+            pass
+        elif packet.id == EVENT_FOLLOW:
+            # This packet has no value for the user.
+            pass
+        elif packet.id == EVENT_CONNECT:
+            pass
+        elif packet.id == EVENT_DISCONNECT:
+            pass
+        elif packet.id == SWITCH_BAUD_RATE_RESP:
+            pass
+        elif packet.id == PING_RESP:
+            if hasattr(packet, 'version'):
+                versions = {1116: '3.1.0',
+                            1115: '3.0.0',
+                            1114: '2.0.0',
+                            1113: '2.0.0-beta-3',
+                            1112: '2.0.0-beta-1'}
+                fwversion = versions.get(packet.version, 'SVN rev: %d' % packet.version)
+                print(f'fw version: {fwversion}')
+        elif packet.id == RESP_VERSION:
+            pass
+        elif packet.id == RESP_TIMESTAMP:
+            """
+            # Use current time as timestamp reference
+            packet_reader._last_time = time.time()
+            packet_reader._last_timestamp = packet.timestamp
+
+            lt = time.localtime(packet_reader._last_time)
+            usecs = int((packet_reader._last_time - int(packet_reader._last_time)) * 1_000_000)
+            logging.info(f'Firmware timestamp {packet_reader._last_timestamp} reference: '
+                         f'{time.strftime("%b %d %Y %X", lt)}.{usecs} {time.strftime("%Z", lt)}')
+            """
+        else:
+            logging.info("Unknown packet ID")
+
+        packet_reader.handlePacketHistory(packet)  # Will save this packet as last packet
+
+
+def parse_pcapng_file(file_type, file, analyzer=None):
+    """parse the saved pcap or pcapng file.
 
         Args:
             file_type:
                 0: Wireshark saved pcapng file
-                1: pcap file converted pcapng file
-            file: the saved sniffer pcapng file name with path
+                1: pcap file captured by the sniffer, or that file converted to pcapng
+            file: the saved sniffer pcap or pcapng file name with path
+            analyzer: the TimingAnalyzer to use, a new one if None
+
+        Returns:
+            the TimingAnalyzer with the T_IFS, PHY switch and connection timing results
     """
+    if analyzer is None:
+        analyzer = TimingAnalyzer()
+
     #
     # utilize the nRF sniffer code
     #
-    packet_reader = Packet.PacketReader(pcapng_parser=True)
-
-    with open(file, 'rb') as fp:
-        scanner = FileScanner(fp)
-        block_ndx = 1
-        packet_ndx = 1
-        for block in scanner:
-            if block_ndx == 1:  # SectionHeader 信息(cpu, os, wireshark version等)
-                # print(f'1st block: {block}')
-                block_ndx = 2
-            elif block_ndx == 2:  # InterfaceDescription, 主要是接口的信息, 如以太网网卡信息等
-                # print(f'2nd block: {block}')
-                block_ndx = 3
-            else:  # EnhancedPacket
-                # <EnhancedPacket interface_id=0 timestamp_high=377899 timestamp_low=1033621862 packet_payload_info=(
-                # 93, 93, b'\x11"3DUfH\xb0-\x13G*\x08\x00E\x00\x00O^e@\x00@\x11NN\xc0\xa8\x06B\xc0\xa8\x06X\xe2\x15
-                # \x0f\xa1\x00;\xbc\xd3\xaa\x00\x00\x00\x19\x02\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00
-                # \x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00
-                # \x00\x00\x00\x00\x00\x00\x00\x00') options=Options({})>
-                # <EnhancedPacket interface_id=0
-                # timestamp_high=386514 timestamp_low=3889417204 captured_len=43 packet_len=43
-                # packet_data=b'\x07$\x00\x03@\x10\x02\n\x01%.\x00\x00\x000\x82\x01\xd6\xbe\x89\x8e\x00\x11\xd8R\x04
-                # \x80\x18\x00\x02\x01\x06\x07\tPeriphs5\xec' options=Options({})> print(f'{packet_ndx:>6}: {
-                # block.timestamp_high}, {block.timestamp_low}, {block.timestamp}')
-                block_time = datetime.fromtimestamp(block.timestamp).strftime("%Y-%m-%d %H:%M:%S.%f")
-                # data = ' '.join(format(x, '02x') for x in block.packet_data)
-                #if test_log:
-                #    test_log.write(f'{packet_ndx:}: {block_time} ({block.timestamp}), len: {block.packet_len}\n')
-
-                try:
-                    packet_list = block.packet_data[1:]
-                    packet = Packet.Packet(packet_list, is_parser=True, packet_reader=packet_reader,
-                                           file_type=file_type, packet_time_from_pcap=block.timestamp)
-
-                    if packet.valid:
-                        packet_reader.handlePacketCompatibility(packet)
-
-                    if packet is None or not packet.valid:
-                        raise Exceptions.InvalidPacketException("")
-                except Exceptions.InvalidPacketException:
-                    pass
-                else:
-                    if packet.id == EVENT_PACKET_DATA_PDU or packet.id == EVENT_PACKET_ADV_PDU:
-                        pass
-                    elif packet.id == EVENT_FOLLOW:
-                        # This packet has no value for the user.
-                        pass
-                    elif packet.id == EVENT_CONNECT:
-                        pass
-                    elif packet.id == EVENT_DISCONNECT:
-                        pass
-                    elif packet.id == SWITCH_BAUD_RATE_RESP:
-                        pass
-                    elif packet.id == PING_RESP:
-                        if hasattr(packet, 'version'):
-                            versions = {1116: '3.1.0',
-                                        1115: '3.0.0',
-                                        1114: '2.0.0',
-                                        1113: '2.0.0-beta-3',
-                                        1112: '2.0.0-beta-1'}
-                            fwversion = versions.get(packet.version, 'SVN rev: %d' % packet.version)
-                            print(f'fw version: {fwversion}')
-                    elif packet.id == RESP_VERSION:
-                        pass
-                    elif packet.id == RESP_TIMESTAMP:
-                        """
-                        # Use current time as timestamp reference
-                        packet_reader._last_time = time.time()
-                        packet_reader._last_timestamp = packet.timestamp
-
-                        lt = time.localtime(packet_reader._last_time)
-                        usecs = int((packet_reader._last_time - int(packet_reader._last_time)) * 1_000_000)
-                        logging.info(f'Firmware timestamp {packet_reader._last_timestamp} reference: '
-                                     f'{time.strftime("%b %d %Y %X", lt)}.{usecs} {time.strftime("%Z", lt)}')
-                        """
-                    else:
-                        logging.info("Unknown packet ID")
-
-                    packet_reader.handlePacketHistory(packet)  # Will save this packet as last packet
-                packet_ndx += 1
+    packet_reader = Packet.PacketReader(pcapng_parser=True, timing_analyzer=analyzer)
+
+    with PcapReader.CaptureFileReader(file) as reader:
+        for timestamp, packet_data in reader:
+            parse_record(packet_reader, file_type, timestamp, packet_data)
+
+    return analyzer
+
+
+def follow_capture_file(file_type, file, stop, analyzer=None, fail_fast=False, poll_interval=DEFAULT_POLL_INTERVAL):
+    """parse a pcap or pcapng file while it is still being written.
+
+        The records are parsed as they are appended to the file, until stop is set. The file is read once more
+        after that, for the records written before the capture stopped.
+
+        Args:
+            file_type: see parse_pcapng_file()
+            file: the pcap or pcapng file name with path, it does not need to exist yet
+            stop: a threading.Event, set when the capture has finished
+            analyzer: the TimingAnalyzer to use, a new one if None
+            fail_fast: return as soon as analyzer.checkFailure() reports a failure
+            poll_interval: seconds between reads of the file
+
+        Returns:
+            the TimingAnalyzer with the T_IFS, PHY switch and connection timing results
+    """
+    if analyzer is None:
+        analyzer = TimingAnalyzer()
+
+    packet_reader = Packet.PacketReader(pcapng_parser=True, timing_analyzer=analyzer)
+
+    with PcapReader.CaptureFileFollower(file) as follower:
+        while True:
+            stopping = stop.is_set()
+            for timestamp, packet_data in follower.read():
+                parse_record(packet_reader, file_type, timestamp, packet_data)
+                if fail_fast and analyzer.checkFailure() is not None:
+                    return analyzer
+            if stopping:
+                break
+            stop.wait(poll_interval)
+
+    return analyzer
 
 
+def find_captures(patterns):
+    """The capture files given by file names, directories (their pcap and pcapng files) and glob patterns."""
+    files = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            for capture_pattern in CAPTURE_PATTERNS:
+                files += glob.glob(os.path.join(pattern, capture_pattern))
+        else:
+            files += glob.glob(pattern, recursive=True)
+    return sorted(set(f for f in files if os.path.isfile(f)))
+
+
+def analyze_file(file_type, file):
+    """Parse one capture and summarize its T_IFS, PHY switch and connection timing.
+
+        Runs in the batch worker processes, the per packet parser output is discarded.
+    """
+    summary = {"file": file, "tifs": 0, "tifs_min": None, "tifs_max": None, "tifs_avg": None, "tifs_median": None,
+               "phy_switch_time": None, "conn_timing_time": None, "result": "NO TIFS", "error": None}
+    try:
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            analyzer = parse_pcapng_file(file_type, file)
+    except (OSError, Exceptions.InvalidCaptureFile) as e:
+        summary["result"] = "ERROR"
+        summary["error"] = str(e)
+        return summary
+    except Exception as e:
+        # A corrupt capture fails its own summary, not the whole batch
+        summary["result"] = "ERROR"
+        name = type(e).__name__ if type(e).__module__ == "builtins" else f"{type(e).__module__}.{type(e).__name__}"
+        summary["error"] = f"{name}: {e}"
+        return summary
+
+    tifs = analyzer.tifs
+    summary["phy_switch_time"] = analyzer.phy_switch_time
+    summary["conn_timing_time"] = analyzer.conn_timing_time
+    summary["tifs_stats"] = tifs.summary()
+    if tifs.count > 0:
+        summary["tifs"] = tifs.count
+        summary["tifs_min"] = tifs.min
+        summary["tifs_max"] = tifs.max
+        summary["tifs_avg"] = tifs.mean
+        summary["tifs_median"] = tifs.median()
+        summary["result"], summary["error"] = timing_verdict(analyzer)
+    return summary
+
+
+def timing_verdict(analyzer):
+    """The result of the T_IFS, PHY switch and connection timing checks, as ble_test.check_results() does them.
+
+        Returns the result and its reason: PASS, FAIL when a check fails, or INCOMPLETE when no PHY switch or
+        connection was captured.
+    """
+    failure = analyzer.checkFailure()
+    if failure is not None:
+        return "FAIL", failure
+    missing = [name for name, value in (("PHY switch", analyzer.phy_switch_time),
+                                        ("connection timing", analyzer.conn_timing_time)) if value is None]
+    if missing:
+        return "INCOMPLETE", "no " + " and no ".join(missing) + " captured"
+    return "PASS", None
+
+
+def capture_formats(files):
+    """The formats, "pcap" and "pcapng", of the capture files. Files which can not be read are left out."""
+    formats = set()
+    for file in files:
+        try:
+            with PcapReader.CaptureFileReader(file) as reader:
+                formats.add("pcapng" if reader.pcapng else "pcap")
+        except (OSError, Exceptions.InvalidCaptureFile):
+            pass
+    return formats
+
+
+def analyze_batch(file_type, files, jobs=None):
+    """Analyze the capture files in parallel worker processes, returns their summaries in the order of files."""
+    # The largest files are started first, so that the workers finish at about the same time
+    by_size = sorted(files, key=os.path.getsize, reverse=True)
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = {file: executor.submit(analyze_file, file_type, file) for file in by_size}
+        return [futures[file].result() for file in files]
+
+
+def print_report(summaries, elapsed):
+    def value(v, fmt):
+        return "-" if v is None else format(v, fmt)
+
+    width = max([len(s["file"]) for s in summaries] + [4])
+    print(f'{"file":<{width}} {"T_IFS":>6} {"min":>5} {"max":>5} {"avg":>6} {"median":>6} '
+          f'{"PHY sw ms":>9} {"conn us":>7}  result')
+    for s in summaries:
+        phy_switch_ms = None if s["phy_switch_time"] is None else s["phy_switch_time"] * 1E3
+        print(f'{s["file"]:<{width}} {s["tifs"]:>6} {value(s["tifs_min"], "d"):>5} {value(s["tifs_max"], "d"):>5} '
+              f'{value(s["tifs_avg"], ".1f"):>6} {value(s["tifs_median"], ".1f"):>6} {value(phy_switch_ms, ".3f"):>9} '
+              f'{value(s["conn_timing_time"], "d"):>7}  {s["result"]}')
+        if s["error"]:
+            print(f'    {s["error"]}')
+
+    counts = {result: sum(1 for s in summaries if s["result"] == result)
+              for result in ("PASS", "FAIL", "INCOMPLETE", "NO TIFS", "ERROR")}
+    print(f'{len(summaries)} files in {elapsed:.1f} s: ' + ", ".join(f'{n} {r}' for r, n in counts.items()))
+
+
+def batch_exit_code(summaries):
+    results = set(s["result"] for s in summaries)
+    if "FAIL" in results or "ERROR" in results:
+        return 11
+    if not summaries or "NO TIFS" in results or "INCOMPLETE" in results:
+        return 10
+    return 0
+
 
 if __name__ == "__main__":
-    if len(sys.argv) != 3:
-        print(f'Please give the pcapng file type and name with full path.')
-        exit(1)
+    parser = argparse.ArgumentParser(description="Check the T_IFS, PHY switch and connection timing of sniffer "
+                                                 "pcap and pcapng captures")
+    parser.add_argument("file_type", type=int,
+                        help="0: Wireshark saved pcapng file, 1: pcap file captured by the sniffer, "
+                             "or that file converted to pcapng")
+    parser.add_argument("files", nargs="+",
+                        help="the capture file, or directories and glob patterns of captures to analyze in parallel")
+    parser.add_argument("--jobs", type=int, default=None, help="batch worker processes (default: number of CPUs)")
+    parser.add_argument("--json", help="save the batch report to this JSON file")
+    parser.add_argument("--follow", action="store_true",
+                        help="analyze the pcap or pcapng file while it is being written, until interrupted with Ctrl-C")
+    parser.add_argument("--fail-fast", action="store_true",
+                        help="with --follow, stop at the first T_IFS, PHY switch or connection timing failure")
+    args = parser.parse_args()
 
     # file_name = r'C:\Users\Ycai3\Documents\Ellisys\Captures\fit_01.pcapng'
-    file_type = int(sys.argv[1])
+    file_type = args.file_type
     if file_type != 0 and file_type != 1:
         print(f'file type should be 0 (Wireshark saved pcapng file) or 1 (pcap converted pcapng file).')
         exit(2)
 
-    file_name = sys.argv[2]
+    if len(args.files) > 1 or os.path.isdir(args.files[0]) or glob.has_magic(args.files[0]):
+        if args.follow:
+            parser.error("--follow takes a single capture file")
+        start = time.perf_counter()
+        files = find_captures(args.files)
+        # The file type depends on the sniffer firmware which wrote the capture, not on its format. A batch which
+        # mixes pcap and pcapng files most likely mixes file types too, and one of them would be misreported.
+        if len(capture_formats(files)) > 1:
+            print(f'The captures mix pcap and pcapng files, analyze each file type in its own batch.')
+            exit(2)
+        summaries = analyze_batch(file_type, files, args.jobs)
+        print_report(summaries, time.perf_counter() - start)
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump({"file_type": file_type, "files": summaries}, f, indent=2)
+        exit(batch_exit_code(summaries))
 
-    if not exists(file_name):
+    file_name = args.files[0]
+
+    if not args.follow and not exists(file_name):
         print(f'File "{file_name}" does not exist.')
         exit(3)
 
-    parse_pcapng_file(file_type, file_name)
-
-    if len(all_tifs) > 0:
-        max_tifs = max(all_tifs)
-        min_tifs = min(all_tifs)
-        avg = sum(all_tifs) / len(all_tifs)
+    with TimingAnalyzer(info_log="test_packet_info.log", tifs_log="test_tifs_log.log") as analyzer:
+        if args.follow:
+            try:
+                follow_capture_file(file_type, file_name, threading.Event(), analyzer, fail_fast=args.fail_fast)
+            except KeyboardInterrupt:
+                pass
+            failure = analyzer.checkFailure()
+            if failure is not None:
+                print(f'Failed: {failure}')
+        else:
+            parse_pcapng_file(file_type, file_name, analyzer)
+    tifs = analyzer.tifs
 
-        print(f'TIFS, total: {len(all_tifs)}, max: {max_tifs}, min: {min_tifs}, average: {avg:.1f}')
-        if max_tifs <= 152 and min_tifs >= 148:
+    if tifs.count > 0:
+        print(f'TIFS, total: {tifs.count}, max: {tifs.max}, min: {tifs.min}, average: {tifs.mean:.1f}')
+        if tifs.inSpec:
             print("                 TIFS verification: PASS")
         else:
             print("                 TIFS verification: FAIL")
@@ -0,0 +1,307 @@
+#
+# Vectorized analysis of nRF Sniffer captures.
+#
+# pcapng_file_parser.py runs every record through the live capture Packet class. This module loads all records
+# into a NumPy structured array once and computes the same T_IFS, PHY switch and connection timing results with
+# array operations, which matters for captures of several hundred MB.
+#
+# @see https://www.tcpdump.org/linktypes/LINKTYPE_NORDIC_BLE.html
+#
+from os.path import exists
+import sys
+
+import numpy as np
+from SnifferAPI import Packet, PcapReader, TimingAnalyzer
+from SnifferAPI.Types import *
+
+
+# One row per record of the capture file
+RECORD_DTYPE = np.dtype([
+    ("time", np.float64),           # record time from the pcap(ng) file, in seconds
+    ("valid", np.bool_),            # the record is a valid Nordic BLE packet
+    ("id", np.uint8),               # UART packet ID
+    ("payload_length", np.int32),   # UART payload length
+    ("timestamp", np.int64),        # sniffer timestamp, us
+    ("flags", np.uint8),
+    ("ok", np.bool_),               # CRC (and MIC if encrypted) OK, and a complete BLE packet
+    ("phy", np.uint8),
+    ("channel", np.uint8),
+    ("direction", np.bool_),
+    ("adv", np.bool_),              # advertising packet, otherwise data packet
+    ("adv_type", np.uint8),
+    ("llid", np.uint8),
+    ("ci", np.uint8),               # the byte after the access address, the coding indicator on the coded PHY
+    ("length", np.uint8),           # BLE PDU length
+    ("payload_size", np.int32),     # number of bytes from the BLE payload to the end of the record
+    ("opcode", np.int16),           # first byte of the BLE payload, -1 if there is none
+])
+
+# Connection timing states, see TimingAnalyzer.CONN_TIMING_ST_*
+CONN_INIT = TimingAnalyzer.CONN_TIMING_ST_INIT
+CONN_REQ = TimingAnalyzer.CONN_TIMING_ST_REQ
+CONN_DONE = TimingAnalyzer.CONN_TIMING_ST_DONE
+
+LL_PHY_REQ = 0x16
+
+
+INDEX_DTYPE = np.dtype([("time", np.float64), ("offset", np.int64), ("length", np.int64)])
+
+
+def load_records(buffer, index):
+    """Decode the headers of all records into a structured array.
+
+        Args:
+            buffer: the capture file contents, e.g. CaptureFileReader.buffer
+            index: (time in seconds, offset, length) of every record in buffer, e.g. from CaptureFileReader.index().
+                   Each record starts with the board ID byte.
+
+        Returns:
+            numpy structured array of RECORD_DTYPE
+    """
+    index = np.array(index, dtype=INDEX_DTYPE)
+    n = len(index)
+    rows = np.zeros(n, dtype=RECORD_DTYPE)
+    if n == 0:
+        return rows
+    rows["time"] = index["time"]
+
+    # Skip the board ID byte
+    starts = index["offset"] + 1
+    lengths = np.maximum(index["length"] - 1, 0)
+    data = np.frombuffer(buffer, dtype=np.uint8)
+
+    def byte_at(pos):
+        pos = np.asarray(pos)
+        present = lengths > pos
+        return np.where(present, data[np.minimum(starts + pos, len(data) - 1)], 0).astype(np.int64)
+
+    protover = byte_at(Packet.PROTOVER_POS)
+    payload_length = np.where(protover == PROTOVER_V1, byte_at(Packet.PAYLOAD_LEN_POS_V1),
+                              byte_at(Packet.PAYLOAD_LEN_POS) | (byte_at(Packet.PAYLOAD_LEN_POS + 1) << 8))
+    packet_id = byte_at(Packet.ID_POS)
+    is_ble = (packet_id == EVENT_PACKET_ADV_PDU) | (packet_id == EVENT_PACKET_DATA_PDU)
+
+    valid = (lengths >= Packet.HEADER_LENGTH) & (protover <= PROTOVER_V3) \
+        & (payload_length + Packet.HEADER_LENGTH == lengths)
+    # BLE packets also need the complete BLE header
+    ble = valid & is_ble
+    valid &= ~is_ble | ((byte_at(Packet.BLE_HEADER_LEN_POS) == Packet.BLE_HEADER_LENGTH)
+                        & (lengths >= Packet.BLEPACKET_POS))
+    ble &= valid
+
+    flags = byte_at(Packet.FLAGS_POS)
+    timestamp = byte_at(Packet.TIMESTAMP_POS) | (byte_at(Packet.TIMESTAMP_POS + 1) << 8) \
+        | (byte_at(Packet.TIMESTAMP_POS + 2) << 16) | (byte_at(Packet.TIMESTAMP_POS + 3) << 24)
+    phy = (flags >> 4) & 7
+    coded = (phy == PHY_CODED).astype(np.int64)
+    header = byte_at(Packet.BLEPACKET_POS + 4 + coded)
+    payload_pos = Packet.BLEPACKET_POS + 6 + coded
+
+    access_address = np.stack([byte_at(Packet.BLEPACKET_POS + i) for i in range(4)], axis=1)
+    adv_access_address = np.frombuffer(Packet.ADV_ACCESS_ADDRESS, dtype=np.uint8)
+    adv = np.where(protover >= PROTOVER_V3, packet_id == EVENT_PACKET_ADV_PDU,
+                   (access_address == adv_access_address).all(axis=1))
+
+    crc_ok = (flags & 1) != 0
+    encrypted = (flags & 4) != 0
+    mic_ok = (flags & 8) != 0
+
+    rows["valid"] = valid
+    rows["id"] = packet_id
+    rows["payload_length"] = payload_length
+    rows["timestamp"] = np.where(ble, timestamp, 0)
+    rows["flags"] = np.where(ble, flags, 0)
+    # The BLE packet can only be parsed up to its payload if the record is long enough
+    rows["ok"] = ble & crc_ok & (mic_ok | ~encrypted) & (lengths >= payload_pos)
+    rows["phy"] = np.where(ble, phy, 0)
+    rows["channel"] = np.where(ble, byte_at(Packet.CHANNEL_POS), 0)
+    rows["direction"] = ble & ((flags & 2) != 0)
+    rows["adv"] = adv
+    rows["adv_type"] = header & 15
+    rows["llid"] = header & 3
+    rows["ci"] = byte_at(Packet.BLEPACKET_POS + 4)
+    rows["length"] = byte_at(payload_pos - 1)
+    rows["payload_size"] = lengths - payload_pos
+    rows["opcode"] = np.where(lengths > payload_pos, byte_at(payload_pos), -1)
+    return rows
+
+
+def previous_index(mask):
+    """For each row, the index of the last earlier row where mask is True, or -1."""
+    index = np.where(mask, np.arange(len(mask)), -1)
+    index = np.maximum.accumulate(index) if len(index) else index
+    return np.concatenate(([-1], index[:-1]))
+
+
+def packet_time(rows, previous_length):
+    """On air time of the previous packet in us, see PacketReader.getPacketTime()."""
+    ble_payload_length = previous_length - Packet.BLE_HEADER_LENGTH
+    fec1_block_us = 80 + 256 + 16 + 24
+    fec2_block_len = ble_payload_length - 4 - 1
+    phy = rows["phy"]
+    ci = rows["ci"]
+    return np.select(
+        [phy == PHY_1M,
+         phy == PHY_2M,
+         (phy == PHY_CODED) & (ci == PHY_CODED_CI_S8),
+         (phy == PHY_CODED) & (ci == PHY_CODED_CI_S2)],
+        [8 * (1 + ble_payload_length),
+         4 * (2 + ble_payload_length),
+         fec1_block_us + 64 * fec2_block_len + 24,
+         fec1_block_us + 16 * fec2_block_len + 6],
+        0)
+
+
+def end_to_start_times(rows, file_type):
+    """T_IFS of every record, in us: the time from the end of the previous packet to the start of this one."""
+    if file_type == 1:
+        return rows["timestamp"].copy()
+
+    # The previous valid record (PacketReader.lastReceivedPacket) and the previous valid BLE packet
+    # (PacketReader.lastReceivedTimestampPacket)
+    is_ble = (rows["id"] == EVENT_PACKET_ADV_PDU) | (rows["id"] == EVENT_PACKET_DATA_PDU)
+    last_valid = previous_index(rows["valid"])
+    last_ble = previous_index(rows["valid"] & is_ble)
+
+    previous_length = rows["payload_length"][np.maximum(last_valid, 0)].astype(np.int64)
+    start_to_start = rows["timestamp"] - rows["timestamp"][np.maximum(last_ble, 0)]
+    return np.where(last_ble >= 0, start_to_start - packet_time(rows, previous_length), 0)
+
+
+def compose_scan(transitions):
+    """Prefix composition of per row state transitions.
+
+        Args:
+            transitions: (n, states) array, transitions[i][s] is the state after row i when in state s before it
+
+        Returns:
+            (n, states) array, row i maps the initial state to the state after row i
+    """
+    result = transitions.copy()
+    step = 1
+    while step < len(result):
+        result[step:] = np.take_along_axis(result[step:], result[:-step], axis=1)
+        step *= 2
+    return result
+
+
+def analyze(rows, file_type):
+    """Compute the T_IFS, PHY switch and connection timing results, as the Packet class does when parsing.
+
+        Args:
+            rows: records from load_records()
+            file_type: 0 for Wireshark saved pcapng files, 1 for files captured by the sniffer (pcap, or converted pcapng)
+
+        Returns:
+            dict with "tifs" (array of T_IFS in us), "tifs_packets" (their record indexes),
+            "phy_switch_time" (s) and "conn_timing_time" (us), None if not found
+    """
+    end_to_start = end_to_start_times(rows, file_type)
+
+    # Only complete BLE packets with a correct CRC go through the checks
+    index = np.flatnonzero(rows["ok"])
+    packets = rows[index]
+    end_to_start = end_to_start[index]
+    n = len(packets)
+    has_previous = np.arange(n) > 0
+    is_data = ~packets["adv"]
+
+    # Connection detection: set by a CONNECT_IND, cleared by any other advertising packet
+    connect_ind = packets["adv"] & (packets["adv_type"] == PDU_TYPE_CONNECT_IND) & has_previous
+    clear = packets["adv"] & ~connect_ind
+    last_change = np.maximum.accumulate(np.where(connect_ind | clear, np.arange(n), -1)) if n else np.zeros(0, int)
+    detected = (last_change >= 0) & connect_ind[np.maximum(last_change, 0)]
+
+    # Connection timing state machine, as a transition table per packet
+    states = np.array([CONN_INIT, CONN_REQ, CONN_DONE])
+    state = np.where(clear[:, None] & (states == CONN_DONE), CONN_INIT, states)
+    transitions = np.where(detected[:, None] & (state == CONN_INIT), CONN_REQ,
+                           np.where(is_data[:, None] & (state == CONN_REQ), CONN_DONE, state))
+    after = compose_scan(transitions.astype(np.int8))[:, CONN_INIT] if n else np.zeros(0, np.int8)
+    before = np.concatenate(([CONN_INIT], after[:-1]))
+    conn_done = (before != CONN_DONE) & (after == CONN_DONE)
+    conn_timing_time = int(end_to_start[conn_done][-1]) if conn_done.any() else None
+
+    # PHY switch: from an LL_PHY_REQ to the first packet which is not on the 1M PHY
+    phy_req = np.flatnonzero(is_data & (packets["llid"] == 3) & (packets["payload_size"] == 6)
+                             & (packets["opcode"] == LL_PHY_REQ))
+    new_phy = np.flatnonzero(packets["phy"] != PHY_1M)
+    phy_switch_time = None
+    if len(phy_req):
+        applied = np.searchsorted(new_phy, phy_req)
+        applied = np.where(applied < len(new_phy), new_phy[np.minimum(applied, len(new_phy) - 1)], n)
+        # A later LL_PHY_REQ before the new PHY is applied restarts the measurement
+        next_req = np.append(phy_req[1:], n)
+        completed = np.flatnonzero(applied < next_req)
+        if len(completed):
+            last = completed[-1]
+            times = packets["time"]
+            phy_switch_time = float(times[applied[last]] - times[phy_req[last]])
+
+    # T_IFS, from slave to master in a connection, until the PHY switch starts
+    first_phy_req = phy_req[0] if len(phy_req) else n
+    tifs_mask = (np.arange(n) < first_phy_req) & has_previous & is_data & detected & ~packets["direction"]
+
+    return {
+        "tifs": end_to_start[tifs_mask],
+        "tifs_packets": index[tifs_mask],
+        "phy_switch_time": phy_switch_time,
+        "conn_timing_time": conn_timing_time,
+    }
+
+
+def parse_pcapng_file(file_type, file):
+    """Parse a saved sniffer pcap or pcapng file and compute the timing results.
+
+        Args:
+            file_type:
+                0: Wireshark saved pcapng file
+                1: pcap file captured by the sniffer, or that file converted to pcapng
+            file: the saved sniffer pcap or pcapng file name with path
+
+        Returns:
+            dict, see analyze()
+    """
+    with PcapReader.CaptureFileReader(file) as reader:
+        rows = load_records(reader.buffer, reader.index())
+    return analyze(rows, file_type)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print(f'Please give the file type and the pcap or pcapng file name with full path.')
+        exit(1)
+
+    file_type = int(sys.argv[1])
+    if file_type != 0 and file_type != 1:
+        print(f'file type should be 0 (Wireshark saved pcapng file) or 1 (sniffer captured pcap file).')
+        exit(2)
+
+    file_name = sys.argv[2]
+
+    if not exists(file_name):
+        print(f'File "{file_name}" does not exist.')
+        exit(3)
+
+    results = parse_pcapng_file(file_type, file_name)
+    all_tifs = results["tifs"]
+
+    if results["phy_switch_time"] is not None:
+        print(f'PHY switch time: {results["phy_switch_time"] * 1E3:.3f} ms')
+    if results["conn_timing_time"] is not None:
+        print(f'Connection timing: {results["conn_timing_time"]} us')
+
+    if len(all_tifs) > 0:
+        max_tifs = all_tifs.max()
+        min_tifs = all_tifs.min()
+        avg = all_tifs.mean()
+
+        print(f'TIFS, total: {len(all_tifs)}, max: {max_tifs}, min: {min_tifs}, average: {avg:.1f}')
+        if max_tifs <= TimingAnalyzer.TIFS_MAX and min_tifs >= TimingAnalyzer.TIFS_MIN:
+            print("                 TIFS verification: PASS")
+        else:
+            print("                 TIFS verification: FAIL")
+            exit(11)
+    else:
+        print("No TIFS captured.")
+        exit(10)
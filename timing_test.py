@@ -36,6 +36,7 @@
 import argparse
 from BLE_hci import BLE_hci
 from BLE_hci import Namespace
+from ble_hci_console import isConnectionComplete
 from nrf_sniffer_ble import run_sniffer as exe_sniffer
 import os
 import shutil
@@ -45,6 +46,11 @@ from threading import Thread
 
 sniffer_res = dict()
 
+# Seconds the connection runs before and after the PHY switch, for the sniffer to measure it
+MEASURE_TIME = 3
+# Seconds to wait for the connection to be established
+CONNECT_TIMEOUT = 5
+
 
 def get_args():
     parser = argparse.ArgumentParser()
@@ -148,38 +154,35 @@ def run_test(inputs, new_phy):
     slv_hci = BLE_hci({"serialPort": inputs.hci2, "monPort": inputs.mon2, "baud": 115200, "id": 2})
     mst_hci = BLE_hci({"serialPort": inputs.hci1, "monPort": inputs.mon1, "baud": 115200, "id": 1})
 
+    # Each command returns when the controller responded to it, no delay is needed between them
     print("\nslave reset")
     slv_hci.resetFunc(None)
-    sleep(1)
     print("\nmaster reset")
     mst_hci.resetFunc(None)
-    sleep(0.2)
 
     print(f"\nset slave address: {inputs.addr2}")
     slv_hci.addrFunc(Namespace(addr=inputs.addr2))
-    sleep(0.2)
     print(f"\nset master address: {inputs.addr1}")
     mst_hci.addrFunc(Namespace(addr=inputs.addr1))
-    sleep(0.2)
 
     print("\nslave starts adv")
     slv_hci.advFunc(Namespace(interval="60", stats="False", connect="True", maintain=False, listen="False"))
-    sleep(0.5)
 
     print("\nmaster starts to connect")
     mst_hci.initFunc(Namespace(interval="6", timeout="64", addr=inputs.addr2, stats="False", maintain=False, listen="False"))
-    sleep(3)
+    if mst_hci.wait_for_event(isConnectionComplete, timeout=CONNECT_TIMEOUT) is None:
+        print(f"\nmaster: no connection within {CONNECT_TIMEOUT} secs")
+    sleep(MEASURE_TIME)
 
+    # phyFunc() returns when the PHY update completed
     print(f'\nslave changes the PHY to {new_phy}')
     slv_hci.phyFunc(Namespace(phy=str(new_phy), timeout=1))
-    sleep(3)
+    sleep(MEASURE_TIME)
 
     print("\nslave reset")
     slv_hci.resetFunc(None)
-    sleep(0.2)
     print("\nmaster reset")
     mst_hci.resetFunc(None)
-    sleep(0.2)
 
     print(f"\ntest on phy: {new_phy} done\n")
 